@@ -5,6 +5,7 @@ import uuid
 from socket import timeout
 
 import dashi.bootstrap as bootstrap
+import dashi.exceptions
 from dashi.util import LoopingCall
 
 from epu.highavailability.policy import policy_map
@@ -19,10 +20,16 @@ DEFAULT_TOPIC = "highavailability"
 
 class DashiHAProcessControl(object):
 
+    # the only process fields HA policies look at
+    process_fields = ['upid', 'state', 'hostname']
+
     def __init__(self, dashi, process_dispatchers):
         self.dashi = dashi
         self.process_dispatchers = list(process_dispatchers)
 
+        # process dispatchers which predate list_processes
+        self.legacy_dispatchers = set()
+
     def _get_pd_client(self, name):
         return ProcessDispatcherClient(self.dashi, name)
 
@@ -57,15 +64,33 @@ class DashiHAProcessControl(object):
         for pd_name in self.process_dispatchers:
             pd_client = self._get_pd_client(pd_name)
             try:
-                procs = pd_client.describe_processes()
-                all_procs[pd_name] = procs
+                all_procs[pd_name] = self._list_processes(pd_name, pd_client)
             except timeout:
-                log.warning("%s timed out when calling describe_processes", pd_name)
+                log.warning("%s timed out when listing processes", pd_name)
             except Exception:
                 log.exception("Problem querying %s", pd_name)
 
         return all_procs
 
+    def _list_processes(self, pd_name, pd_client):
+        if pd_name not in self.legacy_dispatchers:
+            try:
+                return pd_client.list_all_processes(fields=self.process_fields)
+            except dashi.exceptions.DashiError, e:
+                if not _is_unknown_operation(e):
+                    raise
+                log.info("%s doesn't support list_processes. Falling back "
+                         "to describe_processes", pd_name)
+                self.legacy_dispatchers.add(pd_name)
+
+        # for compatibility with older services
+        return pd_client.describe_processes()
+
+
+def _is_unknown_operation(e):
+    return (isinstance(e, dashi.exceptions.UnknownOperationError) or
+            getattr(e, 'exc_type', None) == "UnknownOperationError")
+
 
 class HighAvailabilityService(object):
 
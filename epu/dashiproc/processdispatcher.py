@@ -9,7 +9,10 @@ from epu.processdispatcher.core import ProcessDispatcherCore
 from epu.processdispatcher.store import get_processdispatcher_store
 from epu.processdispatcher.engines import EngineRegistry
 from epu.processdispatcher.matchmaker import PDMatchmaker
+from epu.processdispatcher.scheduling import get_scheduling_policy
 from epu.processdispatcher.doctor import PDDoctor
+from epu.processdispatcher.heartbeats import HeartbeatIngester
+from epu.processdispatcher.resourcecache import ResourceCache
 from epu.dashiproc.epumanagement import EPUManagementClient
 from epu.util import get_config_paths
 import epu.dashiproc
@@ -43,6 +46,9 @@ class ProcessDispatcherService(object):
         self.store.initialize()
         self.registry = registry or EngineRegistry.from_config(engine_conf,
             default=default_engine, process_engines=process_engines)
+
+        # engines added at runtime are shared by all workers through the store
+        self.registry.follow_store(self.store)
         self.eeagent_client = EEAgentClient(self.dashi)
 
         domain_definition_id = None
@@ -67,21 +73,46 @@ class ProcessDispatcherService(object):
         else:
             self.notifier = SubscriberNotifier(self.dashi)
 
+        evacuation_concurrency = self.CFG.processdispatcher.get('evacuation_concurrency', 1)
         self.core = ProcessDispatcherCore(self.store,
                                           self.registry,
                                           self.eeagent_client,
-                                          self.notifier)
+                                          self.notifier,
+                                          evacuation_concurrency=evacuation_concurrency)
 
         launch_type = self.CFG.processdispatcher.get('launch_type', 'supd')
         restart_throttling_config = self.CFG.processdispatcher.get('restart_throttling_config', {})
         dispatch_retry_seconds = self.CFG.processdispatcher.get('dispatch_retry_seconds')
+        matchmaking_concurrency = self.CFG.processdispatcher.get('matchmaking_concurrency', 1)
+        dispatch_concurrency = self.CFG.processdispatcher.get('dispatch_concurrency', 1)
+        scheduling_policy = get_scheduling_policy(
+            self.CFG.processdispatcher.get('scheduling_policy'))
+
+        # the matchmaker and doctor share one view of execution resources
+        self.resource_cache = ResourceCache(self.store)
 
         self.matchmaker = PDMatchmaker(self.core, self.store, self.eeagent_client,
             self.registry, self.epum_client, self.notifier, self.topic,
             domain_definition_id, base_domain_config, launch_type,
-            restart_throttling_config, dispatch_retry_seconds)
+            restart_throttling_config, dispatch_retry_seconds,
+            matchmaking_concurrency=matchmaking_concurrency,
+            scheduling_policy=scheduling_policy,
+            dispatch_concurrency=dispatch_concurrency,
+            resource_cache=self.resource_cache)
+
+        self.doctor = PDDoctor(self.core, self.store, config=self.CFG,
+            resource_cache=self.resource_cache)
+
+        # heartbeats are processed inline, or by their own worker pool when
+        # heartbeat_workers is set
+        heartbeat_workers = self.CFG.processdispatcher.get('heartbeat_workers', 0)
+        if heartbeat_workers:
+            heartbeat_queue_size = self.CFG.processdispatcher.get('heartbeat_queue_size', 10000)
+            self.heartbeat_ingester = HeartbeatIngester(self.core.ee_heartbeat,
+                worker_count=heartbeat_workers, max_pending=heartbeat_queue_size)
+        else:
+            self.heartbeat_ingester = None
 
-        self.doctor = PDDoctor(self.core, self.store, config=self.CFG)
         self.ready_event = threading.Event()
 
     def start(self):
@@ -98,6 +129,9 @@ class ProcessDispatcherService(object):
 
         epu.dashiproc.link_dashi_exceptions(self.dashi)
 
+        if self.heartbeat_ingester:
+            self.heartbeat_ingester.start()
+
         self.dashi.handle(self.set_system_boot)
         self.dashi.handle(self.create_definition)
         self.dashi.handle(self.describe_definition)
@@ -108,6 +142,7 @@ class ProcessDispatcherService(object):
         self.dashi.handle(self.schedule_process)
         self.dashi.handle(self.describe_process)
         self.dashi.handle(self.describe_processes)
+        self.dashi.handle(self.list_processes)
         self.dashi.handle(self.restart_process)
         self.dashi.handle(self.terminate_process)
         self.dashi.handle(self.node_state)
@@ -130,6 +165,8 @@ class ProcessDispatcherService(object):
         self.ready_event.clear()
         self.dashi.cancel()
         self.dashi.disconnect()
+        if self.heartbeat_ingester:
+            self.heartbeat_ingester.stop()
         self.store.shutdown()
 
     def _make_process_dict(self, proc):
@@ -166,14 +203,15 @@ class ProcessDispatcherService(object):
                          subscribers=None, constraints=None,
                          queueing_mode=None, restart_mode=None,
                          execution_engine_id=None, node_exclusive=None,
-                         name=None):
+                         name=None, priority=None):
 
         result = self.core.schedule_process(None, upid=upid,
             definition_id=definition_id, configuration=configuration,
             subscribers=subscribers, constraints=constraints,
             queueing_mode=queueing_mode, restart_mode=restart_mode,
             node_exclusive=node_exclusive,
-            execution_engine_id=execution_engine_id, name=name)
+            execution_engine_id=execution_engine_id, name=name,
+            priority=priority)
         return self._make_process_dict(result)
 
     def describe_process(self, upid):
@@ -182,6 +220,11 @@ class ProcessDispatcherService(object):
     def describe_processes(self):
         return self.core.describe_processes()
 
+    def list_processes(self, states=None, owner=None, engine_id=None,
+                       fields=None, cursor=None, limit=None):
+        return self.core.list_processes(states=states, owner=owner,
+            engine_id=engine_id, fields=fields, cursor=cursor, limit=limit)
+
     def restart_process(self, upid):
         result = self.core.restart_process(None, upid)
         return self._make_process_dict(result)
@@ -195,10 +238,16 @@ class ProcessDispatcherService(object):
 
     def heartbeat(self, sender, message):
         log.debug("got heartbeat from %s: %s", sender, message)
-        self.core.ee_heartbeat(sender, message)
+        if self.heartbeat_ingester:
+            self.heartbeat_ingester.submit(sender, message)
+        else:
+            self.core.ee_heartbeat(sender, message)
 
     def dump(self):
-        return self.core.dump()
+        state = self.core.dump()
+        if self.heartbeat_ingester:
+            state['heartbeats'] = self.heartbeat_ingester.get_stats()
+        return state
 
     def add_engine(self, definition):
         self.core.add_engine(definition)
@@ -285,13 +334,16 @@ class ProcessDispatcherClient(object):
                          subscribers=None, constraints=None,
                          queueing_mode=None, restart_mode=None,
                          execution_engine_id=None, node_exclusive=None,
-                         name=None):
+                         name=None, priority=None):
         request = dict(upid=upid, definition_id=definition_id,
                        configuration=configuration,
                        subscribers=subscribers, constraints=constraints,
                        queueing_mode=queueing_mode, restart_mode=restart_mode,
                        execution_engine_id=execution_engine_id,
                        node_exclusive=node_exclusive, name=name)
+        # only send priority when set, for compatibility with older services
+        if priority is not None:
+            request['priority'] = priority
 
         return self.dashi.call(self.topic, "schedule_process", args=request)
 
@@ -301,6 +353,32 @@ class ProcessDispatcherClient(object):
     def describe_processes(self):
         return self.dashi.call(self.topic, "describe_processes")
 
+    def list_processes(self, states=None, owner=None, engine_id=None,
+                       fields=None, cursor=None, limit=None):
+        """Get one page of processes, optionally filtered and projected
+
+        Returns a dict with a list of processes and the cursor to pass to
+        get the next page, which is None after the last page.
+        """
+        return self.dashi.call(self.topic, "list_processes", states=states,
+            owner=owner, engine_id=engine_id, fields=fields, cursor=cursor,
+            limit=limit)
+
+    def list_all_processes(self, states=None, owner=None, engine_id=None,
+                           fields=None, page_size=1000):
+        """Get all processes, optionally filtered and projected, one page at a time
+        """
+        processes = []
+        cursor = None
+        while True:
+            page = self.list_processes(states=states, owner=owner,
+                engine_id=engine_id, fields=fields, cursor=cursor,
+                limit=page_size)
+            processes.extend(page['processes'])
+            cursor = page['cursor']
+            if cursor is None:
+                return processes
+
     def restart_process(self, upid):
         return self.dashi.call(self.topic, 'restart_process', upid=upid)
 
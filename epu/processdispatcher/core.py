@@ -1,6 +1,8 @@
 # Copyright 2013 University of Chicago
 
 import logging
+import threading
+import time
 
 from epu.states import InstanceState, ProcessState, ExecutionResourceState
 from epu.exceptions import NotFoundError, WriteConflictError, BadRequestError
@@ -10,8 +12,10 @@ from epu.processdispatcher.store import ProcessRecord, NodeRecord, \
     ResourceRecord, ProcessDefinitionRecord
 from epu.processdispatcher.modes import RestartMode
 from epu.processdispatcher.util import get_process_state_message, \
-    get_set_difference_debug_message
+    get_set_difference_debug_message, LRUCache
 from epu.processdispatcher.engines import EngineSpec
+from epu.processdispatcher.processindex import ProcessIndex
+import epu.tevent as tevent
 
 log = logging.getLogger(__name__)
 
@@ -29,6 +33,13 @@ def validate_definition_id(definition_id):
         raise BadRequestError("invalid definition_id")
 
 
+def validate_priority(priority):
+    # bool is an int subclass but is surely a mistake here
+    if priority is not None and (isinstance(priority, bool) or
+            not isinstance(priority, (int, long))):
+        raise BadRequestError("invalid priority")
+
+
 class ProcessDispatcherCore(object):
     """Service that fields requests from application engines and operators
     for process launches and termination.
@@ -57,7 +68,18 @@ class ProcessDispatcherCore(object):
 
     """
 
-    def __init__(self, store, ee_registry, eeagent_client, notifier):
+    # a heartbeat identical to the last one which needed no changes only has
+    # its timestamp recorded. Every so often a full check is done anyway.
+    heartbeat_recheck_seconds = 300
+
+    # evacuations log their progress every so many processes
+    evacuation_progress_interval = 100
+
+    # number of process rounds whose constraints are remembered
+    process_constraints_cache_size = 10000
+
+    def __init__(self, store, ee_registry, eeagent_client, notifier,
+                 evacuation_concurrency=1):
         """
 
         @param store:
@@ -65,12 +87,35 @@ class ProcessDispatcherCore(object):
         @param ee_registry:
         @param eeagent_client:
         @param notifier:
+        @param evacuation_concurrency: number of processes evacuated at once
         @return:
         """
         self.store = store
         self.ee_registry = ee_registry
         self.eeagent_client = eeagent_client
         self.notifier = notifier
+        self.evacuation_concurrency = evacuation_concurrency or 1
+
+        # sender -> (heartbeat signature, resource version, time). Records
+        # the last heartbeat from each EE which needed no changes, so an
+        # identical heartbeat only needs its timestamp recorded.
+        self.heartbeat_signatures = {}
+
+        # (owner, upid) -> sender, for processes reported in a recorded
+        # heartbeat signature. Each has one store watch outstanding, which
+        # drops the sender's signature when the process record changes.
+        self.heartbeat_watched_processes = {}
+
+        # protects the heartbeat watches. never held while calling into the
+        # store, because store watchers can fire under its lock
+        self.heartbeat_lock = threading.Lock()
+
+        # in-memory copy of process records, for listing processes
+        self.process_index = ProcessIndex(store)
+
+        # (owner, upid, round) -> (registry generation, default engine,
+        # constraints). See get_process_constraints()
+        self.process_constraints = LRUCache(self.process_constraints_cache_size)
 
     def set_system_boot(self, system_boot):
         """Operation used at the end of a launch to disable system boot mode
@@ -158,7 +203,7 @@ class ProcessDispatcherCore(object):
                          configuration=None, subscribers=None,
                          constraints=None, queueing_mode=None,
                          restart_mode=None, execution_engine_id=None,
-                         node_exclusive=None, name=None):
+                         node_exclusive=None, name=None, priority=None):
         """Schedule a process for execution
 
         @param upid: unique process identifier
@@ -171,6 +216,7 @@ class ProcessDispatcherCore(object):
         @param execution_engine_id: dispatch a process to a specific eea
         @param node_exclusive: property that will only be permitted once on a node
         @param name: a (hopefully) human recognizable name for the process
+        @param priority: scheduling priority. higher is matched sooner.
         @rtype: ProcessRecord
         @return: description of process launch status
 
@@ -188,6 +234,7 @@ class ProcessDispatcherCore(object):
         """
 
         validate_owner_upid(owner, upid)
+        validate_priority(priority)
 
         if constraints is None:
             constraints = {}
@@ -197,7 +244,7 @@ class ProcessDispatcherCore(object):
         process_updates = dict(configuration=configuration,
             subscribers=subscribers, constraints=constraints,
             queueing_mode=queueing_mode, restart_mode=restart_mode,
-            node_exclusive=node_exclusive, name=name)
+            node_exclusive=node_exclusive, name=name, priority=priority)
 
         process = self.store.get_process(owner, upid)
 
@@ -279,8 +326,60 @@ class ProcessDispatcherCore(object):
         Get a list of processes in the system
         @return: list of process descriptions
         """
-        return [self.store.get_process(owner, upid)
-                for owner, upid in self.store.get_process_ids()]
+        return [process for process in
+                self.store.get_processes(self.store.get_process_ids())
+                if process is not None]
+
+    def list_processes(self, states=None, owner=None, engine_id=None,
+                       fields=None, cursor=None, limit=None):
+        """
+        Get a page of processes in the system, optionally filtered
+        @param states: only include processes in one of these states
+        @param owner: only include processes of this owner
+        @param engine_id: only include processes for this execution engine
+        @param fields: only include these fields of each process
+        @param cursor: cursor returned with the previous page
+        @param limit: maximum number of processes in the page
+        @return: dict with list of process descriptions in "processes" and
+            the cursor of the next page in "cursor", or None if this is the
+            last page
+
+        Processes are listed from an in-memory index rather than read from
+        the store, so a page may not reflect changes made just before the
+        call.
+        """
+        if states is not None:
+            if not isinstance(states, (list, tuple)):
+                raise BadRequestError("states must be a list")
+            states = frozenset(states)
+        if fields is not None:
+            if not isinstance(fields, (list, tuple)):
+                raise BadRequestError("fields must be a list")
+        if cursor is not None and not isinstance(cursor, basestring):
+            raise BadRequestError("invalid cursor")
+        if limit is not None:
+            if not isinstance(limit, (int, long)) or limit < 1:
+                raise BadRequestError("limit must be a positive integer")
+
+        def match(process):
+            if states is not None and process.state not in states:
+                return False
+            if owner is not None and process.owner != owner:
+                return False
+            if (engine_id is not None and
+                    self.get_process_engine_id(process) != engine_id):
+                return False
+            return True
+
+        processes, next_cursor = self.process_index.query(match=match,
+            cursor=cursor, limit=limit)
+
+        if fields is None:
+            descriptions = [dict(process) for process in processes]
+        else:
+            descriptions = [dict((field, process.get(field)) for field in fields)
+                            for process in processes]
+        return dict(processes=descriptions, cursor=next_cursor)
 
     def restart_process(self, owner, upid):
         """
@@ -451,36 +550,58 @@ class ProcessDispatcherCore(object):
         rescheduled_process_state: the state restartable processes are moved to.
             defaults to REQUESTED
         """
-        node_id = node.node_id
+        self.evacuate_nodes([node], is_system_restart=is_system_restart,
+            dead_process_state=dead_process_state,
+            rescheduled_process_state=rescheduled_process_state)
 
-        for resource_id in node.resources:
-            resource = self.store.get_resource(resource_id)
+    def evacuate_nodes(self, nodes, is_system_restart=False,
+                       dead_process_state=None, rescheduled_process_state=None):
+        """Remove nodes and reschedule their processes as needed
 
+        The processes of all of the nodes are evacuated together. See
+        evacuate_node() for the parameters.
+        """
+        def disable_resource(resource_id):
+            resource = self.store.get_resource(resource_id)
             if not resource:
-                log.warn("Node has unknown resource %s", node_id, resource_id)
-                continue
+                return None
 
-            else:
-                # mark resource ineligible for scheduling
-                self.resource_change_state(resource, ExecutionResourceState.DISABLED)
+            # mark resource ineligible for scheduling
+            updated_resource, _ = self.resource_change_state(resource,
+                ExecutionResourceState.DISABLED)
+            return updated_resource or resource
 
-                self.evacuate_resource(
-                    resource,
-                    is_system_restart=is_system_restart,
-                    dead_process_state=dead_process_state,
-                    rescheduled_process_state=rescheduled_process_state,
-                    update_node_exclusive=False)
-                # node is going away, so we don't bother updating node exclusive
+        resource_ids = []
+        for node in nodes:
+            resource_ids.extend(node.resources)
+        resources = self._evacuation_map(disable_resource, resource_ids)
 
+        for resource_id, resource in zip(resource_ids, resources):
+            if not resource:
+                log.warn("Node has unknown resource %s", resource_id)
+        resources = [resource for resource in resources if resource]
+
+        # node is going away, so we don't bother updating node exclusive
+        self._evacuate_resources(resources,
+            is_system_restart=is_system_restart,
+            dead_process_state=dead_process_state,
+            rescheduled_process_state=rescheduled_process_state,
+            update_node_exclusive=False, clear_assignments=False)
+
+        def remove_resource(resource):
+            self._clear_resource_assignments(resource)
             try:
-                self.store.remove_resource(resource_id)
+                self.store.remove_resource(resource.resource_id)
             except NotFoundError:
                 pass
+            self._forget_heartbeat_signature(resource.resource_id)
+        self._evacuation_map(remove_resource, resources)
 
-        try:
-            self.store.remove_node(node_id)
-        except NotFoundError:
-            pass
+        for node in nodes:
+            try:
+                self.store.remove_node(node.node_id)
+            except NotFoundError:
+                pass
 
     def evacuate_resource(self, resource, is_system_restart=False,
                       dead_process_state=None, rescheduled_process_state=None,
@@ -490,31 +611,133 @@ class ProcessDispatcherCore(object):
         This assumes the resource is already disabled or is otherwise prevented
         from being assigned any new processes
         """
-
-        processes = []
-        for owner, upid, round in resource.assigned:
-            process = self.store.get_process(owner, upid)
-            if process:
-                processes.append(process)
+        self.evacuate_resources([resource],
+            is_system_restart=is_system_restart,
+            dead_process_state=dead_process_state,
+            rescheduled_process_state=rescheduled_process_state,
+            update_node_exclusive=update_node_exclusive)
+
+    def evacuate_resources(self, resources, is_system_restart=False,
+                           dead_process_state=None, rescheduled_process_state=None,
+                           update_node_exclusive=True):
+        """Remove and reschedule processes from several resources at once
+
+        Processes are evacuated concurrently as evacuation_concurrency allows,
+        and rescheduled processes are queued together once all are done. See
+        evacuate_resource() for the parameters.
+        """
+        self._evacuate_resources(resources,
+            is_system_restart=is_system_restart,
+            dead_process_state=dead_process_state,
+            rescheduled_process_state=rescheduled_process_state,
+            update_node_exclusive=update_node_exclusive)
+
+    def _evacuate_resources(self, resources, is_system_restart=False,
+                            dead_process_state=None, rescheduled_process_state=None,
+                            update_node_exclusive=True, clear_assignments=True):
+        start_time = time.time()
+
+        for resource in resources:
+            self._forget_heartbeat_signature(resource.resource_id)
+
+        process_ids = []
+        process_rounds = []
+        process_resources = []
+        for resource in resources:
+            for owner, upid, round in resource.assigned:
+                process_ids.append((owner, upid))
+                process_rounds.append(round)
+                process_resources.append(resource)
+
+        # processes which have already moved on to a later round are no longer
+        # on the resource. This happens when an earlier evacuation of the same
+        # resource failed partway and is being retried.
+        evacuations = [(process, resource) for process, round, resource in
+                       zip(self.store.get_processes(process_ids), process_rounds,
+                           process_resources)
+                       if process and process.round <= round]
 
         # update node exclusive tags first, in case we die partway through this
         # operation. on recovery it should be retried and we don't want to leave
         # node exclusives orphaned.
         if update_node_exclusive:
-            to_remove = [p.node_exclusive for p in processes if p.node_exclusive]
-            if to_remove:
-                node = self.store.get_node(resource.node_id)
+            node_exclusives = {}
+            for process, resource in evacuations:
+                if process.node_exclusive:
+                    node_exclusives.setdefault(resource.node_id, []).append(
+                        process.node_exclusive)
+            for node_id, to_remove in node_exclusives.iteritems():
+                node = self.store.get_node(node_id)
                 if node:
                     self.node_remove_exclusive_tags(node, to_remove)
 
         # now go through and evacuate each process
-        for process in processes:
-            self._evacuate_process(process, resource,
-                is_system_restart=is_system_restart,
-                dead_process_state=dead_process_state,
-                rescheduled_process_state=rescheduled_process_state)
+        progress = _EvacuationProgress(len(evacuations),
+            self.evacuation_progress_interval)
+
+        # rescheduled processes, and (resource_id, exception) for processes
+        # which couldn't be evacuated
+        requeued = []
+        failures = []
+
+        def evacuate(evacuation):
+            process, resource = evacuation
+            try:
+                rescheduled = self._evacuate_process(process, resource,
+                    is_system_restart=is_system_restart,
+                    dead_process_state=dead_process_state,
+                    rescheduled_process_state=rescheduled_process_state,
+                    enqueue=False)
+            except Exception, e:
+                log.exception("Problem evacuating process %s from resource %s",
+                    process.upid, resource.resource_id)
+                failures.append((resource.resource_id, e))
+                return
+            if rescheduled is not None:
+                requeued.append(rescheduled)
+            progress.increment()
 
-        self._clear_resource_assignments(resource)
+        try:
+            self._evacuation_map(evacuate, evacuations)
+        finally:
+            # queue rescheduled processes in one go, so the matchmaker sees a
+            # single change to the queue rather than one per process. This
+            # happens even if evacuation was cut short, so that no process
+            # is left in its next round without being queued.
+            self.store.enqueue_processes(process.key for process in requeued)
+
+        # resources with processes that failed to evacuate keep their
+        # assignments, so that the evacuation can be retried
+        if clear_assignments:
+            failed_resource_ids = set(resource_id for resource_id, _ in failures)
+            for resource in resources:
+                if resource.resource_id not in failed_resource_ids:
+                    self._clear_resource_assignments(resource)
+
+        if evacuations:
+            log.info("Evacuated %d processes from %d resources in %.2f seconds",
+                len(evacuations) - len(failures), len(resources),
+                time.time() - start_time)
+
+        if failures:
+            raise failures[0][1]
+
+    def _evacuation_map(self, func, items):
+        """Call func with each item and return the results in order
+
+        Calls are made concurrently when evacuation_concurrency allows.
+        """
+        if self.evacuation_concurrency > 1 and len(items) > 1:
+            pool = tevent.Pool(min(self.evacuation_concurrency, len(items)))
+            try:
+                async_results = [pool.apply_async(func, (item,)) for item in items]
+            finally:
+                # no more work is given to the pool, so its worker threads
+                # exit once all of the calls are done
+                pool.close()
+                pool.join()
+            return [async_result.get() for async_result in async_results]
+        return [func(item) for item in items]
 
     def _clear_resource_assignments(self, resource):
         """Clear resource assignments as long as state doesn't return to OK
@@ -535,8 +758,13 @@ class ProcessDispatcherCore(object):
         return resource, updated
 
     def _evacuate_process(self, process, resource, is_system_restart=False,
-            dead_process_state=None, rescheduled_process_state=None):
+            dead_process_state=None, rescheduled_process_state=None,
+            enqueue=True):
         """Deal with a process on a terminating/terminated node
+
+        Returns the process record if it was rescheduled, or None. When
+        enqueue is False, queueing the rescheduled process is left to the
+        caller.
         """
         if not dead_process_state:
             dead_process_state = ProcessState.FAILED
@@ -552,12 +780,16 @@ class ProcessDispatcherCore(object):
                 log.debug("Rescheduling process %s from evacuated resource %s on node %s",
                     process.upid, resource.resource_id, resource.node_id)
                 if rescheduled_process_state:
-                    self.process_next_round(process,
-                        newstate=rescheduled_process_state)
+                    process, updated = self.process_next_round(process,
+                        newstate=rescheduled_process_state, enqueue=enqueue)
                 else:
-                    self.process_next_round(process)
+                    process, updated = self.process_next_round(process,
+                        enqueue=enqueue)
+                if updated:
+                    return process
             else:
                 self.process_change_state(process, dead_process_state, assigned=None)
+        return None
 
     def ee_heartbeat(self, sender, beat):
         """Incoming heartbeat from an EEAgent
@@ -589,30 +821,49 @@ class ProcessDispatcherCore(object):
             self._first_heartbeat(sender, beat)
             return  # *** EARLY RETURN **
 
-        resource_updated = False
-
         timestamp_str = beat['timestamp']
         timestamp = ceiling_datetime(parse_datetime(timestamp_str))
 
-        resource_timestamp = resource.last_heartbeat_datetime
+        # heartbeat timestamps are kept apart from the resource record, so
+        # recording one doesn't churn the record
+        resource_timestamp = self.get_resource_last_heartbeat(resource)
         if resource_timestamp is None or timestamp > resource_timestamp:
-            resource.new_last_heartbeat_datetime(timestamp)
-            resource_updated = True
+            self.store.set_resource_heartbeat(sender, timestamp.isoformat())
 
-        assigned_procs = set()
-        processes = beat['processes']
-        node_exclusives_to_remove = []
-        for procstate in processes:
-            upid = procstate['upid']
-            round = int(procstate['round'])
+        processes = []
+        for procstate in beat['processes']:
             state = procstate['state']
 
             # TODO hack to handle how states are formatted in EEAgent heartbeat
             if isinstance(state, (list, tuple)):
                 state = "-".join(str(s) for s in state)
+            processes.append((procstate['upid'], int(procstate['round']), state))
+
+        # fast path: nothing has changed since the last heartbeat, other
+        # than the timestamp
+        signature = frozenset(processes)
+        if self._heartbeat_unchanged(sender, resource, signature):
+            return
+
+        resource_updated = False
+
+        # heartbeat is consistent with the records if every process is known
+        # and in its recorded state and round, and every assignment is
+        # reported. In that case the next identical heartbeat can skip all
+        # of this.
+        consistent = True
+
+        # TODO owner?
+        found_processes = self.store.get_processes(
+            [(None, upid) for upid, _, _ in processes])
+
+        assigned_procs = set()
+        node_exclusives_to_remove = []
+        for (upid, round, state), process in zip(processes, found_processes):
+            if not (process and round == process.round and state == process.state and
+                    state < ProcessState.TERMINATED):
+                consistent = False
 
-            # TODO owner?
-            process = self.store.get_process(None, upid)
             if not process:
                 log.warn("EE reports process %s that is unknown!", upid)
 
@@ -683,10 +934,21 @@ class ProcessDispatcherCore(object):
                 # with the dead process
                 self.eeagent_client.cleanup_process(sender, upid, round)
 
+        reported = set((upid, round) for upid, round, _ in processes)
+        assigned_keys = list(resource.assigned_keys())
+        for _, upid, round in assigned_keys:
+            if (upid, round) not in reported:
+                consistent = False
+
+        # processes may have changed above, so they are read again here
+        unreported_keys = [key for key in assigned_keys if key not in assigned_procs]
+        unreported_processes = dict(zip(unreported_keys, self.store.get_processes(
+            [(owner, upid) for owner, upid, _ in unreported_keys])))
+
         new_assigned = []
-        for owner, upid, round in resource.assigned:
-            key = (owner, upid, round)
-            process = self.store.get_process(owner, upid)
+        for key in assigned_keys:
+            owner, upid, round = key
+            process = unreported_processes.get(key)
 
             if key in assigned_procs:
                 new_assigned.append(key)
@@ -716,13 +978,96 @@ class ProcessDispatcherCore(object):
 
             resource.assigned = new_assigned
             resource_updated = True
+            consistent = False
 
+        self.heartbeat_signatures.pop(sender, None)
         if resource_updated:
             try:
                 self.store.update_resource(resource)
             except (WriteConflictError, NotFoundError):
                 # TODO? right now this will just wait for the next heartbeat
-                pass
+                return
+
+        if consistent and self._watch_heartbeat_processes(sender, found_processes):
+            self.heartbeat_signatures[sender] = (signature,
+                resource.metadata.get('version'), time.time())
+
+    def _watch_heartbeat_processes(self, sender, processes):
+        """Watch reported processes so that changes to them end the fast path
+
+        Processes can change without the resource record changing, for
+        example when they are restarted. Returns False if any of them has
+        already changed since it was read.
+        """
+        with self.heartbeat_lock:
+            unwatched = []
+            for process in processes:
+                process_id = (None, process.upid)
+                if process_id not in self.heartbeat_watched_processes:
+                    unwatched.append(process)
+                self.heartbeat_watched_processes[process_id] = sender
+
+        if not unwatched:
+            return True
+
+        current = self.store.get_processes(
+            [(None, process.upid) for process in unwatched],
+            watcher=self._notify_heartbeat_process_changed)
+        unchanged = True
+        for process, current_process in zip(unwatched, current):
+            if current_process is None:
+                # no watch is set on a missing record
+                with self.heartbeat_lock:
+                    self.heartbeat_watched_processes.pop((None, process.upid), None)
+                unchanged = False
+            elif (current_process.metadata.get('version') !=
+                    process.metadata.get('version')):
+                unchanged = False
+        return unchanged
+
+    def _notify_heartbeat_process_changed(self, owner, upid):
+        with self.heartbeat_lock:
+            sender = self.heartbeat_watched_processes.pop((owner, upid), None)
+            if sender is not None:
+                self.heartbeat_signatures.pop(sender, None)
+
+    def _forget_heartbeat_signature(self, resource_id):
+        self.heartbeat_signatures.pop(resource_id, None)
+
+    def _heartbeat_unchanged(self, sender, resource, signature):
+        """Check if a heartbeat matches the last consistent one from sender
+
+        The resource record must also be unchanged since then.
+        """
+        entry = self.heartbeat_signatures.get(sender)
+        if entry is None:
+            return False
+        last_signature, version, checked = entry
+        return (last_signature == signature and
+                version == resource.metadata.get('version') and
+                time.time() - checked < self.heartbeat_recheck_seconds)
+
+    def get_resource_last_heartbeat(self, resource, watcher=None):
+        """Return the time of the latest heartbeat from a resource
+
+        If provided, watcher is called with the resource_id when a newer
+        heartbeat is recorded.
+        """
+        timestamp = self.get_resource_last_heartbeat_timestamp(resource,
+            watcher=watcher)
+        if timestamp is None:
+            return None
+        return parse_datetime(timestamp)
+
+    def get_resource_last_heartbeat_timestamp(self, resource, watcher=None):
+        """Return the unparsed timestamp of the latest heartbeat from a resource
+        """
+        timestamp = self.store.get_resource_heartbeat(resource.resource_id,
+            watcher=watcher)
+        if timestamp is None:
+            # only the first heartbeat is on the resource record
+            return resource.last_heartbeat
+        return timestamp
 
     def process_should_restart(self, process, exit_state, is_system_restart=False):
 
@@ -965,27 +1310,42 @@ class ProcessDispatcherCore(object):
             self.notifier.notify_process(process)
         return process, updated
 
+    def get_process_engine_id(self, process):
+        """Returns the ID of the engine a process runs on, or None
+        """
+        engine_id = process.constraints.get('engine')
+        if engine_id is None:
+            engine_id = self.ee_registry.get_process_definition_engine_id(
+                process.definition)
+        if engine_id is None:
+            engine_id = self.ee_registry.default
+        return engine_id
+
     def get_process_constraints(self, process):
         """Returns a dict of process constraints
 
         Includes constraints from the process itself as well as from the engine registry.
 
         Guaranteed to at least include an engine in the constraints.
-        """
-        constraints = {}
-        engine_id = self.ee_registry.get_process_definition_engine_id(process.definition)
-        if process.constraints.get('engine') is not None:
-            engine_id = process.constraints.get('engine')
-
-        if engine_id is None:
-            engine_id = self.ee_registry.default
 
+        Constraints don't change within a process round, so they are worked
+        out once per round, until the engine registry changes. The returned
+        dict is shared and must not be modified.
+        """
+        registry = self.ee_registry
+        cached = self.process_constraints.get(process.key)
+        if cached is not None:
+            generation, default, constraints = cached
+            if generation == registry.generation and default == registry.default:
+                return constraints
+
+        constraints = dict(process.constraints)
+        engine_id = self.get_process_engine_id(process)
         if engine_id is not None:
             constraints['engine'] = engine_id
 
-        if process.constraints:
-            process.constraints.update(constraints)
-            constraints = process.constraints
+        self.process_constraints.set(process.key,
+            (registry.generation, registry.default, constraints))
         return constraints
 
     def dump(self):
@@ -999,6 +1359,9 @@ class ProcessDispatcherCore(object):
             if not resource:
                 continue
             resources[resource_id] = dict(resource)
+            last_heartbeat = self.store.get_resource_heartbeat(resource_id)
+            if last_heartbeat is not None:
+                resources[resource_id]['last_heartbeat'] = last_heartbeat
 
         for owner, upid in self.store.get_process_ids():
             process = self.store.get_process(owner, upid)
@@ -1015,20 +1378,35 @@ class ProcessDispatcherCore(object):
         return state
 
     def add_engine(self, definition):
+        """Add an execution engine
+
+        The engine is kept in the store, so that the registries of all
+        workers pick it up.
+        """
+        definition = dict(definition)
         try:
             engine_id = definition['engine_id']
             del(definition['engine_id'])
         except KeyError:
             raise BadRequestError("Definition must have an 'engine_id'")
 
-        try:
-            slots = definition['slots']
-            del(definition['slots'])
-        except KeyError:
+        if 'slots' not in definition:
             raise BadRequestError("Definition must have 'slots'")
 
-        engine = EngineSpec(engine_id, slots, **definition)
-        self.ee_registry.add(engine)
+        engine = EngineSpec(engine_id, **definition)
+
+        if engine_id in self.ee_registry:
+            raise BadRequestError("engine %s already exists" % engine_id)
+        try:
+            self.store.add_engine(engine_id, definition)
+        except WriteConflictError:
+            raise BadRequestError("engine %s already exists" % engine_id)
+
+        try:
+            self.ee_registry.add(engine)
+        except KeyError:
+            # already picked up from the store
+            pass
 
 
 def _check_process_schedule_idempotency(process, parameters):
@@ -1043,3 +1421,20 @@ def _check_process_schedule_idempotency(process, parameters):
             raise BadRequestError(
                 "process %s is %s but %s parameter value doesn't match request"
                 % (process.upid, process.state, key))
+
+
+class _EvacuationProgress(object):
+    """Counts evacuated processes and logs progress every so often
+    """
+    def __init__(self, total, interval):
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def increment(self):
+        with self.lock:
+            self.count += 1
+            count = self.count
+        if self.interval and count % self.interval == 0 and count < self.total:
+            log.info("Evacuated %d of %d processes", count, self.total)
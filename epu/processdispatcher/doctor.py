@@ -1,14 +1,16 @@
 # Copyright 2013 University of Chicago
 
+import calendar
 import logging
 import threading
 import heapq
 from collections import namedtuple
-from datetime import timedelta
 
-from epu.util import now_datetime, ensure_timedelta
+from epu.util import now_datetime, ensure_timedelta, parse_datetime
 from epu.states import ProcessState, ProcessDispatcherState, ExecutionResourceState
 from epu import tevent
+from epu.processdispatcher.util import iter_processes, get_processes_by_state
+from epu.processdispatcher.resourcecache import ResourceCache
 
 log = logging.getLogger(__name__)
 
@@ -31,14 +33,16 @@ class PDDoctor(object):
 
     CONFIG_MONITOR_HEARTBEATS = "monitor_resource_heartbeats"
 
-    def __init__(self, core, store, config=None):
+    def __init__(self, core, store, config=None, resource_cache=None):
         """
         @type core: ProcessDispatcherCore
         @type store: ProcessDispatcherStore
+        @type resource_cache: ResourceCache
         """
         self.core = core
         self.store = store
         self.config = config or {}
+        self.resource_cache = resource_cache
 
         self.monitor = None
         self.monitor_thread = None
@@ -84,7 +88,8 @@ class PDDoctor(object):
 
         with self.condition:
             if self.is_leader and self.config.get(self.CONFIG_MONITOR_HEARTBEATS, True):
-                self.monitor = ExecutionResourceMonitor(self.core, self.store)
+                self.monitor = ExecutionResourceMonitor(self.core, self.store,
+                    resource_cache=self.resource_cache)
                 self.monitor_thread = tevent.spawn(self.monitor.monitor)
 
         while self.is_leader:
@@ -94,6 +99,8 @@ class PDDoctor(object):
         log.debug("Waiting on monitor thread to exit")
         if self.monitor_thread is not None:
             self.monitor_thread.join()
+        if self.monitor is not None:
+            self.monitor.resource_subscription.cancel()
         self.monitor = None
         self.monitor_thread = None
 
@@ -124,26 +131,34 @@ class PDDoctor(object):
         # we requeue all of these UNSCHEDULED_PENDING processes
         if system_boot:
             # clear out all nodes
+            nodes = []
             for node_id in self.store.get_node_ids():
                 node = self.store.get_node(node_id)
-                if node is None:
-                    continue
-
-                # evacuate the node. Move restartable processes to
-                # UNSCHEDULED_PENDING. They will be restarted after system
-                # boot completes. Move dead processes to TERMINATED.
-                self.core.evacuate_node(node, is_system_restart=True,
-                    dead_process_state=ProcessState.TERMINATED,
-                    rescheduled_process_state=ProcessState.UNSCHEDULED_PENDING)
-
-            # look for any other processes that should be queued after boot
-            for owner, upid in self.store.get_process_ids():
-                process = self.store.get_process(owner, upid)
-                if process is None:
-                    continue
+                if node is not None:
+                    nodes.append(node)
+
+            # evacuate the nodes. Move restartable processes to
+            # UNSCHEDULED_PENDING. They will be restarted after system
+            # boot completes. Move dead processes to TERMINATED.
+            self.core.evacuate_nodes(nodes, is_system_restart=True,
+                dead_process_state=ProcessState.TERMINATED,
+                rescheduled_process_state=ProcessState.UNSCHEDULED_PENDING)
+
+            # look for any other processes that should be queued after boot.
+            # every record is read here anyway, so this is also where any
+            # UNSCHEDULED_PENDING processes missing from the state index
+            # are added to it.
+            pending_ids = set(self.store.get_process_ids_by_state(
+                ProcessState.UNSCHEDULED_PENDING))
+            for process in iter_processes(self.store, self.store.get_process_ids()):
+
+                if process.state == ProcessState.UNSCHEDULED_PENDING:
+                    if (process.owner, process.upid) not in pending_ids:
+                        self.store.index_process_state(process.owner,
+                            process.upid, ProcessState.UNSCHEDULED_PENDING)
 
                 # these processes were stuck in a transitional state at shutdown
-                if process.state in self._PROCESS_STATES_TO_REQUEUE:
+                elif process.state in self._PROCESS_STATES_TO_REQUEUE:
 
                     if self.core.process_should_restart(process,
                             ProcessState.TERMINATED, is_system_restart=True):
@@ -172,18 +187,16 @@ class PDDoctor(object):
 
     def schedule_pending_processes(self):
         log.debug("Checking for UNSCHEDULED_PENDING processes to reschedule")
-        process_ids = self.store.get_process_ids()
-
-        for owner, upid in process_ids:
-            process = self.store.get_process(owner, upid)
-            if process is None or process.state != ProcessState.UNSCHEDULED_PENDING:
-                continue
 
+        for process in get_processes_by_state(self.store,
+                ProcessState.UNSCHEDULED_PENDING):
             process, updated = self.core.process_change_state(process,
                 ProcessState.REQUESTED)
             if updated:
                 self.store.enqueue_process(process.owner, process.upid,
                     process.round)
+                self.store.unindex_process_state(process,
+                    ProcessState.UNSCHEDULED_PENDING)
 
 
 class ExecutionResourceMonitor(object):
@@ -230,15 +243,22 @@ class ExecutionResourceMonitor(object):
 
     _now_func = staticmethod(now_datetime)
 
-    def __init__(self, core, store):
+    def __init__(self, core, store, resource_cache=None):
         self.core = core
         self.store = store
 
         self.condition = threading.Condition()
         self.cancelled = False
 
+        # resource records may be shared with other leaders in this worker
+        self.resource_cache = resource_cache or ResourceCache(store)
+        self.resource_subscription = self.resource_cache.subscribe(
+            self._notify_resources_changed)
+
         self.resources = {}
-        self.resource_set_changed = True
+        self.resources_changed = True
+
+        # resources with a new heartbeat since they were last checked
         self.changed_resources = set()
 
         self.resource_checks = _ResourceChecks()
@@ -246,6 +266,17 @@ class ExecutionResourceMonitor(object):
         # local times at which resources were moved to the WARNING state.
         self.resource_warnings = {}
 
+        # resource_id -> (heartbeat timestamp, epoch seconds), so that each
+        # timestamp is parsed once
+        self.heartbeat_times = {}
+
+        # engine_id -> (engine spec, warning seconds, missing seconds)
+        self.engine_thresholds = {}
+
+        # MISSING resources found in the current cycle, to be evacuated
+        # together at the end of it
+        self.missing_resources = []
+
     def cancel(self):
         with self.condition:
             self.cancelled = True
@@ -255,7 +286,8 @@ class ExecutionResourceMonitor(object):
         """Monitor execution resources until cancelled
         """
 
-        self.resource_set_changed = True
+        self.resource_subscription.reset()
+        self.resources_changed = True
 
         while not self.cancelled:
             try:
@@ -270,7 +302,7 @@ class ExecutionResourceMonitor(object):
             if delay is None or delay > 0:
                 with self.condition:
                     if not any((self.cancelled, self.changed_resources,
-                               self.resource_set_changed)):
+                               self.resources_changed)):
                         self.condition.wait(delay)
 
     def monitor_cycle(self):
@@ -279,7 +311,7 @@ class ExecutionResourceMonitor(object):
         returns the number of seconds until the next needed check, or None if no checks are needed
         """
         changed = self._update()
-        now = self._now_func()
+        now = _epoch_seconds(self._now_func())
 
         for resource_id in changed:
             resource = self.resources.get(resource_id)
@@ -287,19 +319,18 @@ class ExecutionResourceMonitor(object):
             # skip resource and remove any checks if it is removed or disabled
             if resource is None or resource.state == ExecutionResourceState.DISABLED:
                 self.resource_checks.discard_resource_check(resource_id)
-                try:
-                    del self.resource_warnings[resource_id]
-                except KeyError:
-                    pass
+                self.resource_warnings.pop(resource_id, None)
+                self.heartbeat_times.pop(resource_id, None)
                 continue
 
             # otherwise, queue up the resource to be looked at in this cycle
             self.resource_checks.set_resource_check(resource_id, now)
 
-        # walk the resource checks, up to the current time. This data structure
-        # ensures that we only check resources that have either been updated, or
-        # are due to timeout
-        for resource_id in self.resource_checks.walk_through_time(now):
+        # take the batch of resource checks due by the current time. This
+        # data structure ensures that we only check resources that have
+        # either been updated, or are due to timeout
+        self.missing_resources = []
+        for resource_id in self.resource_checks.pop_due_checks(now):
 
             if self.cancelled:  # back out early if cancelled
                 return
@@ -308,24 +339,36 @@ class ExecutionResourceMonitor(object):
                 resource = self.resources[resource_id]
                 self._check_one_resource(resource, now)
             except Exception:
-                log.exception("Problem checking execution resource %s. Will retry.")
+                log.exception("Problem checking execution resource %s. Will retry.",
+                    resource_id)
                 if resource_id not in self.resource_checks:
-                    next_check_time = now + timedelta(seconds=self._MONITOR_ERROR_DELAY_SECONDS)
+                    next_check_time = now + self._MONITOR_ERROR_DELAY_SECONDS
                     self.resource_checks.set_resource_check(resource_id, next_check_time)
 
+        if self.missing_resources:
+            self._evacuate_missing_resources(now)
+
         # return the number of seconds until the next expected check, or None
         next_check_time = self.resource_checks.next_check_time
         if next_check_time is not None:
-            return max((next_check_time - self._now_func()).total_seconds(), 0)
+            return max(next_check_time - _epoch_seconds(self._now_func()), 0)
         return None
 
     def _check_one_resource(self, resource, now):
 
-        last_heartbeat = resource.last_heartbeat_datetime
         warning_threshold, missing_threshold = self._get_resource_thresholds(resource)
         if warning_threshold is None or missing_threshold is None:
             return
 
+        # heartbeats are recorded apart from the resource record. OK
+        # resources are only checked when their heartbeat could be late,
+        # but others are checked again as soon as a new heartbeat arrives.
+        if resource.state == ExecutionResourceState.OK:
+            watcher = None
+        else:
+            watcher = self._notify_resource_changed
+        last_heartbeat = self._get_last_heartbeat(resource, watcher=watcher)
+
         log.debug("Examining heartbeat for resource %s (in state %s)",
             resource.resource_id, resource.state)
 
@@ -380,7 +423,7 @@ class ExecutionResourceMonitor(object):
                 # likely we would only get in this situation if previously
                 # marked the resource MISSING but failed before we evacuated
                 # everything
-                self.core.evacuate_resource(resource)
+                self.missing_resources.append(resource)
 
         if next_check_time is not None:
             self.resource_checks.set_resource_check(resource_id, next_check_time)
@@ -390,7 +433,7 @@ class ExecutionResourceMonitor(object):
             ExecutionResourceState.WARNING)
         if updated:
             resource_id = resource.resource_id
-            heartbeat_age = (now - last_heartbeat).total_seconds()
+            heartbeat_age = now - last_heartbeat
             self.resource_warnings[resource_id] = _ResourceWarning(
                 resource_id, last_heartbeat, now)
             log.warn("Execution resource %s is in WARNING state: Last known "
@@ -409,39 +452,84 @@ class ExecutionResourceMonitor(object):
             except KeyError:
                 pass
 
-            heartbeat_age = (now - last_heartbeat).total_seconds()
+            heartbeat_age = now - last_heartbeat
             log.warn("Execution resource %s is MISSING: Last known "
                 "heartbeat was sent %s seconds ago. ", resource.resource_id, heartbeat_age)
 
-            self.core.evacuate_resource(resource)
+            self.missing_resources.append(resource)
+
+    def _evacuate_missing_resources(self, now):
+        """Evacuate all resources found MISSING in this cycle together
+
+        When many resources go missing at once, such as when a network
+        partition cuts off a group of nodes, their processes are evacuated
+        concurrently and requeued in a single batch.
+        """
+        resources = self.missing_resources
+        self.missing_resources = []
+
+        if len(resources) > 1:
+            log.warn("Evacuating %d MISSING execution resources", len(resources))
+        try:
+            self.core.evacuate_resources(resources)
+        except Exception:
+            log.exception("Problem evacuating MISSING execution resources. Will retry.")
+            next_check_time = now + self._MONITOR_ERROR_DELAY_SECONDS
+            for resource in resources:
+                if resource.resource_id not in self.resource_checks:
+                    self.resource_checks.set_resource_check(resource.resource_id,
+                        next_check_time)
 
     def _mark_resource_ok(self, resource, now, last_heartbeat):
         resource, updated = self.core.resource_change_state(resource,
             ExecutionResourceState.OK)
         if updated:
-            heartbeat_age = (now - last_heartbeat).total_seconds()
+            heartbeat_age = now - last_heartbeat
             log.info("Execution resource %s is OK again: Last known "
                 "heartbeat was sent %s seconds ago. ", resource.resource_id, heartbeat_age)
 
+    def _get_last_heartbeat(self, resource, watcher=None):
+        """Return the time of the latest heartbeat from a resource, in epoch seconds
+
+        Timestamps are only parsed when they change.
+        """
+        resource_id = resource.resource_id
+        timestamp = self.core.get_resource_last_heartbeat_timestamp(resource,
+            watcher=watcher)
+
+        cached = self.heartbeat_times.get(resource_id)
+        if cached is not None and cached[0] == timestamp:
+            return cached[1]
+
+        last_heartbeat = _epoch_seconds(parse_datetime(timestamp))
+        self.heartbeat_times[resource_id] = (timestamp, last_heartbeat)
+        return last_heartbeat
+
     def _get_resource_thresholds(self, resource):
+        """Return the (warning, missing) heartbeat thresholds of a resource, in seconds
+
+        Thresholds are worked out once per engine.
+        """
         engine = self.core.get_resource_engine(resource)
+
+        cached = self.engine_thresholds.get(engine.engine_id)
+        if cached is not None and cached[0] is engine:
+            return cached[1], cached[2]
+
         warning = engine.heartbeat_warning
         if warning is not None:
-            warning = ensure_timedelta(warning)
+            warning = ensure_timedelta(warning).total_seconds()
 
         missing = engine.heartbeat_missing
         if missing is not None:
-            missing = ensure_timedelta(missing)
+            missing = ensure_timedelta(missing).total_seconds()
 
+        self.engine_thresholds[engine.engine_id] = (engine, warning, missing)
         return warning, missing
 
-    def _get_resource_missing_threshold(self, resource):
-        engine = self.core.get_resource_engine(resource)
-        return ensure_timedelta(engine.heartbeat_missing)
-
-    def _notify_resource_set_changed(self, *args):
+    def _notify_resources_changed(self):
         with self.condition:
-            self.resource_set_changed = True
+            self.resources_changed = True
             self.condition.notify_all()
 
     def _notify_resource_changed(self, resource_id, *args):
@@ -450,51 +538,37 @@ class ExecutionResourceMonitor(object):
             self.condition.notify_all()
 
     def _update(self):
-        changed = set()
-        if self.resource_set_changed:
-            changed.update(self._update_resource_set())
-        if self.changed_resources:
-            changed.update(self._update_resources())
-        return changed
-
-    def _update_resource_set(self):
-        self.resource_set_changed = False
-        resource_ids = set(self.store.get_resource_ids(
-            watcher=self._notify_resource_set_changed))
-
-        previous = set(self.resources.keys())
-
-        added = resource_ids - previous
-        removed = previous - resource_ids
-
-        for resource_id in removed:
-            del self.resources[resource_id]
-
-        for resource_id in added:
-            self.resources[resource_id] = self.store.get_resource(
-                resource_id, watcher=self._notify_resource_changed)
-
-        return added | removed
-
-    def _update_resources(self):
         with self.condition:
-            changed = self.changed_resources.copy()
-            self.changed_resources.clear()
-
-        for resource_id in changed:
-            resource = self.store.get_resource(resource_id,
-                                               watcher=self._notify_resource_changed)
-            if resource:
-                self.resources[resource_id] = resource
-
+            resources_changed = self.resources_changed
+            self.resources_changed = False
+            changed = self.changed_resources
+            self.changed_resources = set()
+
+        if resources_changed:
+            for resource_id in self.resource_subscription.get_changes():
+                resource = self.resource_cache.get_resource(resource_id)
+                if resource:
+                    self.resources[resource_id] = resource
+                else:
+                    self.resources.pop(resource_id, None)
+                changed.add(resource_id)
         return changed
 
 
+# last_heartbeat and warning_time are in epoch seconds
 _ResourceWarning = namedtuple("_ResourceWarning",
     ["resource_id", "last_heartbeat", "warning_time"])
 
 
+def _epoch_seconds(d):
+    """Convert a datetime to seconds since the epoch. Naive datetimes are UTC.
+    """
+    return calendar.timegm(d.utctimetuple()) + d.microsecond / 1000000.0
+
+
 class _ResourceChecks(object):
+    """Times at which resources are due to be checked, in epoch seconds
+    """
 
     def __init__(self):
         self.checks = {}
@@ -517,7 +591,10 @@ class _ResourceChecks(object):
         except KeyError:
             pass
 
-    def walk_through_time(self, now):
+    def pop_due_checks(self, now):
+        """Remove and return the IDs of all resources due to be checked by now
+        """
+        due = []
         while self.check_heap:
 
             # heap guarantees smallest element is at index 0, so we can peek before we pop
@@ -530,10 +607,11 @@ class _ResourceChecks(object):
             elif check_time <= now:
                 heapq.heappop(self.check_heap)
                 del self.checks[resource_id]
-                yield resource_id
+                due.append(resource_id)
 
             else:
                 break
+        return due
 
     @property
     def next_check_time(self):
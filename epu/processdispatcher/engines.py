@@ -1,7 +1,9 @@
 # Copyright 2013 University of Chicago
 
 import logging
+import threading
 
+import epu.tevent as tevent
 from epu.util import ensure_timedelta
 
 log = logging.getLogger(__name__)
@@ -36,6 +38,11 @@ class EngineRegistry(object):
 
     2. More slots are needed for a particular engine type. The engine type
        is used to lookup the corresponding DT and slot information
+
+    Engines come from the configuration, and may also be added while the
+    system runs. Those are kept in the store, and a registry which follows
+    the store picks them up as they appear. Registries in every worker
+    therefore converge on the same set of engines.
     """
 
     @classmethod
@@ -67,27 +74,120 @@ class EngineRegistry(object):
         self.by_engine = {}
         self.process_module_engines = {}
 
+        # depths of the mapped paths, deepest first. Only prefixes of these
+        # depths can match, so they are the only ones looked up.
+        self.process_engine_depths = []
+
+        # incremented whenever engines or process engine mappings change, so
+        # that users can tell when their own cached lookups are stale
+        self.generation = 0
+
+        # callables fired with no arguments when engines may have changed
+        self.listeners = []
+
+        # store of engines added at runtime. See follow_store()
+        self.store = None
+        self.lock = threading.RLock()
+
+        # protects the flag below. never held while calling into the store,
+        # because store watchers can fire under its lock
+        self.change_lock = threading.Lock()
+        self.stored_engines_changed = False
+
     def __len__(self):
         return len(self.by_engine)
 
     def __iter__(self):
-        return self.by_engine.itervalues()
+        return iter(self.by_engine.values())
+
+    def __contains__(self, engine_id):
+        return engine_id in self.by_engine
 
     def add(self, engine):
-        if engine.engine_id in self.by_engine:
-            raise KeyError("engine %s already in registry" % engine.engine_id)
+        with self.lock:
+            if engine.engine_id in self.by_engine:
+                raise KeyError("engine %s already in registry" % engine.engine_id)
 
-        self.by_engine[engine.engine_id] = engine
+            self.by_engine[engine.engine_id] = engine
+            self._changed()
 
     def get_engine_by_id(self, engine):
         return self.by_engine[engine]
 
+    def add_listener(self, listener):
+        """Call listener with no arguments whenever engines may have changed
+        """
+        self.listeners.append(listener)
+
+    def _notify_listeners(self):
+        for listener in list(self.listeners):
+            listener()
+
+    def follow_store(self, store):
+        """Pick up engines added to the store, now and as they appear
+
+        Engines already in the store are read right away. Later ones are
+        read in the background when the store's engines watch fires, so
+        looking up engines never touches the store.
+        """
+        self.store = store
+        with self.change_lock:
+            self.stored_engines_changed = True
+        self.refresh()
+
+    def _notify_stored_engines_changed(self, *args):
+        # store watchers may fire under the store's lock or in its event
+        # thread, so the engines are read elsewhere
+        with self.change_lock:
+            self.stored_engines_changed = True
+        tevent.spawn(self.refresh)
+
+    def refresh(self):
+        """Add any engines which appeared in the store since the last refresh
+        """
+        if self.store is None or not self.stored_engines_changed:
+            return
+
+        with self.lock:
+            with self.change_lock:
+                if not self.stored_engines_changed:
+                    return
+                self.stored_engines_changed = False
+
+            engine_ids = self.store.get_engine_ids(
+                watcher=self._notify_stored_engines_changed)
+            for engine_id in engine_ids:
+                if engine_id in self.by_engine:
+                    continue
+
+                definition = self.store.get_engine(engine_id)
+                if definition is None:
+                    continue
+                try:
+                    engine = EngineSpec(engine_id, **definition)
+                except Exception:
+                    log.exception("Stored engine %s has a bad definition: %s",
+                        engine_id, definition)
+                    continue
+
+                log.info("Adding engine %s from the store", engine_id)
+                self.add(engine)
+
     def set_process_engine_mapping(self, path, engine_id):
         if not path:
             raise ValueError("invalid path")
-        if engine_id not in self.by_engine:
+        if engine_id not in self:
             raise KeyError("engine mapped to %s is unknown" % (path,))
-        self.process_module_engines[path] = engine_id
+        with self.lock:
+            self.process_module_engines[path] = engine_id
+            self.process_engine_depths = sorted(
+                set(mapped.count('.') + 1 for mapped in self.process_module_engines),
+                reverse=True)
+            self._changed()
+
+    def _changed(self):
+        self.generation += 1
+        self._notify_listeners()
 
     def get_process_definition_engine_id(self, definition):
         """returns an engine id associated with a process definition, or None
@@ -105,15 +205,18 @@ class EngineRegistry(object):
         if not (executable and executable.get('module') and executable.get('class')):
             return None
 
-        path = str(executable['module']) + "." + str(executable['class'])
-        while path:
-            if path in self.process_module_engines:
-                return self.process_module_engines[path]
-            dot = path.rfind('.')
-            if dot == -1:
-                path = ""
-            else:
-                path = path[:dot]
+        return self._find_path_engine_id(
+            str(executable['module']) + "." + str(executable['class']))
+
+    def _find_path_engine_id(self, path):
+        parts = path.split('.')
+        mappings = self.process_module_engines
+        for depth in self.process_engine_depths:
+            if depth > len(parts):
+                continue
+            engine_id = mappings.get('.'.join(parts[:depth]))
+            if engine_id is not None:
+                return engine_id
 
         return None
 
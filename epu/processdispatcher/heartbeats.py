@@ -0,0 +1,136 @@
+# Copyright 2013 University of Chicago
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import epu.tevent as tevent
+
+log = logging.getLogger(__name__)
+
+
+class HeartbeatIngester(object):
+    """Processes EEAgent heartbeats on a pool of worker threads
+
+    Heartbeats are handed off by the messaging thread and processed in the
+    background, so a burst of heartbeats can't hold up other requests.
+
+    Senders are sharded across the workers, so heartbeats from a single
+    sender are always processed one at a time and in order. Each heartbeat
+    describes the full state of its sender, so only the latest pending
+    heartbeat from a sender is kept. When the queue is full, heartbeats from
+    senders without one already pending are dropped: a newer one is never
+    far behind.
+    """
+
+    def __init__(self, handler, worker_count=4, max_pending=10000):
+        """
+        @param handler: called with (sender, beat) for each heartbeat
+        @param worker_count: number of worker threads
+        @param max_pending: maximum number of queued heartbeats
+        """
+        if worker_count < 1:
+            raise ValueError("worker_count must be at least 1")
+        self.handler = handler
+        self.shards = [_HeartbeatShard(max(1, max_pending // worker_count))
+                       for _ in range(worker_count)]
+        self.threads = []
+
+    def start(self):
+        for shard in self.shards:
+            shard.stopped = False
+            self.threads.append(tevent.spawn(self._work, shard))
+
+    def stop(self):
+        for shard in self.shards:
+            with shard.condition:
+                shard.stopped = True
+                shard.condition.notify_all()
+        tevent.joinall(self.threads)
+        self.threads = []
+
+    def submit(self, sender, beat):
+        """Queue a heartbeat for processing
+
+        Returns False if the heartbeat was dropped because the queue is full
+        """
+        shard = self.shards[hash(sender) % len(self.shards)]
+        now = time.time()
+        with shard.condition:
+            shard.received += 1
+            pending = shard.pending.get(sender)
+            if pending is not None:
+                # keep the queue position and receipt time of the older beat
+                shard.pending[sender] = (beat, pending[1])
+                shard.coalesced += 1
+                return True
+
+            if len(shard.pending) >= shard.max_pending:
+                shard.dropped += 1
+                log.warning("Heartbeat queue is full. Dropping heartbeat from %s", sender)
+                return False
+
+            shard.pending[sender] = (beat, now)
+            shard.condition.notify()
+        return True
+
+    def get_stats(self):
+        """Return counts and lag of heartbeat processing
+
+        queue_depth is the number of heartbeats waiting, and max_lag the
+        seconds the oldest of them has waited. last_lag is the seconds the
+        most recently processed heartbeat waited before processing began.
+        """
+        now = time.time()
+        stats = dict(queue_depth=0, max_lag=0.0, last_lag=0.0, received=0,
+                     processed=0, coalesced=0, dropped=0)
+        last_processed = 0
+        for shard in self.shards:
+            with shard.condition:
+                stats['queue_depth'] += len(shard.pending)
+                if shard.pending:
+                    _, received = next(shard.pending.itervalues())
+                    stats['max_lag'] = max(stats['max_lag'], now - received)
+                for key in ('received', 'processed', 'coalesced', 'dropped'):
+                    stats[key] += getattr(shard, key)
+                if shard.last_processed > last_processed:
+                    last_processed = shard.last_processed
+                    stats['last_lag'] = shard.last_lag
+        return stats
+
+    def _work(self, shard):
+        while True:
+            with shard.condition:
+                while not (shard.pending or shard.stopped):
+                    shard.condition.wait()
+                if shard.stopped:
+                    return
+                sender, (beat, received) = shard.pending.popitem(last=False)
+                shard.last_processed = time.time()
+                shard.last_lag = shard.last_processed - received
+
+            try:
+                self.handler(sender, beat)
+            except Exception:
+                log.exception("Error processing heartbeat from %s", sender)
+
+            with shard.condition:
+                shard.processed += 1
+
+
+class _HeartbeatShard(object):
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        # sender -> (latest beat, time the oldest unprocessed beat arrived)
+        self.pending = OrderedDict()
+
+        self.received = 0
+        self.processed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.last_processed = 0
+        self.last_lag = 0.0
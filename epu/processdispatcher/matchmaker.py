@@ -1,19 +1,24 @@
 # Copyright 2013 University of Chicago
 
+import bisect
+import heapq
 import logging
 import threading
 import time
 from math import ceil
 from copy import deepcopy
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from operator import attrgetter
 
+import epu.tevent as tevent
 from epu.exceptions import WriteConflictError, NotFoundError
 from epu.states import ProcessState, ProcessDispatcherState, ExecutionResourceState
 from epu.processdispatcher.modes import QueueingMode
 from epu.processdispatcher.engines import domain_id_from_engine
+from epu.processdispatcher.scheduling import SchedulingPolicy
+from epu.processdispatcher.resourcecache import ResourceCache
 from epu.processdispatcher.util import get_process_state_message, \
-    get_set_difference
+    get_processes_by_state
 
 log = logging.getLogger(__name__)
 
@@ -39,13 +44,17 @@ class PDMatchmaker(object):
     def __init__(self, core, store, resource_client, ee_registry, epum_client,
                  notifier, service_name, domain_definition_id,
                  base_domain_config, run_type, restart_throttling_config,
-                 dispatch_retry_seconds=0):
+                 dispatch_retry_seconds=0, matchmaking_concurrency=1,
+                 scheduling_policy=None, dispatch_concurrency=1,
+                 resource_cache=None):
         """
         @type core: ProcessDispatcherCore
         @type store: ProcessDispatcherStore
         @type resource_client: EEAgentClient
         @type ee_registry: EngineRegistry
         @type notifier: SubscriberNotifier
+        @type scheduling_policy: SchedulingPolicy
+        @type resource_cache: ResourceCache
         """
         self.core = core
         self.store = store
@@ -60,23 +69,55 @@ class PDMatchmaker(object):
         self._cached_pd_state = None
         self.restart_throttling_config = restart_throttling_config
 
+        # number of engine partitions to matchmake at once
+        self.matchmaking_concurrency = matchmaking_concurrency or 1
+
+        # orders each engine's queued processes for matchmaking
+        self.scheduling_policy = scheduling_policy or SchedulingPolicy()
+
         self.process_launcher = ProcessLauncher(store, resource_client, run_type,
-                                                retry_seconds=dispatch_retry_seconds)
+                                                retry_seconds=dispatch_retry_seconds,
+                                                concurrency=dispatch_concurrency)
+
+        # resource records may be shared with other leaders in this worker
+        self.resource_cache = resource_cache or ResourceCache(store)
+        self.resource_subscription = self.resource_cache.subscribe(
+            self._notify_resources_changed)
 
         self.resources = None
+        self.slot_index = None
+        self.constraint_index = None
+        self.assigned_resources = None
+        self.resource_assignments = None
+        self.node_cache = None
         self.queued_processes = None
         self.stale_processes = None
+        self.process_cache = None
+        self.process_cache_invalidations = 0
+        self.watched_processes = None
         self.throttled_processes = None
+        self.throttle_heap = None
         self.unscheduled_pending_processes = []
 
         self.condition = threading.Condition()
 
+        # guards the resource indexes and queue view when engine partitions
+        # are matchmade concurrently
+        self.index_lock = threading.RLock()
+
         self.is_leader = False
 
+        self.resources_changed = False
         self.needs_matchmaking = False
 
         self.registered_needs = None
 
+        # IDs of engines whose EPUM domains are known to exist. Domains are
+        # only looked for when engines change.
+        self.domain_engine_ids = set()
+        self.engines_changed = False
+        self.ee_registry.add_listener(self._notify_engines_changed)
+
     def start_election(self):
         """Initiates participation in the leader election"""
         self.store.contend_matchmaker(self)
@@ -102,12 +143,43 @@ class PDMatchmaker(object):
     def initialize(self):
 
         self.resources = {}
-        self.queued_processes = []
-        self.stale_processes = []
-        self.throttled_processes = []
-
-        self.resource_set_changed = True
-        self.changed_resources = set()
+        self.slot_index = SlotIndex()
+        self.constraint_index = ConstraintIndex()
+        self.engine_tally = EngineTally()
+
+        # (owner, upid, round) -> resource_id, for every known assignment
+        self.assigned_resources = {}
+        # resource_id -> set of (owner, upid, round) assigned to it
+        self.resource_assignments = {}
+
+        self.node_cache = {}
+        # queued process keys, in queue order. values are unused.
+        self.queued_processes = OrderedDict()
+        self.stale_processes = set()
+
+        # queued process keys not yet counted in the engine tally. Their
+        # engine is only known once the process record has been read.
+        self.untallied_processes = set()
+
+        # (owner, upid) -> process record, for queued processes. Each entry
+        # has a store watch outstanding and is dropped when the record
+        # changes, so an unchanged queue can be walked without any reads.
+        self.process_cache = {}
+
+        # (owner, upid) of process records with a store watch outstanding.
+        # Store watches are one-shot, so a key is dropped when its watch
+        # fires, not when its cache entry is.
+        self.watched_processes = set()
+
+        # (owner, upid, round) -> throttle end time, for queued processes
+        # held back by restart throttling. The heap holds (end time, key)
+        # pairs so expired processes can be released without a scan. Heap
+        # entries of processes no longer throttled are skipped when popped.
+        self.throttled_processes = {}
+        self.throttle_heap = []
+
+        self.resource_subscription.reset()
+        self.resources_changed = True
         self.process_set_changed = True
 
         self.needs_matchmaking = True
@@ -115,13 +187,18 @@ class PDMatchmaker(object):
         self.registered_needs = {}
         self._get_pending_processes()
 
+        self.domain_engine_ids = set()
         self._create_missing_domains()
 
     def _create_missing_domains(self):
+        with self.condition:
+            self.engines_changed = False
 
         # create the domains if they don't already exist
         if self.epum_client:
             for engine in list(self.ee_registry):
+                if engine.engine_id in self.domain_engine_ids:
+                    continue
 
                 if not self.domain_definition_id:
                     raise Exception("domain definition must be provided")
@@ -138,37 +215,7 @@ class PDMatchmaker(object):
                         self.domain_definition_id, config,
                         subscriber_name=self.service_name,
                         subscriber_op='node_state')
-
-    def queued_processes_by_engine(self, engine_id):
-        procs = []
-        for p in self.queued_processes:
-            proc = self.store.get_process(p[0], p[1])
-            if not proc:
-                continue
-
-            # get_process_constraints is guaranteed to have an engine set
-            constraints = self.core.get_process_constraints(proc)
-            if constraints['engine'] == engine_id:
-                procs.append(proc)
-        return procs
-
-    def pending_processes_by_engine(self, engine_id):
-        procs = []
-        for proc in self.unscheduled_pending_processes:
-            if not proc:
-                continue
-
-            # get_process_constraints is guaranteed to have an engine set
-            constraints = self.core.get_process_constraints(proc)
-            if constraints['engine'] == engine_id:
-                procs.append(proc)
-        return procs
-
-    def resources_by_engine(self, engine_id):
-        filtered = {rid: r
-                for rid, r in self.resources.iteritems()
-                  if r and r.properties.get('engine') == engine_id}
-        return filtered
+                self.domain_engine_ids.add(engine.engine_id)
 
     def engine(self, engine_id):
         return self.ee_registry.get_engine_by_id(engine_id)
@@ -206,27 +253,68 @@ class PDMatchmaker(object):
         return config
 
     def _find_assigned_resource(self, owner, upid, round):
-        # could speedup with cache
-        for resource in self.resources.itervalues():
-            if resource.is_assigned(owner, upid, round):
-                return resource
-        return None
+        resource_id = self.assigned_resources.get((owner, upid, round))
+        if resource_id is None:
+            return None
+        return self.resources.get(resource_id)
 
-    def _notify_resource_set_changed(self, *args):
+    def _notify_resources_changed(self):
         with self.condition:
-            self.resource_set_changed = True
+            self.resources_changed = True
             self.condition.notifyAll()
 
-    def _notify_process_set_changed(self, *args):
+    def _notify_engines_changed(self):
         with self.condition:
-            self.process_set_changed = True
+            self.engines_changed = True
             self.condition.notifyAll()
 
-    def _notify_resource_changed(self, resource_id, *args):
+    def _notify_process_set_changed(self, *args):
         with self.condition:
-            self.changed_resources.add(resource_id)
+            self.process_set_changed = True
             self.condition.notifyAll()
 
+    def _notify_process_changed(self, owner, upid):
+        self.process_cache_invalidations += 1
+        self.watched_processes.discard((owner, upid))
+        self.process_cache.pop((owner, upid), None)
+
+    def _get_queued_process(self, owner, upid):
+        """Get a queued process record, from the cache where possible
+
+        Callers must not keep modifications to the returned record unless
+        they are written to the store, or must drop it from the cache.
+        """
+        key = (owner, upid)
+        process = self.process_cache.get(key)
+        if process is not None:
+            return process
+
+        # don't cache a record if any watch fired while it was being read.
+        # it could have been this record's, before it was cached.
+        invalidations = self.process_cache_invalidations
+
+        # a record dropped from the cache may still have its watch
+        # outstanding. Don't pile another one on top of it.
+        watcher = None
+        if key not in self.watched_processes:
+            self.watched_processes.add(key)
+            watcher = self._notify_process_changed
+        try:
+            process = self.store.get_process(owner, upid, watcher=watcher)
+        except Exception:
+            if watcher:
+                self.watched_processes.discard(key)
+            raise
+        if process is None:
+            # no watch is left on a record that isn't there
+            if watcher:
+                self.watched_processes.discard(key)
+            return None
+
+        if invalidations == self.process_cache_invalidations:
+            self.process_cache[key] = process
+        return process
+
     def _get_pd_state(self):
         if self._cached_pd_state != ProcessDispatcherState.OK:
             self._cached_pd_state = self.store.get_pd_state()
@@ -242,11 +330,8 @@ class PDMatchmaker(object):
                 # for processes
                 return
 
-            process_ids = self.store.get_process_ids()
-            for process_id in process_ids:
-                process = self.store.get_process(process_id[0], process_id[1])
-                if process.state == ProcessState.UNSCHEDULED_PENDING:
-                    self.unscheduled_pending_processes.append(process)
+            self.unscheduled_pending_processes = get_processes_by_state(
+                self.store, ProcessState.UNSCHEDULED_PENDING)
         elif self.unscheduled_pending_processes:
             self.unscheduled_pending_processes = []
 
@@ -255,9 +340,19 @@ class PDMatchmaker(object):
         processes = self.store.get_queued_processes(
             watcher=self._notify_process_set_changed)
 
-        if processes != self.queued_processes:
-            added, removed = get_set_difference(set(self.queued_processes), set(processes))
+        # apply only the differences to our ordered view of the queue. New
+        # entries are always at the end of the queue. Our view plus the new
+        # entries covers the current queue, so if the sizes match, nothing
+        # was removed.
+        current = set(processes)
+        added = OrderedDict((key, None) for key in processes
+                            if key not in self.queued_processes)
+        if len(self.queued_processes) + len(added) != len(current):
+            removed = [key for key in self.queued_processes if key not in current]
+        else:
+            removed = []
 
+        if added or removed:
             if self.process_launcher.supports_retries and removed:
                 # find processes which were removed from queue and drop them from process launcher
                 for process_key in removed:
@@ -265,49 +360,66 @@ class PDMatchmaker(object):
                         del self.process_launcher[process_key]
 
             log.debug("Queued process list has changed")
-            self.queued_processes = processes
+            for process_key in removed:
+                self._forget_queued_process(*process_key)
+            self._add_queued_processes(added)
 
             if added:
                 # only need to matchmake when processes are added to queue
                 self.needs_matchmaking = True
 
-    def _get_resource_set(self):
-        self.resource_set_changed = False
-        resource_ids = set(self.store.get_resource_ids(
-            watcher=self._notify_resource_set_changed))
-
-        previous = set(self.resources.keys())
-
-        added = resource_ids - previous
-        removed = previous - resource_ids
-
-        # resource removal doesn't need to trigger matchmaking
-        if added:
-            self._dump_stale_processes()
-            self.needs_matchmaking = True
-
-        for resource_id in removed:
-            del self.resources[resource_id]
-
-        for resource_id in added:
-            resource = self.store.get_resource(resource_id,
-                                               watcher=self._notify_resource_changed)
-            self.resources[resource_id] = resource
-
     def _get_resources(self):
         with self.condition:
-            changed = self.changed_resources.copy()
-            self.changed_resources.clear()
+            self.resources_changed = False
 
-        if changed:
+        # resource removal doesn't need to trigger matchmaking
+        updated = False
+        for resource_id in self.resource_subscription.get_changes():
+            resource = self.resource_cache.get_resource(resource_id)
+            if resource:
+                self._set_resource(resource)
+                updated = True
+            else:
+                self._discard_resource(resource_id)
+
+        if updated:
             self._dump_stale_processes()
             self.needs_matchmaking = True
 
-        for resource_id in changed:
-            resource = self.store.get_resource(resource_id,
-                                               watcher=self._notify_resource_changed)
-            if resource:
-                self.resources[resource_id] = resource
+    def _set_resource(self, resource):
+        """Fold a resource record into the matchmaker's view and indexes
+        """
+        with self.index_lock:
+            self.resources[resource.resource_id] = resource
+            self.slot_index.set_resource(resource)
+            self.constraint_index.set_resource(resource)
+            self.engine_tally.set_resource(resource)
+            self._set_resource_assignments(resource.resource_id,
+                set(resource.assigned_keys()))
+
+    def _discard_resource(self, resource_id):
+        """Drop a resource from the matchmaker's view and indexes
+        """
+        with self.index_lock:
+            self.resources.pop(resource_id, None)
+            self.slot_index.discard_resource(resource_id)
+            self.constraint_index.discard_resource(resource_id)
+            self.engine_tally.discard_resource(resource_id)
+            self._set_resource_assignments(resource_id, set())
+
+    def _set_resource_assignments(self, resource_id, keys):
+        """Update the reverse assignment map for a single resource
+        """
+        previous = self.resource_assignments.pop(resource_id, None)
+        if previous:
+            for key in previous - keys:
+                if self.assigned_resources.get(key) == resource_id:
+                    del self.assigned_resources[key]
+
+        for key in keys:
+            self.assigned_resources[key] = resource_id
+        if keys:
+            self.resource_assignments[resource_id] = keys
 
     def cancel(self):
         log.info("Stopping matchmaker")
@@ -320,15 +432,16 @@ class PDMatchmaker(object):
         log.info("Elected as matchmaker!")
 
         while self.is_leader:
+            # make sure any new engines have their domains
+            if self.engines_changed:
+                self._create_missing_domains()
+
             # first fold in any changes to queued processes and available resources
 
             if self.process_set_changed:
                 self._get_queued_processes()
 
-            if self.resource_set_changed:
-                self._get_resource_set()
-
-            if self.changed_resources:
+            if self.resources_changed:
                 self._get_resources()
 
             self._check_throttled_processes()
@@ -352,8 +465,8 @@ class PDMatchmaker(object):
                 next_process_retry = self.process_launcher.retry_process_dispatches()
 
             with self.condition:
-                if self.is_leader and not (self.resource_set_changed or
-                        self.changed_resources or self.process_set_changed):
+                if self.is_leader and not (self.resources_changed or
+                        self.process_set_changed or self.engines_changed):
                     timeout = self._time_until_throttling_ends()
 
                     # don't sleep as long if we anticipate retrying again soon
@@ -367,36 +480,104 @@ class PDMatchmaker(object):
                         self.condition.wait(timeout)
 
     def matchmake(self):
-        self._create_missing_domains()
+        # node records are only cached for the duration of a single pass
+        self.node_cache = {}
 
-        node_containers = self.get_available_resources()
         log.debug("Matchmaking. Processes: %d  Available nodes: %d",
-                  len(self.queued_processes), len(node_containers))
+                  len(self.queued_processes), len(self.slot_index))
 
-        fresh_processes = self._get_fresh_processes()
+        partitions = self._partition_processes(self._get_fresh_processes())
 
-        for owner, upid, round in list(fresh_processes):
-            try:
-                self._matchmake_process(owner, upid, round, node_containers)
+        # processes can only be matched to resources of their own engine,
+        # so each engine partition can be matchmade independently. Processes
+        # without an engine could match anything, so they go last, alone.
+        unpartitioned = partitions.pop(None, None)
 
-            except (WriteConflictError, NotFoundError):
-                # some write conflict errors are allowed to bubble up,
-                # meaning we should bail out of matchmaking loop and
-                # let outer loop update data and retry
-                return
+        if self.matchmaking_concurrency > 1 and len(partitions) > 1:
+            pool = tevent.Pool(min(self.matchmaking_concurrency, len(partitions)))
+            results = [pool.apply_async(self._matchmake_partition, (engine_id, processes))
+                       for engine_id, processes in partitions.iteritems()]
+            pool.join()
+            complete = all([result.get() for result in results])
+        else:
+            complete = True
+            for engine_id, processes in partitions.iteritems():
+                if not self._matchmake_partition(engine_id, processes):
+                    complete = False
+
+        if unpartitioned and not self._matchmake_partition(None, unpartitioned):
+            complete = False
 
         # if we made it through all processes, we don't need to matchmake
         # again until new information arrives
-        self.needs_matchmaking = False
+        if complete:
+            self.needs_matchmaking = False
 
-    def _matchmake_process(self, owner, upid, round, node_containers):
-        log.debug("Matching process %s", upid)
+    def _partition_processes(self, process_keys):
+        """Group queued processes by engine, ordered by the scheduling policy
 
-        process = self.store.get_process(owner, upid)
-        if not (process and process.round == round and
-                process.state < ProcessState.PENDING):
-            self._remove_queued_process(owner, upid, round)
-            return
+        Returns an OrderedDict of engine_id -> list of process records.
+        Processes which no longer need matching are removed from the queue.
+        """
+        partitions = OrderedDict()
+        for owner, upid, round in process_keys:
+            process = self._get_queued_process(owner, upid)
+            if not (process and process.round == round and
+                    process.state < ProcessState.PENDING):
+                self._remove_queued_process(owner, upid, round)
+                continue
+
+            engine_id = self.core.get_process_constraints(process).get('engine')
+            self._tally_queued_process(process.key, engine_id)
+
+            # a process which may run on any of several engines could match
+            # resources of more than one partition, so it goes unpartitioned
+            if isinstance(engine_id, (list, tuple)):
+                engine_id = None
+
+            # a process already holding a slot is committed against that
+            # slot's resource. It goes with the resource's engine so that no
+            # two partitions ever write the same resource.
+            with self.index_lock:
+                assigned_resource = self._find_assigned_resource(owner, upid, round)
+            if assigned_resource:
+                engine_id = assigned_resource.properties.get('engine')
+            partitions.setdefault(engine_id, []).append(process)
+
+        for engine_id, processes in partitions.iteritems():
+            partitions[engine_id] = self.scheduling_policy.order(processes)
+        return partitions
+
+    def _matchmake_partition(self, engine_id, processes):
+        """Matchmake the queued processes of a single engine
+
+        Placements are staged as processes are matched and are committed
+        once the partition has been walked, one transaction per resource.
+        Returns False if matchmaking was cut short by a conflict.
+        """
+        placements = OrderedDict()
+        complete = True
+        for process in processes:
+            try:
+                self._matchmake_process(process, engine_id, placements)
+
+            except (WriteConflictError, NotFoundError):
+                # some write conflict errors are allowed to bubble up,
+                # meaning we should bail out of matchmaking this engine and
+                # let outer loop update data and retry. Other engines are
+                # unaffected.
+                log.debug("Conflict matchmaking engine %s. will retry",
+                    engine_id)
+                complete = False
+                break
+
+        if not self._commit_placements(placements):
+            complete = False
+        return complete
+
+    def _matchmake_process(self, process, engine_id, placements):
+        owner, upid, round = process.key
+        log.debug("Matching process %s", upid)
 
         # don't rematch processes in ASSIGNED state -- we are awaiting
         # acknowledgment from an EE Agent
@@ -409,23 +590,27 @@ class PDMatchmaker(object):
                     self.process_launcher.dispatch_process(process)
             return
 
-        if self._throttle_end_time(process) > time.time():
-            self._throttle_process(process)
+        throttle_end_time = self._throttle_end_time(process)
+        if throttle_end_time > time.time():
+            self._throttle_process(process, throttle_end_time)
             return
 
-        # ensure process is not already assigned a slot
-        matched_resource = self._find_assigned_resource(owner, upid, round)
-        if matched_resource:
-            log.debug("process already assigned to resource %s",
-                matched_resource.resource_id)
+        with self.index_lock:
+            # ensure process is not already assigned a slot
+            matched_resource = self._find_assigned_resource(owner, upid, round)
+            if matched_resource:
+                log.debug("process already assigned to resource %s",
+                    matched_resource.resource_id)
 
-        if not matched_resource and node_containers:
-            matched_resource = self.matchmake_process(process, node_containers)
+            if not matched_resource and self.slot_index:
+                matched_resource = self.matchmake_process(process)
 
         if matched_resource:
-            self._handle_matched_process(process, matched_resource, node_containers)
+            self._handle_matched_process(process, matched_resource,
+                engine_id, placements)
+            return
 
-        elif process.state < ProcessState.WAITING:
+        if process.state < ProcessState.WAITING:
             self._mark_process_waiting(process)
 
             # remove rejected processes from the queue
@@ -434,104 +619,191 @@ class PDMatchmaker(object):
 
         self._mark_process_stale((owner, upid, round))
 
-    def _handle_matched_process(self, process, matched_resource, node_containers):
-        # update the resource record
-        if not matched_resource.is_assigned(process.owner, process.upid, process.round):
-            matched_resource.assigned.append((process.owner, process.upid, process.round))
-        try:
-            self.store.update_resource(matched_resource)
-        except (WriteConflictError, NotFoundError):
-            log.info("Conflict error updating resource. will retry.")
+    def _handle_matched_process(self, process, matched_resource, engine_id,
+                                placements):
+        """Stage the placement of a process on a matched resource
 
-            # in case of write conflict, bail out of the matchmaker
-            # run and the outer loop will take care of updating data
-            # and trying again
-            raise
+        The placement is folded into the matchmaker's view right away so the
+        rest of the pass sees the slot, and any node exclusive tag, as taken.
+        Nothing is written until _commit_placements().
+        """
+        # engine partitions are matched concurrently and each commits its
+        # own placements, so a resource must never be shared between them.
+        # The unpartitioned processes are matched alone.
+        assert engine_id is None or \
+            matched_resource.properties.get('engine') == engine_id, \
+            "resource %s matched outside of its engine partition" % (
+                matched_resource.resource_id,)
+
+        with self.index_lock:
+            # the reverse assignment map saves walking the resource's list
+            resource_id = self.assigned_resources.get(process.key)
+            if resource_id != matched_resource.resource_id:
+                matched_resource.assigned.append(process.key)
+            self._set_resource(matched_resource)
 
-        matched_node = None
         if process.node_exclusive:
-            matched_node = self.store.get_node(matched_resource.node_id)
-            if matched_node is None:
-                log.error("Couldn't find node %s to update node_exclusive",
-                        matched_resource.node_id)
-            else:
-                self.core.node_add_exclusive_tags(matched_node, [process.node_exclusive])
+            node = self._get_cached_node(matched_resource.node_id)
+            tag = str(process.node_exclusive)
+            if node and tag not in node.node_exclusive:
+                node.node_exclusive.append(tag)
+
+        resource_id = matched_resource.resource_id
+        if resource_id not in placements:
+            placements[resource_id] = (matched_resource, [])
+        placements[resource_id][1].append(process)
+
+    def _commit_placements(self, placements):
+        """Commit staged placements, one transaction per resource
+
+        Returns False if the placements on any resource conflicted. The view
+        of such a resource is reloaded and its processes stay queued for the
+        next pass.
+        """
+        complete = True
+        for resource_id, (resource, processes) in placements.iteritems():
+            try:
+                assigned, dropped = self._commit_assignment(resource, processes)
+            except (WriteConflictError, NotFoundError):
+                log.info("Conflict error committing placements on resource "
+                    "%s. will retry.", resource_id)
+                complete = False
+
+                # our copies of the records hold placements that were never
+                # written. Throw them away.
+                for process in processes:
+                    self.process_cache.pop((process.owner, process.upid), None)
+                self.node_cache.pop(resource.node_id, None)
+                resource = self.store.get_resource(resource_id)
+                if resource:
+                    self._set_resource(resource)
+                else:
+                    self._discard_resource(resource_id)
+                continue
 
-        # attempt to also update the process record and mark it as pending.
-        # If the process has since been terminated, this update will fail.
-        # In that case we must back out the resource record update we just
-        # made.
-        process, assigned = self._maybe_update_assigned_process(
-            process, matched_resource)
+            for process in assigned:
+                self.process_launcher.dispatch_process(process)
 
-        if assigned:
-            self.process_launcher.dispatch_process(process)
+                # the queue entry went away with the assignment
+                self._forget_queued_process(*process.key)
 
-        else:
-            # backout resource record update if the process update failed due to
-            # 3rd party changes to the process.
-            log.debug("failed to assign process. it moved to %s out of band",
-                process.state)
-            matched_resource, removed = self._backout_resource_assignment(
-                matched_resource, process)
+            for pkey in dropped:
+                log.debug("failed to assign process %s. it moved out of band",
+                    pkey[1])
+                self._remove_queued_process(*pkey)
 
-            if process.node_exclusive:
-                self.core.node_remove_exclusive_tags(matched_node,
-                    [process.node_exclusive])
-
-        # update modified resource's node container and prune it out
-        # if the node has no more available slots
-        for i, node_container in enumerate(node_containers):
-            if matched_resource.node_id == node_container.node_id:
-                node_container.update()
-                if matched_node:
-                    node_container.update_node(matched_node)
-                if not node_container.available_slots:
-                    node_containers.pop(i)
-                break  # there can only be one match
-
-        self._remove_queued_process(process.owner, process.upid, process.round)
-
-    def _maybe_update_assigned_process(self, process, resource):
-        updated = False
-        while process.state < ProcessState.ASSIGNED:
-            process.assigned = resource.resource_id
-            process.state = ProcessState.ASSIGNED
-            process.increment_dispatches()
+            # fold the committed resource back into the slot index. this
+            # only touches the resource's own node container.
+            self._set_resource(resource)
 
-            # pull hostname directly onto process record, if available.
-            # it is commonly desired information and this saves the need to
-            # make multiple queries to get it.
-            process.hostname = resource.properties.get('hostname')
+        return complete
 
-            try:
-                self.store.update_process(process)
-                updated = True
+    def _commit_assignment(self, resource, processes):
+        """Write a resource record together with the processes placed on it
 
-                log.info(get_process_state_message(process))
+        The resource record, the process records, their queue entries and
+        any node exclusive tags are written in a single transaction.
+        Processes which have moved on out of band are dropped from the
+        resource and the rest are retried. Returns the assigned processes and
+        the keys of the dropped ones. Raises WriteConflictError or
+        NotFoundError if the resource itself conflicted.
+        """
+        dropped = []
+        while True:
+            node = self._get_exclusive_node(resource, processes, dropped)
+            node_version = node.metadata.get('version') if node else None
 
-            except WriteConflictError:
-                process = self.store.get_process(process.owner, process.upid)
+            versions = []
+            for process in processes:
+                versions.append(process.metadata.get('version'))
 
-        if updated:
-            self.notifier.notify_process(process)
+                process.assigned = resource.resource_id
+                process.state = ProcessState.ASSIGNED
+                process.increment_dispatches()
 
-        return process, updated
+                # pull hostname directly onto process record, if available.
+                # it is commonly desired information and this saves the need
+                # to make multiple queries to get it.
+                process.hostname = resource.properties.get('hostname')
 
-    def _backout_resource_assignment(self, resource, process):
-        removed = False
-        pkey = process.key
-        while resource and pkey in resource.assigned:
-            resource.assigned.remove(pkey)
             try:
-                self.store.update_resource(resource)
-                removed = True
-            except WriteConflictError:
-                resource = self.store.get_resource(resource.resource_id)
-            except NotFoundError:
-                resource = None
+                self.store.commit_assignment(resource, processes, node=node)
+                break
+
+            except (WriteConflictError, NotFoundError):
+                # our copies of the records were modified but not written.
+                # Retry with the current process records, dropping any that
+                # no longer need this placement.
+                changed = False
+                current_processes = []
+                for process, version in zip(processes, versions):
+                    pkey = process.key
+                    self.process_cache.pop((process.owner, process.upid), None)
+                    current = self.store.get_process(process.owner, process.upid)
+                    if current and current.metadata.get('version') != version:
+                        changed = True
+                    elif current is None:
+                        changed = True
+
+                    if (current and current.round == pkey[2] and
+                            current.state < ProcessState.ASSIGNED):
+                        current_processes.append(current)
+                    else:
+                        dropped.append(process)
+                        with self.index_lock:
+                            resource.assigned = [assignment for assignment in resource.assigned
+                                                 if tuple(assignment) != pkey]
+
+                if node is not None:
+                    current_node = self.store.get_node(node.node_id)
+                    if current_node and current_node.metadata.get('version') != node_version:
+                        changed = True
+
+                # if neither the processes nor the node changed, it was the
+                # resource that conflicted. Let the caller bail out.
+                if not changed:
+                    raise
+                processes = current_processes
+
+        if node is not None:
+            self.node_cache[node.node_id] = node
+
+        for process in processes:
+            log.info(get_process_state_message(process))
+            self.notifier.notify_process(process)
+
+        return processes, [process.key for process in dropped]
 
-        return resource, removed
+    def _get_exclusive_node(self, resource, processes, dropped):
+        """Read a resource's node record and apply its placements' exclusive tags
+
+        Tags of placed processes are added and those of dropped processes are
+        removed. Returns None if the node record needs no update.
+        """
+        added = [str(process.node_exclusive) for process in processes
+                 if process.node_exclusive]
+        removed = set(str(process.node_exclusive) for process in dropped
+                      if process.node_exclusive)
+        removed.difference_update(added)
+        if not (added or removed):
+            return None
+
+        node = self.store.get_node(resource.node_id)
+        if node is None:
+            log.error("Couldn't find node %s to update node_exclusive",
+                resource.node_id)
+            return None
+
+        tags = [tag for tag in node.node_exclusive if tag not in removed]
+        for tag in added:
+            if tag not in tags:
+                tags.append(tag)
+        if tags == node.node_exclusive:
+            return None
+
+        log.debug("Updating node %s node_exclusive tags: %s", node.node_id, tags)
+        node.node_exclusive = tags
+        return node
 
     def _remove_queued_process(self, owner, upid, round):
             try:
@@ -539,10 +811,48 @@ class PDMatchmaker(object):
             except NotFoundError:
                 # no problem if some other process removed the queue entry
                 pass
-            try:
-                self.queued_processes.remove((owner, upid, round))
-            except ValueError:
-                pass
+            self._forget_queued_process(owner, upid, round)
+
+    def _add_queued_processes(self, keys):
+        """Append process keys to the matchmaker's view of the queue
+        """
+        with self.index_lock:
+            for key in keys:
+                if key not in self.queued_processes:
+                    self.queued_processes[key] = None
+                    self.untallied_processes.add(key)
+
+    def _forget_queued_process(self, owner, upid, round):
+        key = (owner, upid, round)
+        with self.index_lock:
+            self.queued_processes.pop(key, None)
+            self.stale_processes.discard(key)
+            self.throttled_processes.pop(key, None)
+            self.untallied_processes.discard(key)
+            self.engine_tally.discard_queued_process(key)
+        self.process_cache.pop((owner, upid), None)
+
+    def _tally_queued_process(self, key, engine_id):
+        with self.index_lock:
+            if key in self.untallied_processes:
+                self.untallied_processes.discard(key)
+
+                # a process which may run on any of several engines isn't
+                # counted against any one of them
+                if not isinstance(engine_id, (list, tuple)):
+                    self.engine_tally.set_queued_process(key, engine_id)
+
+    def _tally_queued_processes(self):
+        """Count any newly queued processes against their engines
+        """
+        for key in list(self.untallied_processes):
+            process = self._get_queued_process(key[0], key[1])
+            if not process:
+                continue
+
+            # get_process_constraints is guaranteed to have an engine set
+            engine_id = self.core.get_process_constraints(process)['engine']
+            self._tally_queued_process(key, engine_id)
 
     def _mark_process_waiting(self, process):
 
@@ -585,6 +895,7 @@ class PDMatchmaker(object):
                 self.store.update_process(process)
                 updated = True
             except WriteConflictError:
+                self.process_cache.pop((process.owner, process.upid), None)
                 process = self.store.get_process(process.owner, process.upid)
                 continue
 
@@ -593,24 +904,35 @@ class PDMatchmaker(object):
 
         return process, updated
 
-    def _throttle_process(self, process):
+    def _throttle_process(self, process, throttle_end_time):
         self._mark_process_waiting(process)
-        self.throttled_processes.append(process)
+
+        # the process sits out of matchmaking until its throttle ends
+        key = process.key
+        with self.index_lock:
+            if key in self.queued_processes and key not in self.throttled_processes:
+                self.throttled_processes[key] = throttle_end_time
+                heapq.heappush(self.throttle_heap, (throttle_end_time, key))
 
     def _time_until_throttling_ends(self):
-        process_throttle_times = []
-        for process in self.throttled_processes:
-            process_throttle_times.append(self._throttle_end_time(process))
-        try:
-            throttle_end_time = min(process_throttle_times)
-            time_until_throttling_ends = throttle_end_time - time.time()
-            return time_until_throttling_ends
-        except ValueError:
-            return None
+        with self.index_lock:
+            if not self.throttle_heap:
+                return None
+            return self.throttle_heap[0][0] - time.time()
 
     def _check_throttled_processes(self):
-        if self._time_until_throttling_ends() <= 0:
-            self.throttled_processes = []
+        """Release the throttled processes whose throttle has ended
+        """
+        now = time.time()
+        released = False
+        with self.index_lock:
+            heap = self.throttle_heap
+            while heap and heap[0][0] <= now:
+                throttle_end_time, key = heapq.heappop(heap)
+                if self.throttled_processes.get(key) == throttle_end_time:
+                    del self.throttled_processes[key]
+                    released = True
+        if released:
             self.needs_matchmaking = True
 
     def _throttle_end_time(self, process):
@@ -632,84 +954,47 @@ class PDMatchmaker(object):
             return 0
 
         # Process only needs throttling if it has been restarted at least once
-        if len(process.dispatch_times) <= 1:
+        if process.dispatches <= 1:
             return 0
 
-        last_start = max(process.dispatch_times)
+        last_start = process.get_last_dispatch_time()
+        if last_start is None:
+            return 0
         return last_start + minimum_time_between_starts
 
     def _mark_process_stale(self, process):
-        self.stale_processes.append(process)
+        # only processes still in the queue can be stale
+        with self.index_lock:
+            if process in self.queued_processes:
+                self.stale_processes.add(process)
 
     def _dump_stale_processes(self):
-        self.stale_processes = []
+        self.stale_processes.clear()
 
     def _get_fresh_processes(self):
-        stale = set(self.stale_processes)
-        fresh_processes = [p for p in self.queued_processes if p not in stale]
-        return fresh_processes
-
-    def get_available_resources(self):
-        """Select the available execution resources
-
-        Returns a sorted list of NodeContainer objects
+        stale = self.stale_processes
+        throttled = self.throttled_processes
+        if not (stale or throttled):
+            return list(self.queued_processes)
+        return [p for p in self.queued_processes
+                if p not in stale and p not in throttled]
+
+    def calculate_need(self, engine_id, pending_process_ids=None):
+        """Calculate the number of nodes an engine needs
+
+        Counts come from the engine tally, so the cost doesn't depend on the
+        number of processes or resources. pending_process_ids is an optional
+        set of (owner, upid) of unscheduled pending processes of the engine,
+        which are counted along with the queued and assigned processes.
         """
-
-        # first break down available resources by node
-        available_by_node = defaultdict(list)
-        for resource in self.resources.itervalues():
-
-            # only consider OK resources. We definitely don't want to consider
-            # MISSING or DISABLED resources. We could arguably include WARNING
-            # resources, but perhaps at a lower priority than OK.
-
-            if resource.state == ExecutionResourceState.OK and resource.available_slots:
-                node_id = resource.node_id
-                available_by_node[node_id].append(resource)
-
-        # now create NodeResources container objects for each node,
-        # splitting unoccupied nodes off into a separate list
-        unoccupied_node_containers = []
-        node_containers = []
-        for node_id, resources in available_by_node.iteritems():
-            container = NodeContainer(node_id, resources)
-
-            if any(resource.assigned for resource in resources):
-                node_containers.append(container)
-            else:
-                unoccupied_node_containers.append(container)
-
-        # sort the occupied nodes by the aggregate number of available slots
-        node_containers.sort(key=attrgetter('available_slots'))
-
-        # append the unoccupied node lists onto the end
-        node_containers.extend(unoccupied_node_containers)
-        return node_containers
-
-    def calculate_need(self, engine_id):
-
-        # track a set of all known processes, both assigned and queued. it
-        # is possible for there to be some brief overlap between assigned
-        # and queued processes, where round N of a process is assigned and
-        # round N+1 is requeued.
-        process_set = set()
-        occupied_node_set = set()
-        node_set = set()
-
-        for process in self.pending_processes_by_engine(engine_id):
-            process_set.add((process.owner, process.upid))
-
-        for process in self.queued_processes_by_engine(engine_id):
-            process_set.add((process.owner, process.upid))
-
-        resources = self.resources_by_engine(engine_id)
-        for resource in resources.itervalues():
-            if resource.assigned:
-                for owner, upid, _ in resource.assigned:
-                    process_set.add((owner, upid))
-                occupied_node_set.add(resource.node_id)
-
-            node_set.add(resource.node_id)
+        tally = self.engine_tally
+        with self.index_lock:
+            process_count = tally.get_process_count(engine_id)
+            if pending_process_ids:
+                process_ids = tally.get_process_ids(engine_id)
+                process_count += sum(1 for process_id in pending_process_ids
+                                     if process_id not in process_ids)
+            occupied_count = tally.get_occupied_node_count(engine_id)
 
         # need is the greater of the base need, the number of occupied
         # resources, and the number of instances that could be occupied
@@ -718,35 +1003,56 @@ class PDMatchmaker(object):
 
         # total number of unique runnable processes in the system plus
         # minimum free slots
-        process_count = len(process_set) + engine.spare_slots
+        process_count += engine.spare_slots
 
         process_need = int(ceil(process_count / float(engine.slots * engine.replicas)))
-        need = max(engine.base_need, len(occupied_node_set), process_need)
+        need = max(engine.base_need, occupied_count, process_need)
         if engine.maximum_vms is not None:
             need = min(need, engine.maximum_vms)
             log.debug("Engine '%s' need=%d = min(maximum_vms=%d, max(base_need=%d, occupied=%d, process_need=%d))",
-            engine_id, need, engine.maximum_vms, engine.base_need, len(occupied_node_set), process_need)
+            engine_id, need, engine.maximum_vms, engine.base_need, occupied_count, process_need)
         else:
             log.debug("Engine '%s' need=%d = max(base_need=%d, occupied=%d, process_need=%d)",
-                engine_id, need, engine.base_need, len(occupied_node_set), process_need)
-        return need, list(node_set - occupied_node_set)
+                engine_id, need, engine.base_need, occupied_count, process_need)
+        return need
+
+    def _get_pending_process_ids(self):
+        """Group the unscheduled pending processes by engine
+
+        Returns a dict of engine_id -> set of (owner, upid). This list is only
+        populated while the system is booting.
+        """
+        pending = defaultdict(set)
+        for process in self.unscheduled_pending_processes:
+            if not process:
+                continue
+
+            # get_process_constraints is guaranteed to have an engine set
+            engine_id = self.core.get_process_constraints(process)['engine']
+            pending[engine_id].add((process.owner, process.upid))
+        return pending
 
     def register_needs(self):
 
         self._get_pending_processes()
+        self._tally_queued_processes()
+        pending_process_ids = self._get_pending_process_ids()
 
         for engine in list(self.ee_registry):
 
             engine_id = engine.engine_id
 
-            need, unoccupied_nodes = self.calculate_need(engine_id)
+            need = self.calculate_need(engine_id, pending_process_ids.get(engine_id))
             registered_need = self.registered_needs.get(engine_id)
             if need != registered_need:
 
                 retiree_ids = None
-                # on scale down, request for specific nodes to be terminated
+                # on scale down, request for specific nodes to be terminated.
+                # only now are the unoccupied nodes and their ages looked up.
                 if need < registered_need:
 
+                    with self.index_lock:
+                        unoccupied_nodes = self.engine_tally.get_unoccupied_nodes(engine_id)
                     unoccupied_nodes.sort(key=self._node_state_time, reverse=True)
                     retiree_ids = unoccupied_nodes[:registered_need - need]
                     for resource in self.resources.itervalues():
@@ -763,6 +1069,14 @@ class PDMatchmaker(object):
                 self.epum_client.reconfigure_domain(domain_id, config)
                 self.registered_needs[engine_id] = need
 
+    def _get_cached_node(self, node_id):
+        """Get a node record, caching it for the rest of this matchmaking pass
+        """
+        if node_id in self.node_cache:
+            return self.node_cache[node_id]
+        node = self.node_cache[node_id] = self.store.get_node(node_id)
+        return node
+
     def _node_state_time(self, node_id):
         node = self.store.get_node(node_id)
         if node:
@@ -770,24 +1084,26 @@ class PDMatchmaker(object):
         else:
             return 0
 
-    def matchmake_process(self, process, node_containers):
+    def matchmake_process(self, process):
         constraints = self.core.get_process_constraints(process)
 
-        # node_resources is a list of NodeResources objects. each contains a
-        # sublist of resources.
-        for node_container in node_containers:
+        # narrow the search to resources whose properties can satisfy the
+        # constraints. None means the process is unconstrained.
+        candidates = self.constraint_index.match(constraints)
+        if candidates is not None and not candidates:
+            log.debug("NOMATCH: process %s constraints: %s match no resources",
+                process.upid, constraints)
+            return None
+
+        # the slot index yields NodeContainer objects in matchmaking order.
+        # each contains a sublist of resources.
+        for node_container in self.slot_index.walk(candidates):
 
             # skip ahead by whole nodes if we care about node exclusivity
             if process.node_exclusive:
                 node_id = node_container.node_id
 
-                # grab node object out of data store and cache it on the
-                # container
-                if node_container.node is None:
-                    node = node_container.node = self.store.get_node(node_id)
-                else:
-                    node = node_container.node
-
+                node = self._get_cached_node(node_id)
                 if not node:
                     log.warning("Can't find node %s?", node_id)
                     continue
@@ -797,20 +1113,17 @@ class PDMatchmaker(object):
                                   process.upid, process.node_exclusive, node_id))
                     continue
 
-            # now inspect each resource in the node looking for a match
+            # now inspect each candidate resource in the node looking for a match
             for resource in node_container.resources:
-                logstr = "%s: process %s constraints: %s against resource %s properties: %s"
+                if candidates is not None and resource.resource_id not in candidates:
+                    continue
                 if match_constraints(constraints, resource.properties):
-                    log.debug(logstr, "MATCH", process.upid, constraints,
-                        resource.resource_id, resource.properties)
-
+                    log.debug("MATCH: process %s constraints: %s against resource %s properties: %s",
+                        process.upid, constraints, resource.resource_id, resource.properties)
                     return resource
 
-                else:
-                    log.debug(logstr, "NOTMATCH", process.upid, process.constraints,
-                        resource.resource_id, resource.properties)
-
         # no match was found!
+        log.debug("NOMATCH: process %s constraints: %s", process.upid, constraints)
         return None
 
 
@@ -877,7 +1190,12 @@ def _get_process_config(process):
 
 
 class ProcessLauncher(object):
-    def __init__(self, store, resource_client, run_type, retry_seconds=0):
+
+    # number of process records read at once when retrying dispatches
+    retry_batch_size = 100
+
+    def __init__(self, store, resource_client, run_type, retry_seconds=0,
+                 concurrency=1):
         self.store = store
         self.resource_client = resource_client
         self.run_type = run_type
@@ -888,14 +1206,24 @@ class ProcessLauncher(object):
             self.supports_retries = False
             self.retry_seconds = 0
 
-        # map of pending process owner/ID pairs to last dispatch times
+        # number of retried dispatches sent at once
+        self.concurrency = concurrency or 1
+
+        # map of pending process keys to the time their dispatch is next
+        # due to be retried
         self.pending_process_dispatches = {}
 
+        # heap of (retry time, process key). Entries which no longer match
+        # pending_process_dispatches are skipped when popped.
+        self.retry_heap = []
+        self.lock = threading.Lock()
+
     def __contains__(self, item):
         return item in self.pending_process_dispatches
 
     def __delitem__(self, item):
-        del self.pending_process_dispatches[item]
+        with self.lock:
+            del self.pending_process_dispatches[item]
 
     def dispatch_process(self, process):
         """Launches a process onto a resource.
@@ -904,10 +1232,15 @@ class ProcessLauncher(object):
         until it is acknowledged or canceled.
         """
         if self.retry_seconds:
-            self.pending_process_dispatches[process.key] = time.time()
+            self._schedule_retry(process.key, time.time() + self.retry_seconds)
 
         self._do_dispatch(process)
 
+    def _schedule_retry(self, process_key, retry_time):
+        with self.lock:
+            self.pending_process_dispatches[process_key] = retry_time
+            heapq.heappush(self.retry_heap, (retry_time, process_key))
+
     def _do_dispatch(self, process):
         assert process.state == ProcessState.ASSIGNED
         resource_id = process.assigned
@@ -945,66 +1278,477 @@ class ProcessLauncher(object):
 
         Returns seconds until next retry
         """
-        global_next_retry = None
         now = time.time()
-        for process_key, last_time in self.pending_process_dispatches.items():
-            next_retry = last_time + self.retry_seconds
-            if next_retry <= now:
-                owner, upid, round = process_key
-                process = self.store.get_process(owner, upid)
-                if not (process and process.round == round
-                        and process.state == ProcessState.ASSIGNED):
-                    # if the process has moved on to another round or state,
-                    # drop it from our set and move on
-                    del self.pending_process_dispatches[process_key]
-                    continue
-
-                # otherwise, re-attempt the request
-                self._do_dispatch(process)
-                self.pending_process_dispatches[process_key] = now + self.retry_seconds
-            else:
-                if global_next_retry is None or next_retry < global_next_retry:
-                    global_next_retry = next_retry
+        due = []
+        with self.lock:
+            while self.retry_heap and self.retry_heap[0][0] <= now:
+                retry_time, process_key = heapq.heappop(self.retry_heap)
+                if self.pending_process_dispatches.get(process_key) == retry_time:
+                    due.append(process_key)
+
+        for start in range(0, len(due), self.retry_batch_size):
+            self._retry_dispatches(due[start:start + self.retry_batch_size], now)
+
+        with self.lock:
+            heap = self.retry_heap
+            while heap and self.pending_process_dispatches.get(heap[0][1]) != heap[0][0]:
+                heapq.heappop(heap)
+            if not heap:
+                return None
+            next_retry = heap[0][0]
+
+        return max(next_retry - time.time(), 0)
+
+    def _retry_dispatches(self, process_keys, now):
+        processes = self.store.get_processes(
+            [(owner, upid) for owner, upid, _ in process_keys])
+
+        retries = []
+        for process_key, process in zip(process_keys, processes):
+            round = process_key[2]
+            if not (process and process.round == round
+                    and process.state == ProcessState.ASSIGNED):
+                # if the process has moved on to another round or state,
+                # drop it from our set and move on
+                with self.lock:
+                    self.pending_process_dispatches.pop(process_key, None)
+                continue
 
-        if global_next_retry is None:
-            return None
+            self._schedule_retry(process_key, now + self.retry_seconds)
+            retries.append(process)
 
-        return max(global_next_retry - time.time(), 0)
+        # otherwise, re-attempt the requests
+        if self.concurrency > 1 and len(retries) > 1:
+            pool = tevent.Pool(min(self.concurrency, len(retries)))
+            for process in retries:
+                pool.apply_async(self._do_dispatch, (process,))
+            pool.join()
+        else:
+            for process in retries:
+                self._do_dispatch(process)
 
 
 class NodeContainer(object):
     """Represents the execution resources on a single node (VM)
 
-    Used only internally in matchmaking algorithm. Keeps the node's resources
-    sorted by their available slot count, descending. This way the matchmaker
-    will favor less-utilized resources on each node. Note that among the full
-    set of nodes, the matchmaker favors utilized nodes first. So the net effect
-    is that we fill up nodes but balance processes across all containers on
-    each node as we go.
+    Used only internally in matchmaking algorithm. Keeps the node's available
+    resources sorted by their available slot count, descending. This way the
+    matchmaker will favor less-utilized resources on each node. Note that
+    among the full set of nodes, the matchmaker favors utilized nodes first.
+    So the net effect is that we fill up nodes but balance processes across
+    all containers on each node as we go.
     """
-    def __init__(self, node_id, resources):
+    def __init__(self, node_id, resources=None):
         self.node_id = node_id
-        self.resources = list(resources)
-        self.node = None
+
+        # all known resources on the node, keyed by resource ID
+        self.all_resources = {}
+
+        # resources eligible for matching, sorted by available slots
+        self.resources = []
+        self.available_slots = 0
+        self.occupied = False
+
+        if resources:
+            for resource in resources:
+                self.all_resources[resource.resource_id] = resource
 
         # sort the resource list to begin with
         self.update()
 
-    @property
-    def available_slots(self):
-        return sum(r.available_slots for r in self.resources)
+    def __len__(self):
+        return len(self.all_resources)
+
+    def set_resource(self, resource):
+        self.all_resources[resource.resource_id] = resource
+        self.update()
+
+    def discard_resource(self, resource_id):
+        self.all_resources.pop(resource_id, None)
+        self.update()
 
     def update(self):
         """Ensure the resource set is sorted and available
 
-        Prunes any resources that have no free slots.
+        Only OK resources with free slots are considered. We definitely don't
+        want to consider MISSING or DISABLED resources. We could arguably
+        include WARNING resources, but perhaps at a lower priority than OK.
         """
-        resources = self.resources
+        resources = [resource for resource in self.all_resources.itervalues()
+                     if resource.state == ExecutionResourceState.OK and
+                     resource.available_slots]
         resources.sort(key=attrgetter('available_slots'), reverse=True)
 
-        # walk from the end of list and prune off resources with no free slots
-        while resources and resources[-1].available_slots == 0:
-            resources.pop()
+        self.resources = resources
+        self.available_slots = sum(r.available_slots for r in resources)
+        self.occupied = any(r.assigned for r in self.all_resources.itervalues())
+
+
+class SlotIndex(object):
+    """Incrementally maintained index of available execution resource slots
+
+    Used only internally by the matchmaker. Resources are grouped into a
+    NodeContainer per node, and nodes with free slots are bucketed by their
+    aggregate available slot count. Iterating the index yields occupied nodes
+    with the fewest available slots first, followed by unoccupied nodes.
+
+    The index is updated as resource records are folded in from the store and
+    as processes are placed, so each update only touches a single node rather
+    than rebuilding and sorting every node on each matchmaking pass.
+    """
+    def __init__(self):
+        # node_id -> NodeContainer, for every node with a known resource
+        self.containers = {}
+
+        # resource_id -> node_id
+        self.resource_nodes = {}
+
+        # available slot count -> ordered {node_id: NodeContainer}. The
+        # slot counts of the buckets are also kept in a sorted list, so a
+        # walk doesn't have to sort them.
+        self.occupied_buckets = {}
+        self.occupied_slot_counts = []
+        self.unoccupied = OrderedDict()
+
+        # node_id -> (occupied/unoccupied, available slots, link sequence).
+        # sorting by this key reproduces the iteration order of the index.
+        self.linked = {}
+        self.link_sequence = 0
+
+    def __len__(self):
+        return len(self.linked)
+
+    def __iter__(self):
+        # bucket keys and values are copied so callers may update the index
+        # mid-walk
+        for available_slots in list(self.occupied_slot_counts):
+            bucket = self.occupied_buckets.get(available_slots)
+            if bucket is None:
+                continue
+            for container in bucket.values():
+                yield container
+        for container in self.unoccupied.values():
+            yield container
+
+    def __contains__(self, resource_id):
+        return resource_id in self.resource_nodes
+
+    def walk(self, resource_ids=None):
+        """Yield NodeContainers in matchmaking order
+
+        If a set of resource IDs is provided, only nodes containing at least
+        one of those resources are yielded. When the set is smaller than the
+        number of available nodes, the candidate nodes are ordered with a heap
+        instead of walking the entire index.
+        """
+        if resource_ids is None:
+            for container in self:
+                yield container
+            return
+
+        if len(resource_ids) >= len(self.linked):
+            for container in self:
+                if any(resource.resource_id in resource_ids
+                       for resource in container.resources):
+                    yield container
+            return
+
+        heap = []
+        seen = set()
+        for resource_id in resource_ids:
+            node_id = self.resource_nodes.get(resource_id)
+            if node_id is None or node_id in seen or node_id not in self.linked:
+                continue
+            seen.add(node_id)
+            heap.append((self.linked[node_id], node_id))
+        heapq.heapify(heap)
+
+        while heap:
+            key, node_id = heapq.heappop(heap)
+
+            # the index may have been updated since the heap was built
+            if self.linked.get(node_id) == key:
+                yield self.containers[node_id]
+
+    def set_resource(self, resource):
+        """Add or update a resource record in the index
+        """
+        resource_id = resource.resource_id
+        node_id = resource.node_id
+
+        previous_node_id = self.resource_nodes.get(resource_id)
+        if previous_node_id is not None and previous_node_id != node_id:
+            self.discard_resource(resource_id)
+
+        container = self.containers.get(node_id)
+        if container is None:
+            container = self.containers[node_id] = NodeContainer(node_id)
+
+        self._unlink(container)
+        container.set_resource(resource)
+        self.resource_nodes[resource_id] = node_id
+        self._link(container)
+
+    def discard_resource(self, resource_id):
+        """Remove a resource from the index, if present
+        """
+        node_id = self.resource_nodes.pop(resource_id, None)
+        if node_id is None:
+            return
+
+        container = self.containers[node_id]
+        self._unlink(container)
+        container.discard_resource(resource_id)
+        if len(container):
+            self._link(container)
+        else:
+            del self.containers[node_id]
+
+    def _link(self, container):
+        if not container.available_slots:
+            return
 
-    def update_node(self, new_node):
-        self.node = new_node
+        node_id = container.node_id
+        self.link_sequence += 1
+        if container.occupied:
+            available_slots = container.available_slots
+            bucket = self.occupied_buckets.get(available_slots)
+            if bucket is None:
+                bucket = self.occupied_buckets[available_slots] = OrderedDict()
+                bisect.insort(self.occupied_slot_counts, available_slots)
+            bucket[node_id] = container
+            key = (0, available_slots, self.link_sequence)
+        else:
+            self.unoccupied[node_id] = container
+            key = (1, 0, self.link_sequence)
+        self.linked[node_id] = key
+
+    def _unlink(self, container):
+        node_id = container.node_id
+        if node_id not in self.linked:
+            return
+
+        unoccupied, available_slots, _ = self.linked.pop(node_id)
+        if unoccupied:
+            del self.unoccupied[node_id]
+        else:
+            bucket = self.occupied_buckets[available_slots]
+            del bucket[node_id]
+            if not bucket:
+                del self.occupied_buckets[available_slots]
+                slot_counts = self.occupied_slot_counts
+                del slot_counts[bisect.bisect_left(slot_counts, available_slots)]
+
+
+class ConstraintIndex(object):
+    """Inverted index from resource properties to resource IDs
+
+    Used only internally by the matchmaker. Process constraints are resolved
+    to a candidate set of resources with set intersections, rather than
+    comparing the constraints against every resource's properties.
+    Candidates are still checked with match_constraints() before use.
+    """
+
+    _EMPTY = frozenset()
+
+    def __init__(self):
+        # (property key, value) -> set of resource IDs
+        self.by_property = defaultdict(set)
+
+        # property key -> set of resource IDs advertising an unhashable value
+        self.unhashable = defaultdict(set)
+
+        # resource_id -> list of (index, entry) pairs the resource is under
+        self.resource_entries = {}
+
+    def __contains__(self, resource_id):
+        return resource_id in self.resource_entries
+
+    def set_resource(self, resource):
+        """Add or update a resource record in the index
+        """
+        resource_id = resource.resource_id
+        self.discard_resource(resource_id)
+
+        entries = []
+        for key, value in (resource.properties or {}).iteritems():
+            if value is None:
+                continue
+            try:
+                self.by_property[(key, value)].add(resource_id)
+                entries.append((self.by_property, (key, value)))
+            except TypeError:
+                self.unhashable[key].add(resource_id)
+                entries.append((self.unhashable, key))
+        self.resource_entries[resource_id] = entries
+
+    def discard_resource(self, resource_id):
+        """Remove a resource from the index, if present
+        """
+        entries = self.resource_entries.pop(resource_id, None)
+        if not entries:
+            return
+
+        for index, entry in entries:
+            resource_ids = index[entry]
+            resource_ids.discard(resource_id)
+            if not resource_ids:
+                del index[entry]
+
+    def match(self, constraints):
+        """Return a set of IDs of resources that may satisfy constraints
+
+        Returns None if the constraints don't narrow the resource set at all.
+        """
+        if not constraints:
+            return None
+
+        candidate_sets = []
+        for key, value in constraints.iteritems():
+            if value is None:
+                continue
+
+            if isinstance(value, (list, tuple)):
+                values = value
+            else:
+                values = (value,)
+
+            try:
+                sets = [self.by_property.get((key, v), self._EMPTY) for v in values]
+            except TypeError:
+                # can't narrow on an unhashable constraint value
+                continue
+
+            unhashable = self.unhashable.get(key)
+            if unhashable:
+                sets.append(unhashable)
+
+            if len(sets) == 1:
+                candidate_sets.append(sets[0])
+            else:
+                candidate_sets.append(set().union(*sets))
+
+        if not candidate_sets:
+            return None
+
+        # intersect starting from the smallest set
+        candidate_sets.sort(key=len)
+        candidates = set(candidate_sets[0])
+        for resource_ids in candidate_sets[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(resource_ids)
+        return candidates
+
+
+class EngineTally(object):
+    """Incrementally maintained per-engine process and node counts
+
+    Used only internally by the matchmaker to calculate engine need. Queued
+    processes and resources are folded in as they change, so the counts for
+    an engine can be read without walking every process and resource.
+
+    Processes are counted by (owner, upid), across queued and assigned
+    processes. There can be some brief overlap between the two, where round
+    N of a process is assigned and round N+1 is requeued, so each process is
+    reference counted and only counted once.
+    """
+    def __init__(self):
+        # engine_id -> {(owner, upid): reference count}
+        self.processes = defaultdict(dict)
+
+        # engine_id -> {node_id: count of resources}
+        self.nodes = defaultdict(dict)
+
+        # engine_id -> {node_id: count of resources with assignments}
+        self.occupied_nodes = defaultdict(dict)
+
+        # resource_id -> (engine_id, node_id, tuple of (owner, upid))
+        self.resource_entries = {}
+
+        # (owner, upid, round) -> engine_id
+        self.queued_entries = {}
+
+    def set_resource(self, resource):
+        """Add or update a resource record in the tally
+        """
+        process_ids = tuple(tuple(key[:2]) for key in resource.assigned_keys())
+        entry = (resource.properties.get('engine'), resource.node_id, process_ids)
+
+        previous = self.resource_entries.get(resource.resource_id)
+        if previous == entry:
+            return
+        if previous:
+            self._remove_resource_entry(previous)
+
+        self.resource_entries[resource.resource_id] = entry
+        engine_id, node_id, process_ids = entry
+        _increment(self.nodes[engine_id], node_id)
+        if process_ids:
+            _increment(self.occupied_nodes[engine_id], node_id)
+        processes = self.processes[engine_id]
+        for process_id in process_ids:
+            _increment(processes, process_id)
+
+    def discard_resource(self, resource_id):
+        """Remove a resource from the tally, if present
+        """
+        previous = self.resource_entries.pop(resource_id, None)
+        if previous:
+            self._remove_resource_entry(previous)
+
+    def _remove_resource_entry(self, entry):
+        engine_id, node_id, process_ids = entry
+        _decrement(self.nodes[engine_id], node_id)
+        if process_ids:
+            _decrement(self.occupied_nodes[engine_id], node_id)
+        processes = self.processes[engine_id]
+        for process_id in process_ids:
+            _decrement(processes, process_id)
+
+    def set_queued_process(self, key, engine_id):
+        """Count a queued (owner, upid, round) process against an engine
+        """
+        self.discard_queued_process(key)
+        self.queued_entries[key] = engine_id
+        _increment(self.processes[engine_id], key[:2])
+
+    def discard_queued_process(self, key):
+        """Stop counting a queued process, if it is counted
+        """
+        if key in self.queued_entries:
+            engine_id = self.queued_entries.pop(key)
+            _decrement(self.processes[engine_id], key[:2])
+
+    def get_process_ids(self, engine_id):
+        """Returns the set of (owner, upid) counted against an engine
+        """
+        return self.processes.get(engine_id) or {}
+
+    def get_process_count(self, engine_id):
+        return len(self.processes.get(engine_id) or ())
+
+    def get_node_count(self, engine_id):
+        return len(self.nodes.get(engine_id) or ())
+
+    def get_occupied_node_count(self, engine_id):
+        return len(self.occupied_nodes.get(engine_id) or ())
+
+    def get_unoccupied_nodes(self, engine_id):
+        """Returns a list of the engine's node IDs without any assignments
+        """
+        occupied = self.occupied_nodes.get(engine_id) or {}
+        return [node_id for node_id in self.nodes.get(engine_id) or ()
+                if node_id not in occupied]
+
+
+def _increment(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def _decrement(counts, key):
+    count = counts.get(key, 0) - 1
+    if count > 0:
+        counts[key] = count
+    else:
+        counts.pop(key, None)
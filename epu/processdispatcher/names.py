@@ -0,0 +1,64 @@
+# Copyright 2013 University of Chicago
+
+"""Encoding and decoding of Process Dispatcher record names
+
+Process records are named "owner=<owner>&upid=<upid>" and queue entries are
+named "owner=<owner>&upid=<upid>&round=<round>+<seq>", where the owner part
+is omitted for processes without an owner and <seq> is appended by
+ZooKeeper for sequential nodes.
+"""
+
+import re
+
+_PROCESS_NAME_RE = re.compile(r'^(?:owner=(.+)&)?upid=(.+)$')
+_QUEUED_PROCESS_NAME_RE = re.compile(
+    r'^(?:owner=(.+)&)?upid=(.+)&round=([0-9]+)\+([0-9]+)$')
+
+
+def make_process_name(owner, upid):
+    """Build a process record name
+    """
+    if upid is None:
+        raise ValueError('invalid process upid')
+
+    if owner is not None:
+        return "owner=" + owner + "&upid=" + upid
+    return "upid=" + upid
+
+
+def parse_process_name(name):
+    """Parse a process record name into an (owner, upid) tuple
+    """
+    match = _PROCESS_NAME_RE.match(name)
+    if match is None:
+        raise ValueError("process %s could not be parsed" % name)
+    return match.groups()
+
+
+def make_queued_process_name(owner, upid, round, seq=None):
+    """Build a queue entry name
+
+    Without a seq, the name is suitable as a prefix for a sequential node.
+    """
+    if upid is None:
+        raise ValueError('invalid process upid')
+    if round is None:
+        raise ValueError('invalid process round')
+
+    name = make_process_name(owner, upid) + "&round=" + str(round) + "+"
+    if seq is not None:
+        name += str(seq)
+    return name
+
+
+def parse_queued_process_name(name):
+    """Parse a queue entry name into an (owner, upid, round, seq) tuple
+
+    seq is left as a string, since ZooKeeper zero-pads it and the padded
+    form sorts correctly.
+    """
+    match = _QUEUED_PROCESS_NAME_RE.match(name)
+    if match is None:
+        raise ValueError("queued process %s could not be parsed" % name)
+    owner, upid, round, seq = match.groups()
+    return owner, upid, int(round), seq
@@ -0,0 +1,132 @@
+# Copyright 2013 University of Chicago
+
+import bisect
+import logging
+import threading
+
+from epu.processdispatcher import names
+
+log = logging.getLogger(__name__)
+
+
+class ProcessIndex(object):
+    """In-memory index of process records, ordered by process name
+
+    Listing processes from the store means reading every record on every
+    call. The index instead keeps a copy of each record and watches the
+    store for changes: only records that changed since the last query are
+    read again. Refreshing is done lazily, at the start of each query.
+
+    Processes are ordered by their record name, which allows stable paging:
+    a cursor is the name of the last process of a page, and the next page
+    starts just after it even if processes came or went in between.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+        # protects the change tracking below. never held while calling
+        # into the store, because store watchers can fire under its lock
+        self.lock = threading.Lock()
+        self.process_set_changed = True
+        self.stale_process_ids = set()
+
+        # serializes refreshes and queries
+        self.refresh_lock = threading.RLock()
+
+        # process name -> process record
+        self.processes = {}
+        self.process_names = []
+
+    def _notify_process_set_changed(self, *args):
+        with self.lock:
+            self.process_set_changed = True
+
+    def _notify_process_changed(self, owner, upid):
+        with self.lock:
+            self.stale_process_ids.add((owner, upid))
+
+    def refresh(self):
+        """Bring the index up to date with the store
+        """
+        with self.refresh_lock:
+            with self.lock:
+                process_set_changed = self.process_set_changed
+                self.process_set_changed = False
+                stale_process_ids = self.stale_process_ids
+                self.stale_process_ids = set()
+
+            if process_set_changed:
+                process_ids = self.store.get_process_ids(
+                    watcher=self._notify_process_set_changed)
+                process_names = {}
+                for owner, upid in process_ids:
+                    process_names[names.make_process_name(owner, upid)] = (owner, upid)
+
+                removed = [name for name in self.processes
+                           if name not in process_names]
+                for name in removed:
+                    del self.processes[name]
+
+                for name, process_id in process_names.iteritems():
+                    if name not in self.processes:
+                        stale_process_ids.add(process_id)
+
+                self.process_names = sorted(self.processes)
+
+            if not stale_process_ids:
+                return
+
+            stale_process_ids = list(stale_process_ids)
+            processes = self.store.get_processes(stale_process_ids,
+                watcher=self._notify_process_changed)
+
+            added = False
+            for (owner, upid), process in zip(stale_process_ids, processes):
+                name = names.make_process_name(owner, upid)
+                if process is None:
+                    if self.processes.pop(name, None) is not None:
+                        index = bisect.bisect_left(self.process_names, name)
+                        del self.process_names[index]
+                else:
+                    if name not in self.processes:
+                        self.process_names.append(name)
+                        added = True
+                    self.processes[name] = process
+
+            if added:
+                # mostly sorted already, which sorts in close to linear time
+                self.process_names.sort()
+
+    def query(self, match=None, cursor=None, limit=None):
+        """Find processes in name order
+
+        @param match: optional function called with each process record,
+            returning True for those to include
+        @param cursor: optional cursor returned by an earlier query, to
+            continue after the last process it returned
+        @param limit: optional maximum number of processes to return
+        @return: tuple of (list of process records, cursor). The cursor is
+            None when there are no more processes to return.
+        """
+        with self.refresh_lock:
+            self.refresh()
+
+            if cursor is None:
+                start = 0
+            else:
+                start = bisect.bisect_right(self.process_names, cursor)
+
+            found = []
+            for index in xrange(start, len(self.process_names)):
+                process = self.processes[self.process_names[index]]
+                if match is not None and not match(process):
+                    continue
+                if limit is not None and len(found) == limit:
+                    return found, names.make_process_name(found[-1].owner,
+                                                          found[-1].upid)
+                found.append(process)
+            return found, None
+
+    def __len__(self):
+        return len(self.processes)
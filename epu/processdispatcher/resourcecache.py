@@ -0,0 +1,165 @@
+# Copyright 2013 University of Chicago
+
+import copy
+import logging
+import threading
+
+from epu.processdispatcher.store import ResourceRecord
+
+log = logging.getLogger(__name__)
+
+
+class ResourceCache(object):
+    """In-memory copy of execution resource records, kept current with store watches
+
+    The matchmaker and the resource monitor both follow every resource
+    record. They share a cache, so each change is read from the store once
+    no matter how many of them are running in this worker.
+
+    Changes are read lazily: watches only note which records changed, and
+    the records are read the next time a subscriber asks for its changes.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+        # protects the change tracking below. never held while calling
+        # into the store, because store watchers can fire under its lock
+        self.change_lock = threading.Lock()
+        self.resource_set_changed = True
+        self.changed_resources = set()
+
+        # serializes refreshes and access to the cached records
+        self.lock = threading.RLock()
+        self.resources = {}
+        self.subscriptions = []
+
+    def subscribe(self, callback=None):
+        """Start following changes to resources
+
+        The callback, if provided, is called with no arguments whenever a
+        resource may have changed. Callers then use get_changes() on the
+        returned subscription to find out which.
+        """
+        subscription = ResourceSubscription(self, callback)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            try:
+                self.subscriptions.remove(subscription)
+            except ValueError:
+                pass
+
+    def get_resource(self, resource_id):
+        """Return a copy of a cached resource record, or None
+
+        Each caller gets its own copy, which it is free to modify.
+        """
+        with self.lock:
+            resource = self.resources.get(resource_id)
+            if resource is None:
+                return None
+            return _copy_resource(resource)
+
+    def get_resource_ids(self):
+        with self.lock:
+            return self.resources.keys()
+
+    def _notify_resource_set_changed(self, *args):
+        with self.change_lock:
+            self.resource_set_changed = True
+        self._notify_subscriptions()
+
+    def _notify_resource_changed(self, resource_id, *args):
+        with self.change_lock:
+            self.changed_resources.add(resource_id)
+        self._notify_subscriptions()
+
+    def _notify_subscriptions(self):
+        for subscription in list(self.subscriptions):
+            subscription.notify()
+
+    def refresh(self):
+        """Read any resource records which changed since the last refresh
+        """
+        with self.lock:
+            with self.change_lock:
+                resource_set_changed = self.resource_set_changed
+                self.resource_set_changed = False
+                changed = self.changed_resources
+                self.changed_resources = set()
+
+            updated = set()
+            if resource_set_changed:
+                resource_ids = set(self.store.get_resource_ids(
+                    watcher=self._notify_resource_set_changed))
+                previous = set(self.resources.keys())
+
+                for resource_id in previous - resource_ids:
+                    del self.resources[resource_id]
+                    updated.add(resource_id)
+
+                changed.update(resource_ids - previous)
+
+            for resource_id in changed:
+                resource = self.store.get_resource(resource_id,
+                    watcher=self._notify_resource_changed)
+                if resource:
+                    self.resources[resource_id] = resource
+                else:
+                    self.resources.pop(resource_id, None)
+                updated.add(resource_id)
+
+            if updated:
+                for subscription in self.subscriptions:
+                    subscription.changed.update(updated)
+
+
+class ResourceSubscription(object):
+    """A single follower of a ResourceCache
+    """
+
+    def __init__(self, cache, callback=None):
+        self.cache = cache
+        self.callback = callback
+
+        # resource IDs changed since the subscriber last looked. guarded
+        # by the cache lock.
+        self.changed = set()
+        self.needs_reset = True
+
+    def notify(self):
+        if self.callback:
+            self.callback()
+
+    def reset(self):
+        """Report every cached resource as changed on the next get_changes()
+        """
+        with self.cache.lock:
+            self.needs_reset = True
+
+    def get_changes(self):
+        """Return the IDs of resources added, changed, or removed since the last call
+
+        The current records are available from the cache's get_resource().
+        """
+        with self.cache.lock:
+            self.cache.refresh()
+            changed = self.changed
+            self.changed = set()
+            if self.needs_reset:
+                self.needs_reset = False
+                changed.update(self.cache.resources.keys())
+            return changed
+
+    def cancel(self):
+        self.cache.unsubscribe(self)
+
+
+def _copy_resource(resource):
+    resource_copy = ResourceRecord(copy.deepcopy(dict(resource)))
+    resource_copy.metadata.update(resource.metadata)
+    return resource_copy
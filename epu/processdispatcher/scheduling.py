@@ -0,0 +1,135 @@
+# Copyright 2013 University of Chicago
+
+"""Policies for ordering queued processes for matchmaking
+
+The queue itself is always FIFO. A scheduling policy reorders the queued
+processes of an engine before each matchmaking pass, which only needs the
+process records the matchmaker already holds.
+"""
+
+import heapq
+
+
+class SchedulingPolicyType(object):
+
+    FIFO = "FIFO"
+    PRIORITY = "PRIORITY"
+    FAIR_SHARE = "FAIR_SHARE"
+
+
+def get_process_priority(process):
+    """Returns the priority of a process record. Higher goes first.
+
+    Records created before priorities existed have none, which is the same
+    as the default priority of 0.
+    """
+    priority = process.get('priority')
+    if priority is None:
+        return 0
+    return priority
+
+
+class SchedulingPolicy(object):
+    """Plain FIFO scheduling: processes are matched in queue order
+    """
+
+    def order(self, processes):
+        """Order a list of queued process records for matchmaking
+
+        processes are provided in queue order.
+        """
+        return list(processes)
+
+
+class PrioritySchedulingPolicy(SchedulingPolicy):
+    """Higher priority processes first, FIFO within a priority class
+    """
+
+    def order(self, processes):
+        # sort is stable so queue order is kept within each class
+        return sorted(processes, key=get_process_priority, reverse=True)
+
+
+class FairShareSchedulingPolicy(PrioritySchedulingPolicy):
+    """Priority classes, and weighted fair share between owners within each
+
+    Within a priority class, owners take turns in proportion to their
+    weights, so one owner with a deep queue can't starve the others. Each
+    owner's own processes stay in queue order.
+    """
+
+    def __init__(self, owner_weights=None, default_weight=1):
+        self.owner_weights = dict(owner_weights or {})
+        self.default_weight = default_weight
+
+    def _get_weight(self, owner):
+        weight = self.owner_weights.get(owner, self.default_weight)
+        if weight <= 0:
+            return self.default_weight
+        return weight
+
+    def order(self, processes):
+        ordered = []
+        priority_class = []
+        priority = None
+        for process in PrioritySchedulingPolicy.order(self, processes):
+            process_priority = get_process_priority(process)
+            if priority_class and process_priority != priority:
+                ordered.extend(self._interleave(priority_class))
+                priority_class = []
+            priority = process_priority
+            priority_class.append(process)
+        ordered.extend(self._interleave(priority_class))
+        return ordered
+
+    def _interleave(self, processes):
+        """Weighted round robin between owners (stride scheduling)
+        """
+        owner_queues = {}
+        for process in processes:
+            owner_queues.setdefault(process.owner, []).append(process)
+
+        if len(owner_queues) <= 1:
+            return processes
+
+        # each owner advances by 1/weight per process it is given. ties go
+        # to the owner whose next process has been queued longest.
+        heap = []
+        first_seen = {}
+        for index, process in enumerate(processes):
+            first_seen.setdefault(process.owner, index)
+        for owner in owner_queues:
+            heap.append((0.0, first_seen[owner], owner, 0))
+        heapq.heapify(heap)
+
+        interleaved = []
+        while heap:
+            current_pass, _, owner, position = heapq.heappop(heap)
+            queue = owner_queues[owner]
+            interleaved.append(queue[position])
+            position += 1
+            if position < len(queue):
+                heapq.heappush(heap, (current_pass + 1.0 / self._get_weight(owner),
+                                      first_seen[owner], owner, position))
+        return interleaved
+
+
+def get_scheduling_policy(config=None):
+    """Build a scheduling policy from the processdispatcher configuration
+
+    config is a dict with a "type" of one of SchedulingPolicyType and, for
+    fair share, optional "owner_weights" and "default_weight".
+    """
+    if not config:
+        return SchedulingPolicy()
+
+    policy_type = config.get('type', SchedulingPolicyType.FIFO)
+    if policy_type == SchedulingPolicyType.FIFO:
+        return SchedulingPolicy()
+    elif policy_type == SchedulingPolicyType.PRIORITY:
+        return PrioritySchedulingPolicy()
+    elif policy_type == SchedulingPolicyType.FAIR_SHARE:
+        return FairShareSchedulingPolicy(
+            owner_weights=config.get('owner_weights'),
+            default_weight=config.get('default_weight', 1))
+    raise ValueError("unknown scheduling policy type: %s" % policy_type)
@@ -10,16 +10,28 @@ import copy
 
 from kazoo.client import KazooClient, KazooState
 from kazoo.exceptions import NodeExistsException, BadVersionException, \
-    NoNodeException
+    NoNodeException, RolledBackError
 
 import epu.tevent as tevent
 from epu.exceptions import NotFoundError, WriteConflictError
 from epu import zkutil
-from epu.states import ProcessDispatcherState, ExecutionResourceState
+from epu.processdispatcher import names
+from epu.states import ProcessDispatcherState, ExecutionResourceState, \
+    ProcessState
 from epu.util import parse_datetime
 
 log = logging.getLogger(__name__)
 
+# number of recent start and dispatch times kept on each process record.
+# older times are dropped, but the counts and the latest times are kept.
+PROCESS_HISTORY_SIZE = 10
+
+# processes in these states are kept in a per-state index, so they can be
+# found without reading every process record. A process is added to the
+# index before it is written in the state, but is only removed from it
+# lazily, so the index may include processes which have since moved on.
+INDEXED_PROCESS_STATES = (ProcessState.UNSCHEDULED_PENDING,)
+
 
 def get_processdispatcher_store(config, use_gevent=False):
     """Instantiate PD store object for the given configuration
@@ -60,8 +72,14 @@ class ProcessDispatcherStore(object):
 
         self.definitions = {}
 
+        self.engines = {}
+        self.engine_set_watches = []
+
         self.processes = {}
         self.process_watches = {}
+        self.process_set_watches = []
+        self.indexed_processes = dict((state, set())
+                                      for state in INDEXED_PROCESS_STATES)
 
         self.queued_processes = []
         self.queued_process_set_watches = []
@@ -70,6 +88,9 @@ class ProcessDispatcherStore(object):
         self.resource_set_watches = []
         self.resource_watches = {}
 
+        self.resource_heartbeats = {}
+        self.resource_heartbeat_watches = {}
+
         self.nodes = {}
         self.node_set_watches = []
         self.node_watches = {}
@@ -258,6 +279,49 @@ class ProcessDispatcherStore(object):
         """
         return self.definitions.keys()
 
+    #########################################################################
+    # ENGINES
+    #########################################################################
+
+    def add_engine(self, engine_id, definition):
+        """Adds an execution engine definition
+
+        The definition is a dict of EngineSpec parameters, including slots.
+        Raises WriteConflictError if the engine already exists
+        """
+        with self.lock:
+            if engine_id in self.engines:
+                raise WriteConflictError("engine %s already exists" % engine_id)
+
+            self.engines[engine_id] = json.dumps(definition)
+            self._fire_engine_set_watchers()
+
+    def _fire_engine_set_watchers(self):
+        # expected to be called under lock
+        if self.engine_set_watches:
+            for watcher in self.engine_set_watches:
+                watcher()
+            self.engine_set_watches[:] = []
+
+    def get_engine(self, engine_id):
+        """Retrieve an engine definition dict or None if not found
+        """
+        found = self.engines.get(engine_id)
+        if found is None:
+            return None
+        return json.loads(found)
+
+    def get_engine_ids(self, watcher=None):
+        """Retrieve IDs of stored engines and optionally watch for new ones
+        """
+        with self.lock:
+            if watcher:
+                if not callable(watcher):
+                    raise ValueError("watcher is not callable")
+
+                self.engine_set_watches.append(watcher)
+            return self.engines.keys()
+
     #########################################################################
     # PROCESSES
     #########################################################################
@@ -277,6 +341,11 @@ class ProcessDispatcherStore(object):
             self.processes[key] = data, 0
             process.metadata['version'] = 0
 
+            if process.state in self.indexed_processes:
+                self.indexed_processes[process.state].add(key)
+
+            self._fire_process_set_watchers()
+
     def update_process(self, process, force=False):
         """Updates an existing process record
 
@@ -312,6 +381,9 @@ class ProcessDispatcherStore(object):
             self.processes[key] = data, version + 1
             process.metadata['version'] = version + 1
 
+            if process.state in self.indexed_processes:
+                self.indexed_processes[process.state].add(key)
+
             self._fire_process_watchers(process.owner, process.upid)
 
     def get_process(self, owner, upid, watcher=None):
@@ -340,6 +412,17 @@ class ProcessDispatcherStore(object):
 
             return process
 
+    def get_processes(self, process_ids, watcher=None):
+        """Retrieve many process records at once
+
+        process_ids is a sequence of (owner, upid) pairs. Returns a list of
+        process records in the same order, with None for any not found. If
+        provided, watcher is set on each record found, as in get_process().
+        """
+        with self.lock:
+            return [self.get_process(owner, upid, watcher=watcher)
+                    for owner, upid in process_ids]
+
     def remove_process(self, owner, upid):
         """Remove process record from store
         """
@@ -348,13 +431,70 @@ class ProcessDispatcherStore(object):
             if key not in self.processes:
                 raise NotFoundError()
             del self.processes[key]
+            for indexed in self.indexed_processes.itervalues():
+                indexed.discard(key)
+
+            self._fire_process_watchers(owner, upid)
+            self._fire_process_set_watchers()
 
-    def get_process_ids(self):
-        """Retrieve available process IDs
+    def get_process_ids(self, watcher=None):
+        """Retrieve available process IDs and optionally watch for changes
         """
         with self.lock:
+            if watcher:
+                if not callable(watcher):
+                    raise ValueError("watcher is not callable")
+
+                self.process_set_watches.append(watcher)
             return self.processes.keys()
 
+    def _fire_process_set_watchers(self):
+        # expected to be called under lock
+        if self.process_set_watches:
+            for watcher in self.process_set_watches:
+                watcher()
+            self.process_set_watches[:] = []
+
+    def get_process_ids_by_state(self, state):
+        """Retrieve IDs of processes which may be in an indexed state
+
+        Every process in the state is included, but so may be processes
+        which have since left it.
+        """
+        with self.lock:
+            if state not in self.indexed_processes:
+                raise ValueError("process state %s is not indexed" % state)
+            return list(self.indexed_processes[state])
+
+    def index_process_state(self, owner, upid, state):
+        """Add a process to the index of a process state
+        """
+        with self.lock:
+            if state not in self.indexed_processes:
+                raise ValueError("process state %s is not indexed" % state)
+            self.indexed_processes[state].add((owner, upid))
+
+    def unindex_process_state(self, process, state):
+        """Remove a process from the index of a process state
+
+        The process is only removed if it is not in the state and its record
+        is unchanged in the store. Returns True if it was removed.
+        """
+        with self.lock:
+            if state not in self.indexed_processes:
+                raise ValueError("process state %s is not indexed" % state)
+            if process.state == state:
+                return False
+
+            key = (process.owner, process.upid)
+            found = self.processes.get(key)
+            if found is None or found[1] != process.metadata.get('version'):
+                return False
+            if key not in self.indexed_processes[state]:
+                return False
+            self.indexed_processes[state].remove(key)
+            return True
+
     def _fire_process_watchers(self, owner, upid):
         # expected to be called under lock
         watchers = self.process_watches.get((owner, upid))
@@ -380,6 +520,20 @@ class ProcessDispatcherStore(object):
             self.queued_processes.append(key)
             self._fire_queued_process_set_watchers()
 
+    def enqueue_processes(self, keys):
+        """Mark several processes as runnable, in order
+
+        Watchers of the queue see a single change for the whole batch.
+
+        @param keys: sequence of (owner, upid, round) tuples
+        """
+        keys = list(keys)
+        if not keys:
+            return
+        with self.lock:
+            self.queued_processes.extend(keys)
+            self._fire_queued_process_set_watchers()
+
     def _fire_queued_process_set_watchers(self):
     # expected to be called under lock
         if self.queued_process_set_watches:
@@ -615,9 +769,52 @@ class ProcessDispatcherStore(object):
             if resource_id not in self.resources:
                 raise NotFoundError()
             del self.resources[resource_id]
+            if self.resource_heartbeats.pop(resource_id, None) is not None:
+                self._fire_resource_heartbeat_watchers(resource_id)
 
             self._fire_resource_set_watchers()
 
+    def _fire_resource_heartbeat_watchers(self, resource_id):
+        # expected to be called under lock
+        watchers = self.resource_heartbeat_watches.get(resource_id)
+        if watchers:
+            for watcher in watchers:
+                watcher(resource_id)
+            watchers[:] = []
+
+    def set_resource_heartbeat(self, resource_id, timestamp):
+        """Record the timestamp of the latest heartbeat from a resource
+
+        Heartbeat timestamps are kept apart from resource records, so a
+        heartbeat doesn't change the resource record or its version. A
+        heartbeat from a resource which is not in the store is dropped.
+        """
+        with self.lock:
+            if resource_id not in self.resources:
+                return
+            self.resource_heartbeats[resource_id] = timestamp
+            self._fire_resource_heartbeat_watchers(resource_id)
+
+    def get_resource_heartbeat(self, resource_id, watcher=None):
+        """Retrieve the timestamp of the latest heartbeat from a resource
+
+        Returns None if no heartbeat timestamp has been recorded apart from
+        the resource record. If provided, watcher is called with the
+        resource_id when the timestamp changes.
+        """
+        with self.lock:
+            if watcher:
+                if not callable(watcher):
+                    raise ValueError("watcher is not callable")
+
+                watches = self.resource_heartbeat_watches.get(resource_id)
+                if watches is None:
+                    self.resource_heartbeat_watches[resource_id] = [watcher]
+                else:
+                    watches.append(watcher)
+
+            return self.resource_heartbeats.get(resource_id)
+
     def get_resource_ids(self, watcher=None):
         """Retrieve available resource IDs and optionally watch for changes
         """
@@ -629,6 +826,57 @@ class ProcessDispatcherStore(object):
                 self.resource_set_watches.append(watcher)
             return self.resources.keys()
 
+    #########################################################################
+    # ASSIGNMENTS
+    #########################################################################
+
+    def commit_assignment(self, resource, processes, node=None):
+        """Atomically write a resource record and the processes assigned to it
+
+        The resource record and each process record are written together and
+        each process is removed from the queue, if it is still queued. If a
+        node record is given, it is written as well, so node exclusive tags
+        go out with the placements that need them. Records are versioned as
+        in update_resource(), update_process() and update_node(): if any of
+        them has changed in the store, nothing is written and a
+        WriteConflictError is raised. If any record does not exist, a
+        NotFoundError is raised.
+        """
+        with self.lock:
+            records = [(self.resources.get(resource.resource_id), resource)]
+            for process in processes:
+                records.append((self.processes.get((process.owner, process.upid)),
+                                process))
+            if node is not None:
+                records.append((self.nodes.get(node.node_id), node))
+
+            for found, record in records:
+                if found is None:
+                    raise NotFoundError()
+                version = record.metadata.get('version')
+                if version != found[1]:
+                    raise WriteConflictError("version mismatch. " +
+                                             "current=%s, attempted to write %s" %
+                                             (version, found[1]))
+
+            # everything checks out and we hold the lock, so none of these
+            # writes can fail
+            self.update_resource(resource)
+            for process in processes:
+                self.update_process(process)
+            if node is not None:
+                self.update_node(node)
+
+            dequeued = False
+            for process in processes:
+                try:
+                    self.queued_processes.remove(process.key)
+                    dequeued = True
+                except ValueError:
+                    pass
+            if dequeued:
+                self._fire_queued_process_set_watchers()
+
 
 class ProcessDispatcherZooKeeperStore(object):
     """
@@ -655,12 +903,25 @@ class ProcessDispatcherZooKeeperStore(object):
 
     PROCESSES_PATH = "/processes"
 
+    # index of processes in each of INDEXED_PROCESS_STATES
+    PROCESSES_BY_STATE_PATH = "/processes_by_state"
+
     DEFINITIONS_PATH = "/definitions"
 
+    # execution engines added while the system runs. Engines from the
+    # configuration are not stored.
+    ENGINES_PATH = "/engines"
+
     QUEUED_PROCESSES_PATH = "/requested"
 
+    # maximum number of processes queued in a single transaction
+    ENQUEUE_BATCH_SIZE = 100
+
     RESOURCES_PATH = "/resources"
 
+    # heartbeat timestamps of execution resources, apart from the records
+    HEARTBEATS_PATH = "/heartbeats"
+
     # these paths is used for leader election. PD workers line up for
     # an exclusive lock on leadership.
     MATCHMAKER_ELECTION_PATH = "/elections/matchmaker"
@@ -691,15 +952,27 @@ class ProcessDispatcherZooKeeperStore(object):
         self._matchmaker = None
         self._doctor = None
 
+        # (owner, upid, round) -> queue entry znode name, including its
+        # sequence number. Lets queue entries be removed without listing
+        # the entire queue. It is only filled from get_queued_processes()
+        # listings, so it stays bounded by the queue on the matchmaker and
+        # empty on other workers. Entries may be stale, so a failed delete
+        # falls back to a listing.
+        self._queued_process_names = {}
+
     def initialize(self):
         self._shutdown = False
         self.kazoo.start()
 
         for path in (self.NODES_PATH, self.PROCESSES_PATH,
-                     self.DEFINITIONS_PATH, self.QUEUED_PROCESSES_PATH,
-                     self.RESOURCES_PATH, self.MATCHMAKER_ELECTION_PATH,
+                     self.DEFINITIONS_PATH, self.ENGINES_PATH,
+                     self.QUEUED_PROCESSES_PATH,
+                     self.RESOURCES_PATH, self.HEARTBEATS_PATH,
+                     self.MATCHMAKER_ELECTION_PATH,
                      self.DOCTOR_ELECTION_PATH, self.PARTY_PATH):
             self.retry(self.kazoo.ensure_path, path)
+        for state in INDEXED_PROCESS_STATES:
+            self.retry(self.kazoo.ensure_path, self._make_process_state_path(state))
 
         # the Process Dispatcher is in the UNINITIALIZED state until
         # one or both of the following conditions is true:
@@ -977,19 +1250,56 @@ class ProcessDispatcherZooKeeperStore(object):
         return definition_ids
 
     #########################################################################
-    # PROCESSES
+    # ENGINES
     #########################################################################
 
-    def _make_process_path(self, owner=None, upid=None):
-        if upid is None:
-            raise ValueError('invalid process upid')
+    def _make_engine_path(self, engine_id):
+        if not engine_id:
+            raise ValueError('invalid engine id')
 
-        path = self.PROCESSES_PATH + "/"
-        if owner is not None:
-            path += "owner=" + owner + "&"
-        path += "upid=" + upid
+        return self.ENGINES_PATH + "/" + engine_id
 
-        return path
+    def add_engine(self, engine_id, definition):
+        """Adds an execution engine definition
+
+        The definition is a dict of EngineSpec parameters, including slots.
+        Raises WriteConflictError if the engine already exists
+        """
+        data = json.dumps(definition)
+        zkutil.check_data(data)
+
+        try:
+            self.retry(self.kazoo.create, self._make_engine_path(engine_id), data)
+        except NodeExistsException:
+            raise WriteConflictError("engine %s already exists" % engine_id)
+
+    def get_engine(self, engine_id):
+        """Retrieve an engine definition dict or None if not found
+        """
+        try:
+            data, stat = self.retry(self.kazoo.get,
+                self._make_engine_path(engine_id))
+        except NoNodeException:
+            return None
+
+        return json.loads(data)
+
+    def get_engine_ids(self, watcher=None):
+        """Retrieve IDs of stored engines and optionally watch for new ones
+        """
+        if watcher:
+            if not callable(watcher):
+                raise ValueError("watcher is not callable")
+
+        return self.retry(self.kazoo.get_children, self.ENGINES_PATH,
+            watch=watcher)
+
+    #########################################################################
+    # PROCESSES
+    #########################################################################
+
+    def _make_process_path(self, owner=None, upid=None):
+        return self.PROCESSES_PATH + "/" + names.make_process_name(owner, upid)
 
     def add_process(self, process):
         """Adds a new process record to the store
@@ -1000,6 +1310,9 @@ class ProcessDispatcherZooKeeperStore(object):
         data = json.dumps(process)
         zkutil.check_data(data)
 
+        if process.state in INDEXED_PROCESS_STATES:
+            self.index_process_state(process.owner, process.upid, process.state)
+
         try:
             self.retry(self.kazoo.create,
                 self._make_process_path(owner=process.owner, upid=process.upid),
@@ -1031,6 +1344,9 @@ class ProcessDispatcherZooKeeperStore(object):
         if version is None and not force:
             raise ValueError("process has no version and force=False")
 
+        if process.state in INDEXED_PROCESS_STATES:
+            self.index_process_state(process.owner, process.upid, process.state)
+
         try:
             if force:
                 set_version = -1
@@ -1044,18 +1360,33 @@ class ProcessDispatcherZooKeeperStore(object):
 
         process.metadata['version'] = version + 1
 
+    def _process_watcher_wrapper(self, watched_event, watcher=None):
+        # Extract process owner and upid from the watched_event object
+        match = re.match(r'^%s/(.*)$' % self.PROCESSES_PATH, watched_event.path)
+        if match is None:
+            raise AttributeError("could not parse watched_event %s" % str(watched_event))
+
+        owner, upid = names.parse_process_name(match.group(1))
+        if watcher is not None:
+            watcher(owner, upid)
+
     def get_process(self, owner, upid, watcher=None):
         """Retrieve process record
+
+        If provided, watcher is called with (owner, upid) when the record
+        changes or is removed.
         """
         path = self._make_process_path(owner=owner, upid=upid)
 
+        watch = None
         if watcher:
             if not callable(watcher):
                 raise ValueError("watcher is not callable")
+            watch = partial(self._process_watcher_wrapper, watcher=watcher)
 
         try:
             data, stat = self.retry(self.kazoo.get,
-                path, watch=watcher)
+                path, watch=watch)
         except NoNodeException:
             return None
 
@@ -1065,6 +1396,45 @@ class ProcessDispatcherZooKeeperStore(object):
 
         return process
 
+    def get_processes(self, process_ids, watcher=None):
+        """Retrieve many process records at once
+
+        process_ids is a sequence of (owner, upid) pairs. Returns a list of
+        process records in the same order, with None for any not found. All
+        of the reads are sent before any reply is waited on. If provided,
+        watcher is set on each record found, as in get_process().
+        """
+        paths = [self._make_process_path(owner=owner, upid=upid)
+                 for owner, upid in process_ids]
+
+        watch = None
+        if watcher:
+            if not callable(watcher):
+                raise ValueError("watcher is not callable")
+            watch = partial(self._process_watcher_wrapper, watcher=watcher)
+
+        def get_all():
+            async_results = [self.kazoo.get_async(path, watch=watch)
+                             for path in paths]
+            results = []
+            for async_result in async_results:
+                try:
+                    results.append(async_result.get())
+                except NoNodeException:
+                    results.append(None)
+            return results
+
+        processes = []
+        for result in self.retry(get_all):
+            if result is None:
+                processes.append(None)
+                continue
+            data, stat = result
+            process = ProcessRecord(json.loads(data))
+            process.metadata['version'] = stat.version
+            processes.append(process)
+        return processes
+
     def remove_process(self, owner, upid):
         """Remove process record from store
         """
@@ -1075,49 +1445,82 @@ class ProcessDispatcherZooKeeperStore(object):
         except NoNodeException:
             raise NotFoundError()
 
-    def get_process_ids(self):
-        """Retrieve available node IDs
+        for state in INDEXED_PROCESS_STATES:
+            try:
+                self.retry(self.kazoo.delete,
+                    self._make_process_state_path(state, owner=owner, upid=upid))
+            except NoNodeException:
+                pass
+
+    def get_process_ids(self, watcher=None):
+        """Retrieve available process IDs and optionally watch for changes
         """
-        process_ids = []
-        processes = self.kazoo.get_children(self.PROCESSES_PATH)
+        if watcher:
+            if not callable(watcher):
+                raise ValueError("watcher is not callable")
 
-        for p in processes:
-            owner = None
+        processes = self.retry(self.kazoo.get_children, self.PROCESSES_PATH,
+            watch=watcher)
+        return [names.parse_process_name(p) for p in processes]
 
-            match = re.match(r'^owner=(.+)&upid=(.+)$', p)
-            if match is not None:
-                owner = match.group(1)
-                upid = match.group(2)
-            else:
-                match = re.match(r'^upid=(.+)$', p)
-                if match is None:
-                    raise ValueError("queued process %s could not be parsed" % p)
-                upid = match.group(1)
+    def _make_process_state_path(self, state, owner=None, upid=None):
+        if state not in INDEXED_PROCESS_STATES:
+            raise ValueError("process state %s is not indexed" % state)
 
-            process_ids.append((owner, upid))
+        path = self.PROCESSES_BY_STATE_PATH + "/" + state
+        if upid is not None:
+            path += "/" + names.make_process_name(owner, upid)
+        return path
 
-        return process_ids
+    def get_process_ids_by_state(self, state):
+        """Retrieve IDs of processes which may be in an indexed state
 
-    #########################################################################
-    # QUEUED PROCESSES
-    #########################################################################
+        Every process in the state is included, but so may be processes
+        which have since left it.
+        """
+        processes = self.retry(self.kazoo.get_children,
+            self._make_process_state_path(state))
+        return [names.parse_process_name(p) for p in processes]
 
-    def _make_requested_path(self, owner=None, upid=None, round=None, seq=None):
-        if upid is None:
-            raise ValueError('invalid process upid')
-        if round is None:
-            raise ValueError('invalid process round')
+    def index_process_state(self, owner, upid, state):
+        """Add a process to the index of a process state
+        """
+        try:
+            self.retry(self.kazoo.create,
+                self._make_process_state_path(state, owner=owner, upid=upid))
+        except NodeExistsException:
+            pass
 
-        path = self.QUEUED_PROCESSES_PATH + "/"
-        if owner is not None:
-            path += "owner=" + owner + "&"
+    def unindex_process_state(self, process, state):
+        """Remove a process from the index of a process state
 
-        path += "upid=" + upid + "&round=" + str(round) + "+"
+        The process is only removed if it is not in the state and its record
+        is unchanged in the store. Returns True if it was removed.
+        """
+        path = self._make_process_state_path(state, owner=process.owner,
+            upid=process.upid)
+        if process.state == state:
+            return False
 
-        if seq is not None:
-            path += str(seq)
+        version = process.metadata.get('version')
+        if version is None:
+            raise ValueError("process has no version")
 
-        return path
+        # the index entry is removed only if the process record is not
+        # written in the meantime, which could put it back in the state
+        failed = self._commit_transaction([
+            ('check', (self._make_process_path(owner=process.owner,
+                upid=process.upid), version)),
+            ('delete', (path,))])
+        return failed is None
+
+    #########################################################################
+    # QUEUED PROCESSES
+    #########################################################################
+
+    def _make_requested_path(self, owner=None, upid=None, round=None, seq=None):
+        return self.QUEUED_PROCESSES_PATH + "/" + \
+            names.make_queued_process_name(owner, upid, round, seq)
 
     def enqueue_process(self, owner, upid, round):
         """Mark a process as runnable, to be inspected by the matchmaker
@@ -1133,6 +1536,30 @@ class ProcessDispatcherZooKeeperStore(object):
         except NodeExistsException:
             raise WriteConflictError("process %s for user %s already in queue" % (upid, owner))
 
+    def enqueue_processes(self, keys):
+        """Mark several processes as runnable, in order
+
+        Processes are queued in transactions of up to ENQUEUE_BATCH_SIZE, so
+        watchers of the queue see one change per batch rather than one per
+        process.
+
+        @param keys: sequence of (owner, upid, round) tuples
+        """
+        keys = list(keys)
+        for start in xrange(0, len(keys), self.ENQUEUE_BATCH_SIZE):
+            batch = keys[start:start + self.ENQUEUE_BATCH_SIZE]
+            operations = [('create', (self._make_requested_path(owner=owner,
+                upid=upid, round=round), "", None, False, True))
+                for owner, upid, round in batch]
+
+            failed = self._commit_transaction(operations)
+            if failed is not None:
+                index, error = failed
+                owner, upid, round = batch[index]
+                if isinstance(error, NodeExistsException):
+                    raise WriteConflictError("process %s for user %s already in queue" % (upid, owner))
+                raise error
+
     def get_queued_processes(self, watcher=None):
         """Get the queued processes and optionally set a watcher for changes
 
@@ -1148,61 +1575,62 @@ class ProcessDispatcherZooKeeperStore(object):
             self.QUEUED_PROCESSES_PATH, watch=watcher)
 
         for p in processes:
-            owner = None
-            match = re.match(r'^owner=(.+)&upid=(.+)&round=([0-9]+)\+([0-9]+)$', p)
-            if match is not None:
-                owner = match.group(1)
-                upid = match.group(2)
-                round = int(match.group(3))
-                seq = match.group(4)
-            else:
-                match = re.match(r'^upid=(.+)&round=([0-9]+)\+([0-9]+)$', p)
-                if match is None:
-                    raise ValueError("queued process %s could not be parsed" % p)
-                upid = match.group(1)
-                round = int(match.group(2))
-                seq = match.group(3)
+            owner, upid, round, seq = names.parse_queued_process_name(p)
+            queued_processes.append((seq, (owner, upid, round), p))
 
-            queued_processes.append((seq, (owner, upid, round)))
+        queued_processes.sort()
 
-        return map(lambda x: x[1], sorted(queued_processes))
+        queued_names = {}
+        for _, key, name in queued_processes:
+            queued_names.setdefault(key, name)
+        self._queued_process_names = queued_names
+
+        return [key for _, key, _ in queued_processes]
 
     def remove_queued_process(self, owner, upid, round):
         """Remove a process from the runnable queue
         """
-        processes = self.retry(self.kazoo.get_children,
-            self.QUEUED_PROCESSES_PATH)
-
-        seq = None
-        # Find a zknode that matches this process
-        for p in processes:
-            p_owner = None
-            match = re.match(r'^owner=(.+)&upid=(.+)&round=([0-9]+)\+([0-9]+)$', p)
-            if match is not None:
-                p_owner = match.group(1)
-                p_upid = match.group(2)
-                p_round = int(match.group(3))
-                p_seq = match.group(4)
-            else:
-                match = re.match(r'^upid=(.+)&round=([0-9]+)\+([0-9]+)$', p)
-                if match is None:
-                    raise ValueError("queued process %s could not be parsed" % p)
-                p_upid = match.group(1)
-                p_round = int(match.group(2))
-                p_seq = match.group(3)
-            if owner == p_owner and upid == p_upid and round == p_round:
-                seq = p_seq
-                break
+        key = (owner, upid, round)
+        name = self._queued_process_names.pop(key, None)
+        if name is not None:
+            try:
+                self.retry(self.kazoo.delete,
+                    self.QUEUED_PROCESSES_PATH + "/" + name)
+                return
+            except NoNodeException:
+                # stale entry. look for the process the slow way.
+                pass
 
-        if seq is None:
+        path = self._find_queued_process_path(owner, upid, round,
+                                              use_index=False)
+        if path is None:
             raise NotFoundError("queue process (%s, %s, %s) could not be found" % (owner, upid, str(round)))
 
-        path = self._make_requested_path(owner=owner, upid=upid, round=round, seq=seq)
+        self._queued_process_names.pop(key, None)
         try:
             self.retry(self.kazoo.delete, path)
         except NoNodeException:
             raise NotFoundError()
 
+    def _find_queued_process_path(self, owner, upid, round, use_index=True):
+        """Find the queue entry path for a process, or None if it is not queued
+        """
+        if use_index:
+            name = self._queued_process_names.get((owner, upid, round))
+            if name is not None:
+                return self.QUEUED_PROCESSES_PATH + "/" + name
+
+        processes = self.retry(self.kazoo.get_children,
+            self.QUEUED_PROCESSES_PATH)
+
+        # Find a zknode that matches this process
+        for p in processes:
+            p_owner, p_upid, p_round, _ = names.parse_queued_process_name(p)
+            if owner == p_owner and upid == p_upid and round == p_round:
+                return self.QUEUED_PROCESSES_PATH + "/" + p
+
+        return None
+
     def clear_queued_processes(self):
         """Reset the process queue
         """
@@ -1211,6 +1639,7 @@ class ProcessDispatcherZooKeeperStore(object):
         for process in processes:
             self.retry(self.kazoo.delete,
                 "%s/%s" % (self.QUEUED_PROCESSES_PATH, process))
+        self._queued_process_names.clear()
 
     #########################################################################
     # NODES
@@ -1387,11 +1816,100 @@ class ProcessDispatcherZooKeeperStore(object):
         """Remove a resource from the store
         """
         path = self._make_resource_path(resource_id)
+        heartbeat_path = self._make_heartbeat_path(resource_id)
+
+        # the heartbeat timestamp is removed in the same transaction. If none
+        # has been recorded, one is created and deleted instead, so that a
+        # heartbeat recorded concurrently can't outlive the resource.
+        heartbeat_operations = [('delete', (heartbeat_path,))]
+        while True:
+            failed = self._commit_transaction(
+                [('delete', (path,))] + heartbeat_operations)
+            if failed is None:
+                return
+
+            index, error = failed
+            if index == 0:
+                if isinstance(error, NoNodeException):
+                    raise NotFoundError()
+                raise error
+
+            if isinstance(error, NoNodeException):
+                heartbeat_operations = [('create', (heartbeat_path, "")),
+                                        ('delete', (heartbeat_path,))]
+            elif isinstance(error, NodeExistsException):
+                heartbeat_operations = [('delete', (heartbeat_path,))]
+            else:
+                raise error
 
+    def _make_heartbeat_path(self, resource_id):
+        if resource_id is None:
+            raise ValueError('invalid resource_id')
+
+        return self.HEARTBEATS_PATH + "/" + resource_id
+
+    def _heartbeat_watcher_wrapper(self, watched_event, watcher=None):
+        match = re.match(r'^%s/(.*)$' % self.HEARTBEATS_PATH, watched_event.path)
+        if match is None:
+            raise AttributeError("could not parse watched_event %s" % str(watched_event))
+
+        if watcher is not None:
+            watcher(match.group(1))
+
+    def set_resource_heartbeat(self, resource_id, timestamp):
+        """Record the timestamp of the latest heartbeat from a resource
+
+        Heartbeat timestamps are kept apart from resource records, so a
+        heartbeat doesn't change the resource record or its version. A
+        heartbeat from a resource which is not in the store is dropped.
+        """
+        path = self._make_heartbeat_path(resource_id)
+        data = str(timestamp)
         try:
-            self.retry(self.kazoo.delete, path)
+            self.retry(self.kazoo.set, path, data)
+            return
         except NoNodeException:
-            raise NotFoundError()
+            pass
+
+        # the first heartbeat is only created alongside a check that the
+        # resource still exists, so it can't outlive a concurrent removal
+        failed = self._commit_transaction([
+            ('check', (self._make_resource_path(resource_id), -1)),
+            ('create', (path, data))])
+        if failed is None:
+            return
+
+        index, error = failed
+        if index == 0 and isinstance(error, NoNodeException):
+            return
+        if index == 1 and isinstance(error, NodeExistsException):
+            self.retry(self.kazoo.set, path, data)
+            return
+        raise error
+
+    def get_resource_heartbeat(self, resource_id, watcher=None):
+        """Retrieve the timestamp of the latest heartbeat from a resource
+
+        Returns None if no heartbeat timestamp has been recorded apart from
+        the resource record. If provided, watcher is called with the
+        resource_id when the timestamp changes.
+        """
+        path = self._make_heartbeat_path(resource_id)
+
+        watch = None
+        if watcher:
+            if not callable(watcher):
+                raise ValueError("watcher is not callable")
+            watch = partial(self._heartbeat_watcher_wrapper, watcher=watcher)
+
+        try:
+            data, stat = self.retry(self.kazoo.get, path, watch=watch)
+        except NoNodeException:
+            if watch:
+                # watch for the first heartbeat to be recorded
+                self.retry(self.kazoo.exists, path, watch=watch)
+            return None
+        return data
 
     def get_resource_ids(self, watcher=None):
         """Retrieve available resource IDs and optionally watch for changes
@@ -1405,6 +1923,107 @@ class ProcessDispatcherZooKeeperStore(object):
             self.RESOURCES_PATH, watch=watcher)
         return resource_ids
 
+    #########################################################################
+    # ASSIGNMENTS
+    #########################################################################
+
+    def commit_assignment(self, resource, processes, node=None):
+        """Atomically write a resource record and the processes assigned to it
+
+        The resource record and each process record are written together and
+        each process is removed from the queue, if it is still queued. If a
+        node record is given, it is written as well, so node exclusive tags
+        go out with the placements that need them. Records are versioned as
+        in update_resource(), update_process() and update_node(): if any of
+        them has changed in the store, nothing is written and a
+        WriteConflictError is raised. If any record does not exist, a
+        NotFoundError is raised.
+        """
+        records = [(self._make_resource_path(resource.resource_id), resource)]
+        for process in processes:
+            records.append((self._make_process_path(owner=process.owner,
+                upid=process.upid), process))
+        if node is not None:
+            records.append((self._make_node_path(node.node_id), node))
+
+        operations = []
+        for path, record in records:
+            data = json.dumps(record)
+            zkutil.check_data(data)
+            version = record.metadata.get('version')
+            if version is None:
+                raise ValueError("record has no version")
+            operations.append(('set_data', (path, data, version)))
+
+        for process in processes:
+            if process.state in INDEXED_PROCESS_STATES:
+                self.index_process_state(process.owner, process.upid, process.state)
+
+        queued = []
+        for process in processes:
+            path = self._find_queued_process_path(*process.key)
+            if path is not None:
+                queued.append((process.key, path))
+
+        while True:
+            dequeue = [('delete', (queued_path,)) for _, queued_path in queued]
+            failed = self._commit_transaction(operations + dequeue)
+            if failed is None:
+                break
+
+            index, error = failed
+            if index >= len(operations) and isinstance(error, NoNodeException):
+                # the queue entry is gone or our index of it was stale. the
+                # whole transaction was rolled back, so look it up again and
+                # retry with it, or without it if it really is gone.
+                key, stale_path = queued.pop(index - len(operations))
+                self._queued_process_names.pop(key, None)
+                path = self._find_queued_process_path(*key, use_index=False)
+                if path is not None and path != stale_path:
+                    queued.append((key, path))
+                continue
+            if isinstance(error, BadVersionException):
+                raise WriteConflictError()
+            if isinstance(error, NoNodeException):
+                raise NotFoundError()
+            raise error
+
+        for _, record in records:
+            record.metadata['version'] += 1
+        for process in processes:
+            self._queued_process_names.pop(process.key, None)
+
+    def _commit_transaction(self, operations):
+        """Commit a list of (method, args) operations in a single transaction
+
+        Returns None on success, or an (index, exception) tuple describing the
+        operation which caused the transaction to be rolled back.
+        """
+        return _find_transaction_failure(
+            self._commit_transaction_results(operations))
+
+    def _commit_transaction_results(self, operations):
+        """Commit a list of (method, args) operations and return the results
+        """
+        def commit():
+            # a transaction can only be committed once, so build a fresh one
+            # for each retry attempt
+            transaction = self.kazoo.transaction()
+            for method, args in operations:
+                getattr(transaction, method)(*args)
+            return transaction.commit()
+
+        return self.retry(commit)
+
+
+def _find_transaction_failure(results):
+    """Return (index, exception) of the operation which rolled back a transaction
+    """
+    for index, result in enumerate(results):
+        if isinstance(result, Exception) and not isinstance(result, RolledBackError):
+            return index, result
+    return None
+
 
 class Record(dict):
     __slots__ = ['metadata']
@@ -1438,7 +2057,7 @@ class ProcessRecord(Record):
     def new(cls, owner, upid, definition, state, configuration=None,
             constraints=None, subscribers=None, round=0, assigned=None,
             hostname=None, queueing_mode=None, restart_mode=None,
-            node_exclusive=None, name=None):
+            node_exclusive=None, name=None, priority=None):
 
         definition = copy.deepcopy(definition)
 
@@ -1462,16 +2081,50 @@ class ProcessRecord(Record):
                  queueing_mode=queueing_mode, restart_mode=restart_mode,
                  starts=starts, node_exclusive=node_exclusive, name=name,
                  start_times=start_times, dispatches=dispatches,
-                 dispatch_times=dispatch_times)
+                 dispatch_times=dispatch_times, priority=priority,
+                 last_start_time=None, last_dispatch_time=None)
         return cls(d)
 
     def increment_starts(self):
         self.starts += 1
-        self.start_times.append(time.time())
+        self.last_start_time = self._append_time('start_times')
 
     def increment_dispatches(self):
         self.dispatches += 1
-        self.dispatch_times.append(time.time())
+        self.last_dispatch_time = self._append_time('dispatch_times')
+
+    def get_last_start_time(self):
+        """Returns the time of the most recent start, or None
+        """
+        return self._get_last_time('last_start_time', 'start_times')
+
+    def get_last_dispatch_time(self):
+        """Returns the time of the most recent dispatch, or None
+        """
+        return self._get_last_time('last_dispatch_time', 'dispatch_times')
+
+    def _append_time(self, key):
+        """Append the current time to a bounded list of recent times
+
+        Records written before the lists were bounded may hold any number
+        of times. They are trimmed here.
+        """
+        now = time.time()
+        times = self.get(key) or []
+        times.append(now)
+        if len(times) > PROCESS_HISTORY_SIZE:
+            times = times[-PROCESS_HISTORY_SIZE:]
+        self[key] = times
+        return now
+
+    def _get_last_time(self, last_key, times_key):
+        last_time = self.get(last_key)
+        if last_time is None:
+            # records written before the latest time was kept
+            times = self.get(times_key)
+            if times:
+                last_time = max(times)
+        return last_time
 
     def get_key(self):
         return self.owner, self.upid, self.round
@@ -1514,12 +2167,14 @@ class ResourceRecord(Record):
     def available_slots(self):
         return max(0, self.slot_count - len(self.assigned))
 
-    def is_assigned(self, owner, upid, round):
-        t = (owner, upid, round)
+    def assigned_keys(self):
+        """Yields assignments as hashable (owner, upid, round) tuples
+        """
         for assignment in self.assigned:
-            if t == tuple(assignment):
-                return True
-        return False
+            yield tuple(assignment)
+
+    def is_assigned(self, owner, upid, round):
+        return (owner, upid, round) in set(self.assigned_keys())
 
 
 class NodeRecord(Record):
@@ -1,9 +1,10 @@
 # Copyright 2013 University of Chicago
 
+import threading
 import unittest
 import uuid
 
-from mock import Mock
+from mock import Mock, patch
 
 from epu.states import InstanceState, ProcessState, ExecutionResourceState
 from epu.processdispatcher.core import ProcessDispatcherCore
@@ -114,6 +115,99 @@ class ProcessDispatcherCoreTests(unittest.TestCase):
         self.assertNotIn(proc3.key, queued_processes)
         self.notifier.assert_process_state("proc3", ProcessState.TERMINATED)
 
+    def test_evacuate_nodes_concurrently(self):
+        self.core.evacuation_concurrency = 4
+
+        nodes = []
+        for i in range(3):
+            node_id = "node%d" % i
+            resource_id = "eeagent_%d" % i
+            self.core.node_state(node_id, domain_id_from_engine("engine1"),
+                InstanceState.RUNNING)
+            self.core.ee_heartbeat(resource_id, make_beat(node_id))
+
+            resource = self.store.get_resource(resource_id)
+            for j in range(4):
+                process = ProcessRecord.new(None, "proc%d_%d" % (i, j), {},
+                    ProcessState.RUNNING, assigned=resource_id)
+                self.store.add_process(process)
+                resource.assigned.append(process.key)
+            self.store.update_resource(resource)
+            nodes.append(self.store.get_node(node_id))
+
+        thread_count = threading.active_count()
+        self.core.evacuate_nodes(nodes)
+
+        # pool threads are all gone once evacuation is done
+        self.assertEqual(threading.active_count(), thread_count)
+
+        self.assertEqual(self.store.get_node_ids(), [])
+        self.assertEqual(self.store.get_resource_ids(), [])
+
+        queued_processes = set(self.store.get_queued_processes())
+        self.assertEqual(len(queued_processes), 12)
+        for owner, upid in self.store.get_process_ids():
+            proc = self.store.get_process(owner, upid)
+            self.assertEqual(proc.state, ProcessState.DIED_REQUESTED)
+            self.assertEqual(proc.round, 1)
+            self.assertIn(proc.key, queued_processes)
+
+    def test_evacuate_resources_with_failure(self):
+        self.core.evacuation_concurrency = 4
+        self.core.node_state("node1", domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+
+        resources = []
+        for i in range(2):
+            resource_id = "eeagent_%d" % i
+            self.core.ee_heartbeat(resource_id, make_beat("node1"))
+            resource = self.store.get_resource(resource_id)
+            for j in range(3):
+                process = ProcessRecord.new(None, "proc%d_%d" % (i, j), {},
+                    ProcessState.RUNNING, assigned=resource_id)
+                self.store.add_process(process)
+                resource.assigned.append(process.key)
+            self.store.update_resource(resource)
+            resource, _ = self.core.resource_change_state(resource,
+                ExecutionResourceState.MISSING)
+            resources.append(resource)
+
+        evacuate_process = self.core._evacuate_process
+
+        def failing_evacuate_process(process, *args, **kwargs):
+            if process.upid == "proc0_1":
+                raise Exception("boom")
+            return evacuate_process(process, *args, **kwargs)
+
+        with patch.object(self.core, "_evacuate_process",
+                          side_effect=failing_evacuate_process):
+            self.assertRaises(Exception, self.core.evacuate_resources, resources)
+
+        # every other process was still rescheduled and queued
+        queued_processes = set(self.store.get_queued_processes())
+        self.assertEqual(len(queued_processes), 5)
+        for owner, upid in self.store.get_process_ids():
+            proc = self.store.get_process(owner, upid)
+            if upid == "proc0_1":
+                self.assertEqual(proc.state, ProcessState.RUNNING)
+            else:
+                self.assertEqual(proc.state, ProcessState.DIED_REQUESTED)
+                self.assertIn(proc.key, queued_processes)
+
+        # the resource with the failed process keeps its assignments, so the
+        # evacuation can be retried
+        self.assertEqual(len(self.store.get_resource("eeagent_0").assigned), 3)
+        self.assertEqual(self.store.get_resource("eeagent_1").assigned, [])
+
+        # retrying only evacuates the process which failed
+        self.core.evacuate_resources([self.store.get_resource("eeagent_0")])
+        self.assertEqual(len(self.store.get_queued_processes()), 6)
+        for owner, upid in self.store.get_process_ids():
+            proc = self.store.get_process(owner, upid)
+            self.assertEqual(proc.state, ProcessState.DIED_REQUESTED)
+            self.assertEqual(proc.round, 1)
+        self.assertEqual(self.store.get_resource("eeagent_0").assigned, [])
+
     def test_terminate_not_found(self):
         # process which doesn't exist
 
@@ -233,6 +327,81 @@ class ProcessDispatcherCoreTests(unittest.TestCase):
         self.assertEqual(process.state, ProcessState.REQUESTED)
         self.assertEqual(process.upid, proc)
 
+    def test_schedule_priority(self):
+        definition = "def1"
+        self.core.create_definition(definition, None, None)
+
+        process = self.core.schedule_process(None, "proc1", definition,
+            priority=10)
+        self.assertEqual(process.priority, 10)
+        self.assertEqual(self.store.get_process(None, "proc1").priority, 10)
+
+        # rescheduling with a different priority is not fine
+        with self.assertRaises(BadRequestError):
+            self.core.schedule_process(None, "proc1", priority=5)
+
+        process = self.core.schedule_process(None, "proc2", definition)
+        self.assertIsNone(process.priority)
+
+        for priority in ("10", 1.5, True, [10]):
+            with self.assertRaises(BadRequestError):
+                self.core.schedule_process(None, "proc3", definition,
+                    priority=priority)
+        self.assertIsNone(self.store.get_process(None, "proc3"))
+
+    def test_list_processes(self):
+        definition = "def1"
+        self.core.create_definition(definition, None, None)
+
+        for i in range(10):
+            owner = "owner%d" % (i % 2)
+            engine = "engine1" if i < 5 else "engine2"
+            self.core.schedule_process(owner, "proc%d" % i, definition,
+                execution_engine_id=engine)
+        self.core.create_process(None, "proc10", definition)
+
+        result = self.core.list_processes()
+        self.assertEqual(len(result['processes']), 11)
+        self.assertIsNone(result['cursor'])
+
+        # page through with a projection
+        upids = []
+        cursor = None
+        while True:
+            result = self.core.list_processes(fields=['upid', 'state'],
+                cursor=cursor, limit=4)
+            for process in result['processes']:
+                self.assertEqual(sorted(process.keys()), ['state', 'upid'])
+                upids.append(process['upid'])
+            cursor = result['cursor']
+            if cursor is None:
+                break
+            self.assertEqual(len(result['processes']), 4)
+        self.assertEqual(sorted(upids), sorted("proc%d" % i for i in range(11)))
+
+        # filters
+        result = self.core.list_processes(states=[ProcessState.UNSCHEDULED])
+        self.assertEqual([p['upid'] for p in result['processes']], ["proc10"])
+        result = self.core.list_processes(owner="owner1", engine_id="engine2")
+        self.assertEqual(sorted(p['upid'] for p in result['processes']),
+                         ["proc5", "proc7", "proc9"])
+
+        # changes made after the index is built are picked up
+        process = self.store.get_process("owner0", "proc0")
+        process.state = ProcessState.RUNNING
+        self.store.update_process(process)
+        self.store.remove_process("owner1", "proc1")
+        result = self.core.list_processes(states=[ProcessState.RUNNING])
+        self.assertEqual([p['upid'] for p in result['processes']], ["proc0"])
+        result = self.core.list_processes(owner="owner1", fields=['upid'])
+        self.assertEqual(sorted(p['upid'] for p in result['processes']),
+                         ["proc3", "proc5", "proc7", "proc9"])
+
+        with self.assertRaises(BadRequestError):
+            self.core.list_processes(limit=0)
+        with self.assertRaises(BadRequestError):
+            self.core.list_processes(states=ProcessState.RUNNING)
+
     def test_create_idempotency(self):
         proc = "proc1"
         definition = "def1"
@@ -454,16 +623,116 @@ class ProcessDispatcherCoreTests(unittest.TestCase):
         self.core.ee_heartbeat("eeagent1", make_beat(node_id, timestamp=d1.isoformat()))
 
         resource = self.store.get_resource("eeagent1")
-        self.assertEqual(resource.last_heartbeat_datetime, d1)
+        self.assertEqual(self.core.get_resource_last_heartbeat(resource), d1)
 
         self.core.ee_heartbeat("eeagent1", make_beat(node_id, timestamp=d3.isoformat()))
         resource = self.store.get_resource("eeagent1")
-        self.assertEqual(resource.last_heartbeat_datetime, d3)
+        self.assertEqual(self.core.get_resource_last_heartbeat(resource), d3)
+
+        # heartbeat timestamps don't touch the resource record
+        self.assertEqual(resource.last_heartbeat_datetime, d1)
+        self.assertEqual(resource.metadata['version'], 0)
 
         # out of order hbeat. time shouln't be updated
         self.core.ee_heartbeat("eeagent1", make_beat(node_id, timestamp=d2.isoformat()))
         resource = self.store.get_resource("eeagent1")
-        self.assertEqual(resource.last_heartbeat_datetime, d3)
+        self.assertEqual(self.core.get_resource_last_heartbeat(resource), d3)
+
+    def test_heartbeat_fast_path(self):
+        node_id = uuid.uuid4().hex
+        self.core.node_state(node_id, domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+
+        d1 = parse_datetime("2013-04-02T19:37:57.617734+00:00")
+        d2 = parse_datetime("2013-04-02T19:38:57.617734+00:00")
+        d3 = parse_datetime("2013-04-02T19:39:57.617734+00:00")
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id, timestamp=d1))
+
+        p1 = ProcessRecord.new(None, "proc1", {}, ProcessState.RUNNING,
+            assigned="eeagent1")
+        self.store.add_process(p1)
+        resource = self.store.get_resource("eeagent1")
+        resource.assigned = [p1.key]
+        self.store.update_resource(resource)
+
+        processes = [{"upid": "proc1", "round": 0, "state": ProcessState.RUNNING}]
+
+        # the first beat with this process set is checked in full
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id, processes, d2))
+
+        # an identical beat only updates the timestamp
+        with patch.object(self.store, "get_processes") as mock_get_processes:
+            self.core.ee_heartbeat("eeagent1", make_beat(node_id, processes, d3))
+            self.assertFalse(mock_get_processes.called)
+        resource = self.store.get_resource("eeagent1")
+        self.assertEqual(self.core.get_resource_last_heartbeat(resource), d3)
+        self.assertEqual(resource.assigned, [list(p1.key)])
+
+        # once the resource record changes, beats are checked in full again
+        self.store.update_resource(resource)
+        with patch.object(self.store, "get_processes", return_value=[p1]) as mock_get_processes:
+            self.core.ee_heartbeat("eeagent1", make_beat(node_id, processes, d3))
+            self.assertTrue(mock_get_processes.called)
+
+    def test_heartbeat_fast_path_process_changed(self):
+        node_id = uuid.uuid4().hex
+        self.core.node_state(node_id, domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id))
+
+        p1 = ProcessRecord.new(None, "proc1", {}, ProcessState.RUNNING,
+            assigned="eeagent1")
+        self.store.add_process(p1)
+        resource = self.store.get_resource("eeagent1")
+        resource.assigned = [p1.key]
+        self.store.update_resource(resource)
+
+        processes = [{"upid": "proc1", "round": 0, "state": ProcessState.RUNNING}]
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id, processes))
+        self.assertIn("eeagent1", self.core.heartbeat_signatures)
+
+        # the process is restarted, which doesn't touch the resource record.
+        # An agent which missed the restart still reports the old round, and
+        # must be told to terminate it.
+        self.core.restart_process(None, "proc1")
+        self.assertNotIn("eeagent1", self.core.heartbeat_signatures)
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id, processes))
+        self.resource_client.terminate_process.assert_called_with(
+            "eeagent1", "proc1", 0)
+
+    def test_heartbeat_signature_forgotten_on_evacuation(self):
+        node_id = uuid.uuid4().hex
+        self.core.node_state(node_id, domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id))
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id))
+        self.assertIn("eeagent1", self.core.heartbeat_signatures)
+
+        self.core.evacuate_node(self.store.get_node(node_id))
+        self.assertNotIn("eeagent1", self.core.heartbeat_signatures)
+
+    def test_add_engine(self):
+        definition = {'engine_id': 'engine5', 'slots': 3, 'replicas': 2}
+        self.core.add_engine(definition)
+        self.assertEqual(definition['engine_id'], 'engine5')
+
+        engine = self.registry.get_engine_by_id('engine5')
+        self.assertEqual((engine.slots, engine.replicas), (3, 2))
+        self.assertEqual(self.store.get_engine('engine5'),
+            {'slots': 3, 'replicas': 2})
+
+        # another worker's registry picks the engine up from the store
+        registry = EngineRegistry.from_config(self.engine_conf)
+        registry.follow_store(self.store)
+        self.assertEqual(registry.get_engine_by_id('engine5').slots, 3)
+
+        self.assertRaises(BadRequestError, self.core.add_engine,
+            {'engine_id': 'engine5', 'slots': 1})
+        self.assertRaises(BadRequestError, self.core.add_engine,
+            {'engine_id': 'engine1', 'slots': 1})
+        self.assertRaises(BadRequestError, self.core.add_engine, {'slots': 1})
+        self.assertRaises(BadRequestError, self.core.add_engine,
+            {'engine_id': 'engine6'})
 
     def test_get_process_constraints(self):
         """test_get_process_constraints
@@ -502,3 +771,19 @@ class ProcessDispatcherCoreTests(unittest.TestCase):
                 constraints=process_constraints)
         constraints = self.core.get_process_constraints(p3)
         self.assertEqual(constraints['engine'], "mostimportantengine")
+
+        # the process record itself is left alone
+        p4 = ProcessRecord.new(None, "proc4", process_definition, ProcessState.PENDING,
+                constraints={'hat_type': 'fedora'})
+        constraints = self.core.get_process_constraints(p4)
+        self.assertEqual(constraints, {'engine': 'engine4', 'hat_type': 'fedora'})
+        self.assertEqual(p4.constraints, {'hat_type': 'fedora'})
+
+        # constraints are worked out again when the registry changes
+        self.registry.set_process_engine_mapping("my.test", "engine2")
+        constraints = self.core.get_process_constraints(p4)
+        self.assertEqual(constraints['engine'], "engine2")
+
+        self.registry.default = "engine3"
+        constraints = self.core.get_process_constraints(p1)
+        self.assertEqual(constraints['engine'], "engine3")
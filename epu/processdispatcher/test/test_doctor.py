@@ -6,16 +6,19 @@ import time
 import uuid
 from datetime import timedelta, datetime
 
-from mock import Mock
+from mock import Mock, patch
 
 import epu.tevent as tevent
-from epu.processdispatcher.doctor import PDDoctor, ExecutionResourceMonitor
+import epu.processdispatcher.doctor
+from epu.processdispatcher.doctor import PDDoctor, ExecutionResourceMonitor, \
+    _ResourceChecks
 from epu.processdispatcher.core import ProcessDispatcherCore
 from epu.processdispatcher.modes import RestartMode
 from epu.processdispatcher.store import ProcessDispatcherStore, ProcessDispatcherZooKeeperStore
 from epu.processdispatcher.test.mocks import MockResourceClient, MockNotifier
 from epu.processdispatcher.store import ProcessRecord
-from epu.processdispatcher.engines import EngineRegistry, domain_id_from_engine
+from epu.processdispatcher.engines import EngineRegistry, EngineSpec, \
+    domain_id_from_engine
 from epu.states import ProcessState, InstanceState, ProcessDispatcherState, ExecutionResourceState
 from epu.processdispatcher.test.test_store import StoreTestMixin
 from epu.processdispatcher.test.mocks import nosystemrestart_process_config, make_beat
@@ -144,6 +147,10 @@ class PDDoctorTests(unittest.TestCase, StoreTestMixin):
             self.assertEqual(self.store.get_process(None, proc).state,
                              ProcessState.REQUESTED)
 
+        # and are no longer indexed as pending
+        self.assertEqual(self.store.get_process_ids_by_state(
+            ProcessState.UNSCHEDULED_PENDING), [])
+
     def test_uninitialized_system_boot_without_state(self):
         self.store.set_system_boot(True)
         self._run_in_thread()
@@ -370,6 +377,166 @@ class PDDoctorTests(unittest.TestCase, StoreTestMixin):
         states[r2] = ExecutionResourceState.DISABLED
         self.assert_monitor_cycle(10, states)
 
+    def test_resource_monitor_mass_missing(self):
+        t0 = datetime(2012, 3, 13, 9, 30, 0, tzinfo=UTC)
+        mock_now = Mock()
+        mock_now.return_value = t0
+
+        monitor = self._setup_resource_monitor()
+        monitor._now_func = mock_now
+        self.core.evacuation_concurrency = 4
+
+        self.core.node_state("node1", domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+
+        resource_ids = ["eeagent_%d" % i for i in range(5)]
+        procs = []
+        for i, resource_id in enumerate(resource_ids):
+            self._send_heartbeat(resource_id, "node1", t0)
+
+            p = ProcessRecord.new(None, "proc%d" % i, {}, ProcessState.RUNNING,
+                assigned=resource_id)
+            self.store.add_process(p)
+            procs.append(p)
+
+            resource = self.store.get_resource(resource_id)
+            resource.assigned = [p.key]
+            self.store.update_resource(resource)
+
+        states = dict((resource_id, ExecutionResourceState.OK)
+                      for resource_id in resource_ids)
+        self.assert_monitor_cycle(10, states)
+
+        mock_now.return_value = t0 + timedelta(seconds=10)
+        states = dict((resource_id, ExecutionResourceState.WARNING)
+                      for resource_id in resource_ids)
+        self.assert_monitor_cycle(10, states)
+
+        # every resource goes MISSING in the same cycle. They are evacuated
+        # together and their processes are requeued in a single batch
+        mock_now.return_value = t0 + timedelta(seconds=20)
+        states = dict((resource_id, ExecutionResourceState.MISSING)
+                      for resource_id in resource_ids)
+        with patch.object(self.store, "enqueue_processes",
+                          wraps=self.store.enqueue_processes) as mock_enqueue:
+            self.assertIsNone(monitor.monitor_cycle())
+        self.assertEqual(mock_enqueue.call_count, 1)
+
+        for resource_id in resource_ids:
+            resource = self.store.get_resource(resource_id)
+            self.assertEqual(resource.state, ExecutionResourceState.MISSING)
+            self.assertEqual(resource.assigned, [])
+
+        queued = self.store.get_queued_processes()
+        self.assertEqual(sorted(queued), sorted(
+            (p.owner, p.upid, 1) for p in procs))
+        for p in procs:
+            process = self.store.get_process(p.owner, p.upid)
+            self.assertEqual(process.state, ProcessState.DIED_REQUESTED)
+            self.assertIsNone(process.assigned)
+
+    def test_resource_monitor_missing_batch(self):
+        t0 = datetime(2012, 3, 13, 9, 30, 0, tzinfo=UTC)
+        mock_now = Mock()
+        mock_now.return_value = t0
+
+        monitor = self._setup_resource_monitor()
+        monitor._now_func = mock_now
+
+        self.core.node_state("node1", domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+
+        r1, r2, r3 = "eeagent_1", "eeagent_2", "eeagent_3"
+        for resource_id in (r1, r2, r3):
+            self._send_heartbeat(resource_id, "node1", t0)
+        self.assert_monitor_cycle(10)
+
+        mock_now.return_value = t0 + timedelta(seconds=10)
+        states = {r1: ExecutionResourceState.WARNING,
+                  r2: ExecutionResourceState.WARNING,
+                  r3: ExecutionResourceState.WARNING}
+        self.assert_monitor_cycle(10, states)
+
+        # r3 recovers. r1 and r2 go MISSING in the same cycle and are
+        # evacuated in one batch
+        t1 = t0 + timedelta(seconds=20)
+        mock_now.return_value = t1
+        self._send_heartbeat(r3, "node1", t1)
+        states = {r1: ExecutionResourceState.MISSING,
+                  r2: ExecutionResourceState.MISSING,
+                  r3: ExecutionResourceState.OK}
+        with patch.object(self.core, "evacuate_resources",
+                          wraps=self.core.evacuate_resources) as mock_evacuate:
+            self.assert_monitor_cycle(None, states)
+        self.assertEqual(mock_evacuate.call_count, 1)
+        evacuated = mock_evacuate.call_args[0][0]
+        self.assertEqual(sorted(r.resource_id for r in evacuated), [r1, r2])
+
+        # the state changes are picked up on the next cycle. only r3, which
+        # is OK again, needs another check.
+        self.assert_monitor_cycle(10, states)
+
+    def test_resource_monitor_heartbeat_parsed_once(self):
+        t0 = datetime(2012, 3, 13, 9, 30, 0, tzinfo=UTC)
+        monitor = self._setup_resource_monitor()
+
+        self.core.node_state("node1", domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+        self._send_heartbeat("eeagent_1", "node1", t0)
+        resource = self.store.get_resource("eeagent_1")
+
+        with patch.object(epu.processdispatcher.doctor, "parse_datetime",
+                          wraps=epu.processdispatcher.doctor.parse_datetime) as mock_parse:
+            first = monitor._get_last_heartbeat(resource)
+            self.assertEqual(monitor._get_last_heartbeat(resource), first)
+            self.assertEqual(mock_parse.call_count, 1)
+
+            # a new timestamp is parsed
+            self._send_heartbeat("eeagent_1", "node1", t0 + timedelta(seconds=5))
+            resource = self.store.get_resource("eeagent_1")
+            self.assertEqual(monitor._get_last_heartbeat(resource), first + 5)
+            self.assertEqual(mock_parse.call_count, 2)
+
+    def test_resource_monitor_thresholds_cached(self):
+        monitor = self._setup_resource_monitor()
+
+        self.core.node_state("node1", domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+        self._send_heartbeat("eeagent_1", "node1",
+            datetime(2012, 3, 13, 9, 30, 0, tzinfo=UTC))
+        resource = self.store.get_resource("eeagent_1")
+
+        with patch.object(epu.processdispatcher.doctor, "ensure_timedelta",
+                          wraps=epu.processdispatcher.doctor.ensure_timedelta) as mock_ensure:
+            self.assertEqual(monitor._get_resource_thresholds(resource), (10, 20))
+            self.assertEqual(monitor._get_resource_thresholds(resource), (10, 20))
+            self.assertEqual(mock_ensure.call_count, 2)
+
+            # a changed engine spec is worked out again
+            engine = EngineSpec("engine1", 4, heartbeat_period=5,
+                heartbeat_warning=30, heartbeat_missing=60)
+            with patch.object(self.core, "get_resource_engine", return_value=engine):
+                self.assertEqual(monitor._get_resource_thresholds(resource), (30, 60))
+                self.assertEqual(monitor._get_resource_thresholds(resource), (30, 60))
+            self.assertEqual(mock_ensure.call_count, 4)
+
+    def test_resource_checks_due_batch(self):
+        checks = _ResourceChecks()
+        checks.set_resource_check("r1", 10.0)
+        checks.set_resource_check("r2", 5.0)
+        checks.set_resource_check("r3", 20.0)
+        checks.set_resource_check("r4", 10.0)
+
+        # r2 is rescheduled. its stale heap entry is skipped
+        checks.set_resource_check("r2", 30.0)
+
+        self.assertEqual(sorted(checks.pop_due_checks(10.0)), ["r1", "r4"])
+        self.assertNotIn("r1", checks)
+        self.assertEqual(checks.next_check_time, 20.0)
+        self.assertEqual(checks.pop_due_checks(15.0), [])
+        self.assertEqual(checks.pop_due_checks(30.0), ["r3", "r2"])
+        self.assertIsNone(checks.next_check_time)
+
 
 class PDDoctorZooKeeperTests(PDDoctorTests, ZooKeeperTestMixin):
     def setup_store(self):
@@ -1,8 +1,13 @@
 # Copyright 2013 University of Chicago
 
+import threading
+import time
 import unittest
 
-from epu.processdispatcher.engines import EngineRegistry
+from mock import patch
+
+from epu.processdispatcher.engines import EngineRegistry, EngineSpec
+from epu.processdispatcher.store import ProcessDispatcherStore
 
 
 ENGINE_CONF1 = {'engine1': {'slots': 4, 'base_need': 1},
@@ -49,3 +54,64 @@ class EngineRegistryTests(unittest.TestCase):
 
         definition = dict(executable={"module": "e.f", "class": "G"})
         self.assertEqual(registry.get_process_definition_engine_id(definition), "engine1")
+
+    def test_process_engines_changed(self):
+        registry = EngineRegistry.from_config(ENGINE_CONF1, default="engine1",
+            process_engines={'a.b': 'engine2'})
+        self.assertEqual(registry.process_engine_depths, [2])
+
+        definition = dict(executable={"module": "a.b.c", "class": "D"})
+        self.assertEqual(registry.get_process_definition_engine_id(definition), 'engine2')
+
+        # changing the mappings is seen by the next lookup
+        generation = registry.generation
+        registry.set_process_engine_mapping('a.b.c', 'engine3')
+        self.assertGreater(registry.generation, generation)
+        self.assertEqual(registry.process_engine_depths, [3, 2])
+        self.assertEqual(registry.get_process_definition_engine_id(definition), 'engine3')
+
+        definition2 = dict(executable={"module": "x", "class": "Y"})
+        self.assertIsNone(registry.get_process_definition_engine_id(definition2))
+        registry.add(EngineSpec('engine4', 4))
+        registry.set_process_engine_mapping('x', 'engine4')
+        self.assertEqual(registry.process_engine_depths, [3, 2, 1])
+        self.assertEqual(registry.get_process_definition_engine_id(definition2), 'engine4')
+
+    def test_follow_store(self):
+        store = ProcessDispatcherStore()
+        store.add_engine("engine4", {"slots": 2})
+
+        registry = EngineRegistry.from_config(ENGINE_CONF1, default="engine1")
+
+        registry.follow_store(store)
+        self.assertEqual(registry.get_engine_by_id("engine4").slots, 2)
+        self.assertEqual(len(registry), 4)
+
+        # engines added by other workers are picked up in the background,
+        # and lookups never read the store
+        changed = threading.Event()
+        registry.add_listener(changed.set)
+        with patch.object(store, 'get_engine_ids') as get_engine_ids:
+            self.assertNotIn("engine5", registry)
+            self.assertEqual(len(registry), 4)
+            self.assertFalse(get_engine_ids.called)
+
+        store.add_engine("engine5", {"slots": 8, "base_need": 1})
+        self.assertTrue(changed.wait(5))
+        self.assertIn("engine5", registry)
+        self.assertEqual(registry.get_engine_by_id("engine5").base_need, 1)
+
+        # engines already known are left alone
+        store.add_engine("engine1", {"slots": 1})
+        self.wait_refreshed(registry)
+        self.assertEqual(len(registry), 5)
+        self.assertEqual(registry.get_engine_by_id("engine1").slots, 4)
+
+    def wait_refreshed(self, registry, timeout=5):
+        deadline = time.time() + timeout
+        while registry.stored_engines_changed:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        # the flag is cleared under the lock, before the store is read
+        with registry.lock:
+            pass
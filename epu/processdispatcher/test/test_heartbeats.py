@@ -0,0 +1,94 @@
+# Copyright 2013 University of Chicago
+
+import threading
+import time
+import unittest
+
+from epu.processdispatcher.heartbeats import HeartbeatIngester
+
+
+class HeartbeatIngesterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.handled_condition = threading.Condition()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.ingester = None
+
+    def tearDown(self):
+        self.gate.set()
+        if self.ingester:
+            self.ingester.stop()
+
+    def handler(self, sender, beat):
+        self.gate.wait()
+        with self.handled_condition:
+            self.handled.append((sender, beat))
+            self.handled_condition.notify_all()
+
+    def wait_handled(self, count, timeout=5):
+        deadline = time.time() + timeout
+        with self.handled_condition:
+            while len(self.handled) < count and time.time() < deadline:
+                self.handled_condition.wait(deadline - time.time())
+        self.assertEqual(len(self.handled), count)
+
+    def test_ordering(self):
+        self.ingester = HeartbeatIngester(self.handler, worker_count=3)
+        self.ingester.start()
+
+        count = 0
+        for sender in ("ee1", "ee2", "ee3", "ee4"):
+            for i in range(5):
+                self.ingester.submit(sender, i)
+                count += 1
+                self.wait_handled(count)
+
+        # every sender's beats are handled in order
+        for sender in ("ee1", "ee2", "ee3", "ee4"):
+            beats = [beat for s, beat in self.handled if s == sender]
+            self.assertEqual(beats, range(5))
+
+    def test_coalesce_and_drop(self):
+        self.ingester = HeartbeatIngester(self.handler, worker_count=1,
+            max_pending=2)
+        self.ingester.start()
+
+        # the worker blocks on the first beat
+        self.gate.clear()
+        self.ingester.submit("ee1", 0)
+        while self.ingester.get_stats()['queue_depth']:
+            self.gate.wait(0.01)
+
+        # later beats from ee1 are coalesced into the newest
+        self.assertTrue(self.ingester.submit("ee1", 1))
+        self.assertTrue(self.ingester.submit("ee1", 2))
+        self.assertTrue(self.ingester.submit("ee2", 0))
+
+        # queue is full
+        self.assertFalse(self.ingester.submit("ee3", 0))
+
+        stats = self.ingester.get_stats()
+        self.assertEqual(stats['queue_depth'], 2)
+        self.assertEqual(stats['received'], 5)
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertTrue(stats['max_lag'] >= 0)
+
+        self.gate.set()
+        self.wait_handled(3)
+        self.assertEqual(self.handled, [("ee1", 0), ("ee1", 2), ("ee2", 0)])
+
+    def test_handler_error(self):
+        def handler(sender, beat):
+            if beat == "bad":
+                raise Exception("boom")
+            self.handler(sender, beat)
+
+        self.ingester = HeartbeatIngester(handler, worker_count=1)
+        self.ingester.start()
+        self.ingester.submit("ee1", "bad")
+        self.ingester.submit("ee2", "good")
+        self.wait_handled(1)
+        self.assertEqual(self.handled, [("ee2", "good")])
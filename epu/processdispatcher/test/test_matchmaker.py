@@ -13,12 +13,14 @@ from nose.plugins.attrib import attr
 from nose.plugins.skip import SkipTest
 
 import epu.tevent as tevent
-from epu.processdispatcher.matchmaker import PDMatchmaker
+from epu.processdispatcher.matchmaker import PDMatchmaker, SlotIndex, \
+    ConstraintIndex, EngineTally, ProcessLauncher, match_constraints
 from epu.processdispatcher.store import ProcessDispatcherStore, ProcessDispatcherZooKeeperStore
 from epu.processdispatcher.test.mocks import MockResourceClient, \
     MockEPUMClient, MockNotifier, get_definition, get_domain_config
 from epu.processdispatcher.store import ResourceRecord, ProcessRecord, NodeRecord
 from epu.processdispatcher.engines import EngineRegistry, domain_id_from_engine
+from epu.processdispatcher.scheduling import PrioritySchedulingPolicy
 from epu.states import ProcessState, ProcessDispatcherState, ExecutionResourceState
 from epu.processdispatcher.test.test_store import StoreTestMixin
 from epu.processdispatcher.core import ProcessDispatcherCore
@@ -120,7 +122,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         # now update the resource record so the matchmake() attempt to write will conflict
         r1.assigned = ["hats"]
@@ -136,6 +138,268 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         r1copy = self.store.get_resource(r1.resource_id)
         self.assertRecordVersions(r1, r1copy)
 
+    def test_match_writeconflict_partitioned(self):
+        # a conflict matching one engine shouldn't hold up other engines
+        self.mm.matchmaking_concurrency = 2
+        self.mm.initialize()
+
+        r1 = ResourceRecord.new("r1", "n1", 1, properties={"engine": "engine1"})
+        self.store.add_resource(r1)
+        r2 = ResourceRecord.new("r2", "n2", 1, properties={"engine": "engine2"})
+        self.store.add_resource(r2)
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+                               ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1.key)
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+                               ProcessState.REQUESTED, constraints={"engine": "engine2"})
+        self.store.add_process(p2)
+        self.store.enqueue_process(*p2.key)
+
+        # sneak into MM and force it to update this info from the store
+        self.mm._get_queued_processes()
+        self.mm._get_resources()
+
+        # now update the engine1 resource record so the match will conflict
+        r1.assigned = ["hats"]
+        self.store.update_resource(r1)
+
+        self.mm.matchmake()
+        self.assertTrue(self.mm.needs_matchmaking)
+
+        self.assertEqual(self.store.get_process(None, "p1").state, ProcessState.REQUESTED)
+        p2 = self.store.get_process(None, "p2")
+        self.assertEqual(p2.state, ProcessState.ASSIGNED)
+        self.assertEqual(p2.assigned, "r2")
+
+    def test_match_partitions_share_resource(self):
+        # a process already holding a slot on another engine's resource is
+        # matched with that engine, so concurrent partitions never write the
+        # same resource
+        self.mm.matchmaking_concurrency = 2
+        self.mm.initialize()
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+                               ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1.key)
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+                               ProcessState.REQUESTED, constraints={"engine": "engine2"})
+        self.store.add_process(p2)
+        self.store.enqueue_process(*p2.key)
+        p3 = ProcessRecord.new(None, "p3", get_process_definition(),
+                               ProcessState.REQUESTED, constraints={"engine": "engine2"})
+        self.store.add_process(p3)
+        self.store.enqueue_process(*p3.key)
+
+        r1 = ResourceRecord.new("r1", "n1", 2, properties={"engine": "engine1"})
+        r1.assigned.append(p2.key)
+        self.store.add_resource(r1)
+        r2 = ResourceRecord.new("r2", "n2", 1, properties={"engine": "engine2"})
+        self.store.add_resource(r2)
+
+        self.mm._get_queued_processes()
+        self.mm._get_resources()
+
+        partitions = self.mm._partition_processes(self.mm._get_fresh_processes())
+        self.assertEqual(sorted(p.upid for p in partitions["engine1"]), ["p1", "p2"])
+        self.assertEqual([p.upid for p in partitions["engine2"]], ["p3"])
+
+        self.mm.matchmake()
+
+        for upid, resource_id in (("p1", "r1"), ("p2", "r1"), ("p3", "r2")):
+            process = self.store.get_process(None, upid)
+            self.assertEqual(process.state, ProcessState.ASSIGNED)
+            self.assertEqual(process.assigned, resource_id)
+        self.assertEqual(len(self.store.get_resource("r1").assigned), 2)
+
+    def test_match_multiple_engines(self):
+        # a process constrained to several engines is matched unpartitioned
+        self.mm.matchmaking_concurrency = 2
+        self.mm.initialize()
+
+        r1 = ResourceRecord.new("r1", "n1", 1, properties={"engine": "engine1"})
+        self.store.add_resource(r1)
+        r2 = ResourceRecord.new("r2", "n2", 1, properties={"engine": "engine2"})
+        self.store.add_resource(r2)
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+                               ProcessState.REQUESTED,
+                               constraints={"engine": ["engine1", "engine3"]})
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1.key)
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+                               ProcessState.REQUESTED, constraints={"engine": "engine2"})
+        self.store.add_process(p2)
+        self.store.enqueue_process(*p2.key)
+
+        self.mm._get_queued_processes()
+        self.mm._get_resources()
+
+        partitions = self.mm._partition_processes(self.mm._get_fresh_processes())
+        self.assertEqual([p.upid for p in partitions[None]], ["p1"])
+
+        self.mm.matchmake()
+
+        for upid, resource_id in (("p1", "r1"), ("p2", "r2")):
+            process = self.store.get_process(None, upid)
+            self.assertEqual(process.state, ProcessState.ASSIGNED)
+            self.assertEqual(process.assigned, resource_id)
+        self.assertFalse(self.mm.needs_matchmaking)
+
+    def test_match_priority(self):
+        self.mm.scheduling_policy = PrioritySchedulingPolicy()
+        self.mm.initialize()
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 1, properties=props)
+        self.store.add_resource(r1)
+
+        # the high priority process is queued last but should get the slot
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+                               ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1.key)
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+                               ProcessState.REQUESTED, priority=10)
+        self.store.add_process(p2)
+        self.store.enqueue_process(*p2.key)
+
+        self.mm._get_queued_processes()
+        self.mm._get_resources()
+        self.mm.matchmake()
+
+        self.assertEqual(self.store.get_process(None, "p2").state, ProcessState.ASSIGNED)
+        self.assertEqual(self.store.get_process(None, "p1").state, ProcessState.WAITING)
+
+    def test_throttled_processes(self):
+        self.mm.restart_throttling_config['minimum_time_between_starts'] = 60
+        self.mm.initialize()
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 1, properties=props)
+        self.store.add_resource(r1)
+
+        # both processes have been dispatched before. p1's throttle ends
+        # in 30 seconds, p2's in 60.
+        now = time.time()
+        for upid, last_dispatch_time in (("p1", now - 30), ("p2", now)):
+            p = ProcessRecord.new(None, upid, get_process_definition(),
+                                  ProcessState.REQUESTED)
+            p.dispatches = 2
+            p.last_dispatch_time = last_dispatch_time
+            self.store.add_process(p)
+            self.store.enqueue_process(*p.key)
+
+        self.mm._get_queued_processes()
+        self.mm._get_resources()
+        self.mm.matchmake()
+
+        self.assertEqual(self.store.get_process(None, "p1").state, ProcessState.WAITING)
+        self.assertEqual(self.store.get_process(None, "p2").state, ProcessState.WAITING)
+        self.assertEqual(len(self.mm.throttled_processes), 2)
+        self.assertEqual(self.mm._get_fresh_processes(), [])
+        self.assertTrue(29 < self.mm._time_until_throttling_ends() <= 30)
+
+        # nothing has expired yet
+        self.mm._check_throttled_processes()
+        self.assertFalse(self.mm.needs_matchmaking)
+
+        # only p1 is released and rematched
+        with patch('time.time', return_value=now + 45):
+            self.mm._check_throttled_processes()
+            self.assertTrue(self.mm.needs_matchmaking)
+            self.assertEqual(self.mm._get_fresh_processes(), [(None, "p1", 0)])
+            self.mm.matchmake()
+
+        self.assertEqual(self.store.get_process(None, "p1").state, ProcessState.ASSIGNED)
+        self.assertEqual(self.store.get_process(None, "p2").state, ProcessState.WAITING)
+        self.assertEqual(self.mm.throttled_processes.keys(), [(None, "p2", 0)])
+
+    def test_process_cache(self):
+        self.mm.initialize()
+
+        keys = []
+        for i in range(3):
+            p = ProcessRecord.new(None, "p%d" % i, get_process_definition(),
+                                  ProcessState.REQUESTED)
+            self.store.add_process(p)
+            self.store.enqueue_process(*p.key)
+            keys.append(p.key)
+
+        self.mm._get_queued_processes()
+        self.mm._get_resources()
+
+        # the first pass marks the processes WAITING, so the next one reads
+        # them again
+        self.mm.matchmake()
+        self.mm._dump_stale_processes()
+        self.mm.matchmake()
+
+        # nothing has changed. another pass over the queue needs no reads.
+        self.mm._dump_stale_processes()
+        with patch.object(self.store, 'get_process',
+                          wraps=self.store.get_process) as get_process:
+            self.mm.matchmake()
+            self.assertEqual(get_process.call_count, 0)
+
+        # change one process out of band. only it is read again.
+        p1 = self.store.get_process(None, "p1")
+        p1.configuration = {"hats": 1}
+        self.store.update_process(p1)
+
+        self.mm._dump_stale_processes()
+        with patch.object(self.store, 'get_process',
+                          wraps=self.store.get_process) as get_process:
+            self.mm.matchmake()
+            self.assertEqual(get_process.call_count, 1)
+        self.assertEqual(self.mm.process_cache[(None, "p1")].configuration,
+            {"hats": 1})
+
+    def test_process_cache_watches(self):
+        self.mm.initialize()
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+                               ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        key = (None, "p1")
+
+        # a record dropped from the cache is read again, but its watch is
+        # still outstanding so no other is set
+        with patch.object(self.store, 'get_process',
+                          wraps=self.store.get_process) as get_process:
+            self.mm._get_queued_process(None, "p1")
+            self.mm.process_cache.pop(key)
+            self.mm._get_queued_process(None, "p1")
+            self.mm.process_cache.pop(key)
+            self.mm._get_queued_process(None, "p1")
+
+            watchers = [kwargs['watcher'] for args, kwargs in get_process.call_args_list]
+            self.assertEqual(watchers, [self.mm._notify_process_changed, None, None])
+        self.assertIn(key, self.mm.watched_processes)
+
+        # once the watch fires, the next read sets a new one
+        p1 = self.store.get_process(None, "p1")
+        p1.configuration = {"hats": 1}
+        self.store.update_process(p1)
+        for _ in range(100):
+            if key not in self.mm.watched_processes:
+                break
+            time.sleep(0.05)
+        self.assertNotIn(key, self.mm.watched_processes)
+
+        with patch.object(self.store, 'get_process',
+                          wraps=self.store.get_process) as get_process:
+            process = self.mm._get_queued_process(None, "p1")
+            self.assertEqual(get_process.call_args[1]['watcher'],
+                self.mm._notify_process_changed)
+        self.assertEqual(process.configuration, {"hats": 1})
+
+        # a missing record leaves no watch behind
+        self.assertIsNone(self.mm._get_queued_process(None, "p2"))
+        self.assertNotIn((None, "p2"), self.mm.watched_processes)
+
     def test_match_notfound(self):
         self.mm.initialize()
 
@@ -151,7 +415,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         # now update the resource record so the matchmake() attempt to write will conflict
         self.store.remove_resource("r1")
@@ -178,7 +442,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         # now update the process record to be TERMINATED so that
         # MM should bail out of matching this process
@@ -243,6 +507,48 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.wait_process(p2.owner, p2.upid,
                           lambda p: p.state == ProcessState.ASSIGNED)
 
+    def test_match_coalesced_commit(self):
+        # placements on the same resource are written in one transaction,
+        # along with the node exclusive tags they need
+        self.mm.initialize()
+
+        n1 = NodeRecord.new("n1", "d1")
+        self.store.add_node(n1)
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 2, properties=props)
+        self.store.add_resource(r1)
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+                               ProcessState.REQUESTED, node_exclusive="port5000")
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1.key)
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+                               ProcessState.REQUESTED)
+        self.store.add_process(p2)
+        self.store.enqueue_process(*p2.key)
+
+        self.mm._get_queued_processes()
+        self.mm._get_resources()
+
+        with patch.object(self.store, 'commit_assignment',
+                          wraps=self.store.commit_assignment) as commit:
+            self.mm.matchmake()
+
+        self.assertEqual(commit.call_count, 1)
+        args, kwargs = commit.call_args
+        self.assertEqual(args[0].resource_id, "r1")
+        self.assertEqual([p.upid for p in args[1]], ["p1", "p2"])
+        self.assertEqual(kwargs['node'].node_id, "n1")
+
+        for upid in ("p1", "p2"):
+            process = self.store.get_process(None, upid)
+            self.assertEqual(process.state, ProcessState.ASSIGNED)
+            self.assertEqual(process.assigned, "r1")
+        self.assertEqual(len(self.store.get_resource("r1").assigned), 2)
+        self.assertEqual(self.store.get_node("n1").node_exclusive, ["port5000"])
+        self.assertEqual(self.store.get_queued_processes(), [])
+
     def test_node_exclusive_bug(self):
         """test_node_exclusive_bug
 
@@ -284,7 +590,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         self.mm.matchmake()
 
@@ -444,12 +750,12 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         self.mm.register_needs()
         self.epum_client.clear()
 
-        self.mm.queued_processes = []
+        self.forget_queued_processes()
 
         self.mm.register_needs()
         conf = self.epum_client.reconfigures['pd_domain_engine4'][0]
@@ -509,21 +815,22 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         # to it. we will simulate marking the process TERMINATED out-of-band
         # and ensure that is recognized before the dispatch.
 
-        # when the matchmaker attempts to update the process, sneak in an update
-        # first so the matchmaker request conflicts
-        original_update_process = self.store.update_process
+        # when the matchmaker attempts to commit the assignment, sneak in an
+        # update first so the matchmaker request conflicts
+        original_commit_assignment = self.store.commit_assignment
 
-        def patched_update_process(process):
-            original = self.store.get_process(process.owner, process.upid)
-            original.state = ProcessState.TERMINATED
-            original_update_process(original)
+        def patched_commit_assignment(resource, processes, node=None):
+            for process in processes:
+                original = self.store.get_process(process.owner, process.upid)
+                original.state = ProcessState.TERMINATED
+                self.store.update_process(original)
 
             try:
-                original_update_process(process)
+                original_commit_assignment(resource, processes, node=node)
             finally:
                 event.set()
 
-        self.store.update_process = patched_update_process
+        self.store.commit_assignment = patched_commit_assignment
 
         p1 = ProcessRecord.new(None, "p1", get_process_definition(),
             ProcessState.REQUESTED)
@@ -590,7 +897,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.mm.initialize()
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         self.mm.process_launcher.pending_process_dispatches[p1.key] = time.time()
 
@@ -602,6 +909,37 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         self.assertEqual(len(self.mm.process_launcher.pending_process_dispatches), 1)
 
+    def test_find_assigned_resource(self):
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 2, properties=props)
+        r1.assigned.append(("owner", "p1", 0))
+        self.store.add_resource(r1)
+        r2 = ResourceRecord.new("r2", "n1", 2, properties=props)
+        r2.assigned.append(("owner", "p2", 0))
+        self.store.add_resource(r2)
+
+        self.mm.initialize()
+        self.mm._get_resources()
+
+        self.assertEqual(self.mm._find_assigned_resource("owner", "p1", 0).resource_id, "r1")
+        self.assertEqual(self.mm._find_assigned_resource("owner", "p2", 0).resource_id, "r2")
+        self.assertIsNone(self.mm._find_assigned_resource("owner", "p2", 1))
+
+        # move p1 over to r2 and make sure the map follows
+        r1 = self.store.get_resource("r1")
+        r1.assigned = []
+        self.mm._set_resource(r1)
+        r2 = self.store.get_resource("r2")
+        r2.assigned.append(("owner", "p1", 0))
+        self.mm._set_resource(r2)
+
+        self.assertEqual(self.mm._find_assigned_resource("owner", "p1", 0).resource_id, "r2")
+
+        self.store.remove_resource("r2")
+        self.mm._get_resources()
+        self.assertIsNone(self.mm._find_assigned_resource("owner", "p1", 0))
+        self.assertIsNone(self.mm._find_assigned_resource("owner", "p2", 0))
+
     def test_assigned_process_not_rematched_but_retried(self):
         # Processes are moved to the ASSIGNED state when assigned by the matchmaker.
         # Though they remain in the queue, they should not be rematched
@@ -618,7 +956,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.mm.initialize()
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         # kinda dirty: patch out an internal MM function and ensure it isn't called
         with patch.object(self.mm, '_handle_matched_process') as m:
@@ -740,7 +1078,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
             pkeys.append(pkey)
             self.store.add_process(p)
             self.store.enqueue_process(*pkey)
-            self.mm.queued_processes.append(pkey)
+            self.mm._add_queued_processes([pkey])
         return pkeys
 
     def create_n_pending_processes(self, n_processes, engine_id=None, module=None):
@@ -772,10 +1110,18 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                 process.state = ProcessState.REQUESTED
                 self.store.update_process(process)
                 self.store.enqueue_process(*pkey)
-                self.mm.queued_processes.append(pkey)
+                self.mm._add_queued_processes([pkey])
                 pkeys.append(pkey)
         return pkeys
 
+    def forget_queued_processes(self):
+        for pkey in list(self.mm.queued_processes):
+            self.mm._forget_queued_process(*pkey)
+
+    def empty_resource(self, resource):
+        resource.assigned = []
+        self.mm._set_resource(resource)
+
     def create_engine_resources(self, engine_id, node_count=1, assignments=None):
         engine_spec = self.registry.get_engine_by_id(engine_id)
         assert len(assignments) <= engine_spec.slots * engine_spec.replicas * node_count
@@ -789,7 +1135,6 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                     engine_spec.slots, properties=props)
                 records.append(res)
                 res.metadata['version'] = 0
-                self.mm.resources[res.resource_id] = res
 
                 # use fake process ids in the assigned list, til it matters
                 if len(assignments) <= engine_spec.slots:
@@ -798,6 +1143,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                 else:
                     res.assigned = assignments[:engine_spec.slots]
                     assignments[:] = assignments[engine_spec.slots:]
+                self.mm._set_resource(res)
 
                 print "added resource: %s" % res
         return records
@@ -844,6 +1190,23 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.assertEqual(engine1_domain_conf['maximum_vms'], maximum_vms)
         self.assertEqual(engine2_domain_conf['maximum_vms'], maximum_vms)
 
+    def test_engine_domains(self):
+        self.mm.initialize()
+        self.assertEqual(len(self.epum_client.domains), len(self.engine_conf.keys()))
+        self.assertFalse(self.mm.engines_changed)
+
+        # known engines are not looked up again
+        with patch.object(self.epum_client, "describe_domain",
+                          wraps=self.epum_client.describe_domain) as mock_describe:
+            self.core.add_engine({'engine_id': 'engine9', 'slots': 1})
+            self.assertTrue(self.mm.engines_changed)
+
+            self.mm._create_missing_domains()
+            self.assertEqual(mock_describe.call_count, 1)
+            self.assertFalse(self.mm.engines_changed)
+
+        self.assertIn(domain_id_from_engine('engine9'), self.epum_client.domains)
+
     def test_needs(self):
         self.mm.initialize()
 
@@ -902,7 +1265,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         engine4_resources = self.create_engine_resources("engine4",
             node_count=11, assignments=engine4_procs)
         self.assertEqual(len(engine4_resources), 11)
-        self.mm.queued_processes = []
+        self.forget_queued_processes()
 
         self.mm.register_needs()
         self.assertFalse(self.epum_client.reconfigures)
@@ -913,17 +1276,17 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         engine1_retirees = set()
         for resource in engine1_resources[:2]:
             engine1_retirees.add(resource.node_id)
-            resource.assigned = []
+            self.empty_resource(resource)
 
         # empty 2 resources from engine2. 2 nodes should be terminated
         engine2_retirees = set()
         for resource in engine2_resources[:2]:
             engine2_retirees.add(resource.node_id)
-            resource.assigned = []
+            self.empty_resource(resource)
 
         # empty 3 resources from engine3.  1 node should be terminated
         for resource in engine3_resources[:3]:
-            resource.assigned = []
+            self.empty_resource(resource)
         engine3_retirees = set([engine3_resources[0].node_id])
 
         # empty 2 resources from engine4.  2 nodes should be terminated
@@ -931,7 +1294,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         for resource in engine4_resources:
             if len(resource.assigned) > 0:
                 engine4_retirees.add(resource.node_id)
-                resource.assigned = []
+                self.empty_resource(resource)
 
             if len(engine4_retirees) >= 2:
                 break
@@ -1075,7 +1438,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         engine2_resources = self.create_engine_resources("engine2",
             node_count=10, assignments=engine2_procs)
         self.assertEqual(len(engine2_resources), 10)
-        self.mm.queued_processes = []
+        self.forget_queued_processes()
 
         self.mm.register_needs()
         self.assertFalse(self.epum_client.reconfigures)
@@ -1084,13 +1447,13 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         engine1_retirees = set()
         for resource in engine1_resources:
             engine1_retirees.add(resource.node_id)
-            resource.assigned = []
+            self.empty_resource(resource)
 
         # empty resources from engine2. all nodes should be terminated
         engine2_retirees = set()
         for resource in engine2_resources:
             engine2_retirees.add(resource.node_id)
-            resource.assigned = []
+            self.empty_resource(resource)
 
         self.mm.register_needs()
 
@@ -1099,6 +1462,21 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.assert_one_reconfigure(engine2_domain_id, 0, engine2_retirees)
         self.epum_client.clear()
 
+    def test_needs_multiple_engine_process(self):
+        self.mm.initialize()
+        self.mm.register_needs()
+        self.epum_client.clear()
+
+        # a process constrained to several engines counts against none
+        self.enqueue_n_processes(1, ["engine1", "engine2"])
+        self.enqueue_n_processes(2, "engine2")
+
+        self.mm.register_needs()
+        self.assertEqual(self.mm.engine_tally.get_process_count("engine1"), 0)
+        self.assertEqual(self.mm.engine_tally.get_process_count("engine2"), 2)
+        self.assert_one_reconfigure(domain_id_from_engine("engine2"), 1, [])
+        self.assertFalse(self.mm.untallied_processes)
+
     def test_needs_duplicate_process(self):
 
         # ensure processes represented in queue and in a resource are not
@@ -1138,7 +1516,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         engine1_resources = self.create_engine_resources("engine1",
             node_count=10, assignments=engine1_procs)
         self.assertEqual(len(engine1_resources), 10)
-        self.mm.queued_processes = []
+        self.forget_queued_processes()
 
         self.mm.register_needs()
         self.assertFalse(self.epum_client.reconfigures)
@@ -1147,7 +1525,8 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         # the requue can happen before the resource update so we
         # simulate this to ensure that the process isn't counted twice
 
-        self.mm.queued_processes = [(owner, upid, rround + 1)]
+        self.forget_queued_processes()
+        self.mm._add_queued_processes([(owner, upid, rround + 1)])
         self.mm.register_needs()
         self.assertFalse(self.epum_client.reconfigures)
 
@@ -1211,6 +1590,43 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                           lambda p: p.assigned == r1.resource_id and
                                     p.state == ProcessState.ASSIGNED)
 
+    def test_queued_process_deltas(self):
+        self.mm.initialize()
+
+        keys = [(None, "p%d" % i, 0) for i in range(4)]
+        for key in keys:
+            self.store.enqueue_process(*key)
+
+        self.mm._get_queued_processes()
+        self.assertEqual(list(self.mm.queued_processes), keys)
+
+        self.mm._mark_process_stale(keys[1])
+        self.mm._mark_process_stale((None, "notqueued", 0))
+        self.assertEqual(self.mm.stale_processes, set([keys[1]]))
+        self.assertEqual(self.mm._get_fresh_processes(),
+            [keys[0], keys[2], keys[3]])
+
+        # remove a couple and add one. order is kept and stale entries
+        # for removed processes are dropped.
+        self.store.remove_queued_process(*keys[1])
+        self.store.remove_queued_process(*keys[2])
+        newkey = (None, "p4", 0)
+        self.store.enqueue_process(*newkey)
+
+        self.mm.needs_matchmaking = False
+        self.mm._get_queued_processes()
+        self.assertTrue(self.mm.needs_matchmaking)
+        self.assertEqual(list(self.mm.queued_processes),
+            [keys[0], keys[3], newkey])
+        self.assertFalse(self.mm.stale_processes)
+
+        # removals alone don't warrant matchmaking
+        self.store.remove_queued_process(*keys[0])
+        self.mm.needs_matchmaking = False
+        self.mm._get_queued_processes()
+        self.assertFalse(self.mm.needs_matchmaking)
+        self.assertEqual(list(self.mm.queued_processes), [keys[3], newkey])
+
     @attr('INT')
     def test_stale_procs(self):
         """test that the matchmaker doesn't try to schedule stale procs
@@ -1231,7 +1647,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         self.assertTrue(self.mm.needs_matchmaking)
         self.mm.matchmake()
@@ -1239,7 +1655,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.assertTrue(len(self.mm.stale_processes) > 0)
 
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
         self.assertFalse(self.mm.needs_matchmaking)
         self.assertTrue(len(self.mm.stale_processes) > 0)
 
@@ -1250,7 +1666,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.store.enqueue_process(*p2key)
 
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         self.assertTrue(self.mm.needs_matchmaking)
         self.assertTrue(len(self.mm.stale_processes) > 0)
@@ -1268,7 +1684,6 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         self.mm._get_queued_processes()
         self.mm._get_resources()
-        self.mm._get_resource_set()
 
         self.assertTrue(len(self.mm.stale_processes) == 0)
 
@@ -1294,7 +1709,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         self.assertTrue(self.mm.needs_matchmaking)
         unoptimized_start = clock()
@@ -1312,7 +1727,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         # sneak into MM and force it to update this info from the store
         self.mm._get_queued_processes()
-        self.mm._get_resource_set()
+        self.mm._get_resources()
 
         self.assertTrue(self.mm.needs_matchmaking)
         optimized_start = clock()
@@ -1336,7 +1751,6 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         self.mm._get_queued_processes()
         self.mm._get_resources()
-        self.mm._get_resource_set()
 
         self.assertTrue(self.mm.needs_matchmaking)
         addresource_start = clock()
@@ -1366,9 +1780,266 @@ class PDMatchmakerZooKeeperTests(PDMatchmakerTests, ZooKeeperTestMixin):
         self.teardown_zookeeper()
 
 
+class SlotIndexTests(unittest.TestCase):
+
+    def make_resource(self, resource_id, node_id, slots, assigned=0):
+        resource = ResourceRecord.new(resource_id, node_id, slots,
+            properties={"engine": "engine1"})
+        resource.assigned = [(None, "%s-p%d" % (resource_id, i), 0)
+                             for i in range(assigned)]
+        return resource
+
+    def node_order(self, index):
+        return [container.node_id for container in index]
+
+    def test_ordering(self):
+        index = SlotIndex()
+        index.set_resource(self.make_resource("r1", "empty", 4))
+        index.set_resource(self.make_resource("r2", "half", 4, assigned=2))
+        index.set_resource(self.make_resource("r3", "mostly", 4, assigned=3))
+        index.set_resource(self.make_resource("r4", "full", 4, assigned=4))
+
+        # occupied nodes first, fullest first. full nodes are left out.
+        self.assertEqual(self.node_order(index), ["mostly", "half", "empty"])
+        self.assertEqual(len(index), 3)
+        self.assertIn("r4", index)
+
+    def test_balance_within_node(self):
+        index = SlotIndex()
+        r1 = self.make_resource("r1", "n1", 4, assigned=1)
+        r2 = self.make_resource("r2", "n1", 4)
+        index.set_resource(r1)
+        index.set_resource(r2)
+
+        container, = list(index)
+        self.assertEqual([r.resource_id for r in container.resources], ["r2", "r1"])
+        self.assertEqual(container.available_slots, 7)
+
+        r2.assigned.extend([(None, "a", 0), (None, "b", 0)])
+        index.set_resource(r2)
+        container, = list(index)
+        self.assertEqual([r.resource_id for r in container.resources], ["r1", "r2"])
+        self.assertEqual(container.available_slots, 5)
+
+    def test_update_and_discard(self):
+        index = SlotIndex()
+        r1 = self.make_resource("r1", "n1", 1)
+        r2 = self.make_resource("r2", "n2", 2, assigned=1)
+        index.set_resource(r1)
+        index.set_resource(r2)
+        self.assertEqual(self.node_order(index), ["n2", "n1"])
+
+        # filling a node drops it out of the index
+        r2.assigned.append((None, "p", 0))
+        index.set_resource(r2)
+        self.assertEqual(self.node_order(index), ["n1"])
+
+        # disabled resources are not available
+        r1.state = ExecutionResourceState.DISABLED
+        index.set_resource(r1)
+        self.assertEqual(len(index), 0)
+
+        r1.state = ExecutionResourceState.OK
+        index.set_resource(r1)
+        self.assertEqual(self.node_order(index), ["n1"])
+
+        index.discard_resource("r1")
+        index.discard_resource("r1")
+        self.assertNotIn("r1", index)
+        self.assertEqual(len(index), 0)
+        self.assertNotIn("n1", index.containers)
+
+    def test_walk_candidates(self):
+        index = SlotIndex()
+        index.set_resource(self.make_resource("r1", "empty", 4))
+        index.set_resource(self.make_resource("r2", "half", 4, assigned=2))
+        index.set_resource(self.make_resource("r3", "mostly", 4, assigned=3))
+        index.set_resource(self.make_resource("r4", "full", 4, assigned=4))
+
+        self.assertEqual([c.node_id for c in index.walk()],
+            ["mostly", "half", "empty"])
+        self.assertEqual([c.node_id for c in index.walk(set(["r1", "r2", "r4"]))],
+            ["half", "empty"])
+        self.assertEqual([c.node_id for c in index.walk(set(["r1"]))], ["empty"])
+        self.assertEqual(list(index.walk(set())), [])
+
+    def test_slot_counts(self):
+        index = SlotIndex()
+        r1 = self.make_resource("r1", "n1", 4, assigned=3)
+        r2 = self.make_resource("r2", "n2", 4, assigned=1)
+        r3 = self.make_resource("r3", "n3", 4, assigned=3)
+        for resource in (r1, r2, r3):
+            index.set_resource(resource)
+
+        # buckets are walked in order of their sorted slot counts
+        self.assertEqual(index.occupied_slot_counts, [1, 3])
+        self.assertEqual(self.node_order(index), ["n1", "n3", "n2"])
+
+        # an emptied bucket drops out of the slot counts
+        r2.assigned.append((None, "p", 0))
+        index.set_resource(r2)
+        self.assertEqual(index.occupied_slot_counts, [1, 2])
+        index.discard_resource("r1")
+        index.discard_resource("r3")
+        self.assertEqual(index.occupied_slot_counts, [2])
+        self.assertEqual(sorted(index.occupied_buckets), [2])
+
+        # the index may be updated mid-walk
+        index.set_resource(r1)
+        for container in index:
+            index.discard_resource("r1")
+            index.discard_resource("r2")
+        self.assertEqual(index.occupied_slot_counts, [])
+
+
+class ConstraintIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ConstraintIndex()
+        self.resources = {}
+        self.add("r1", engine="engine1", site="a")
+        self.add("r2", engine="engine1", site="b")
+        self.add("r3", engine="engine2", site="a")
+        self.add("r4", engine="engine2", tags=["x", "y"])
+
+    def add(self, resource_id, **properties):
+        resource = ResourceRecord.new(resource_id, "n1", 1, properties=properties)
+        self.resources[resource_id] = resource
+        self.index.set_resource(resource)
+
+    def assertMatches(self, constraints, expected):
+        candidates = self.index.match(constraints)
+        matched = set(rid for rid in candidates
+                      if match_constraints(constraints, self.resources[rid].properties))
+        self.assertEqual(matched, set(expected))
+
+        # the index must never exclude a resource that would match
+        for resource_id, resource in self.resources.iteritems():
+            if match_constraints(constraints, resource.properties):
+                self.assertIn(resource_id, candidates)
+
+    def test_match(self):
+        self.assertIsNone(self.index.match(None))
+        self.assertIsNone(self.index.match({}))
+        self.assertIsNone(self.index.match({"engine": None}))
+
+        self.assertMatches({"engine": "engine1"}, ["r1", "r2"])
+        self.assertMatches({"engine": "engine1", "site": "a"}, ["r1"])
+        self.assertMatches({"engine": ["engine1", "engine2"], "site": "a"}, ["r1", "r3"])
+        self.assertMatches({"engine": "engine3"}, [])
+        self.assertMatches({"resource_id": "r4"}, ["r4"])
+
+        # unhashable values are not indexed, but must still be candidates
+        self.assertMatches({"tags": "x"}, [])
+        self.assertMatches({"engine": "engine2", "tags": [["x", "y"]]}, ["r4"])
+
+    def test_update_and_discard(self):
+        self.add("r1", engine="engine2", site="a")
+        self.assertMatches({"engine": "engine1"}, ["r2"])
+        self.assertMatches({"engine": "engine2", "site": "a"}, ["r1", "r3"])
+
+        self.index.discard_resource("r3")
+        del self.resources["r3"]
+        self.index.discard_resource("r3")
+        self.assertNotIn("r3", self.index)
+        self.assertMatches({"engine": "engine2", "site": "a"}, ["r1"])
+
+
 def get_process_definition(module=None):
     if module is None:
         module = "some.fake.path"
     return {"name": "hats", "executable": {"module": module,
                                            "url": "uri://something",
                                            "class": "SomeFakeClass"}}
+
+
+class ProcessLauncherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ProcessDispatcherStore()
+        self.resource_client = MockResourceClient()
+        self.launcher = ProcessLauncher(self.store, self.resource_client,
+            "supd", retry_seconds=30, concurrency=4)
+
+    def test_retry_dispatches(self):
+        processes = []
+        for i in range(3):
+            p = ProcessRecord.new(None, "p%d" % i, get_process_definition(),
+                                  ProcessState.ASSIGNED, assigned="r1")
+            self.store.add_process(p)
+            processes.append(p)
+
+        now = time.time()
+        for p in processes:
+            self.launcher.dispatch_process(p)
+        self.assertEqual(self.resource_client.launch_count, 3)
+
+        # nothing is due yet
+        self.assertTrue(29 < self.launcher.retry_process_dispatches() <= 30)
+        self.assertEqual(self.resource_client.launch_count, 3)
+
+        # p1 is acknowledged and p2 has moved on. only p0 is retried.
+        del self.launcher[processes[1].key]
+        p2 = self.store.get_process(None, "p2")
+        p2.state = ProcessState.RUNNING
+        self.store.update_process(p2)
+
+        with patch('time.time', return_value=now + 31):
+            next_retry = self.launcher.retry_process_dispatches()
+        self.assertAlmostEqual(next_retry, 30)
+        self.assertEqual(self.resource_client.launch_count, 4)
+        self.assertEqual(self.resource_client.launches[-1][1], "p0")
+        self.assertEqual(list(self.launcher.pending_process_dispatches),
+            [processes[0].key])
+
+        del self.launcher[processes[0].key]
+        self.assertIsNone(self.launcher.retry_process_dispatches())
+
+
+class EngineTallyTests(unittest.TestCase):
+
+    def make_resource(self, resource_id, node_id, engine_id, assigned=()):
+        resource = ResourceRecord.new(resource_id, node_id, 4,
+            properties={"engine": engine_id})
+        resource.assigned = list(assigned)
+        return resource
+
+    def test_counts(self):
+        tally = EngineTally()
+        r1 = self.make_resource("r1", "n1", "e1", [("o", "p1", 0)])
+        r2 = self.make_resource("r2", "n1", "e1")
+        r3 = self.make_resource("r3", "n2", "e1")
+        r4 = self.make_resource("r4", "n3", "e2", [("o", "p2", 0)])
+        for resource in (r1, r2, r3, r4):
+            tally.set_resource(resource)
+
+        tally.set_queued_process(("o", "p3", 0), "e1")
+
+        # round N assigned and round N+1 queued is counted once
+        tally.set_queued_process(("o", "p1", 1), "e1")
+
+        self.assertEqual(tally.get_process_count("e1"), 2)
+        self.assertEqual(tally.get_node_count("e1"), 2)
+        self.assertEqual(tally.get_occupied_node_count("e1"), 1)
+        self.assertEqual(tally.get_unoccupied_nodes("e1"), ["n2"])
+        self.assertEqual(tally.get_process_count("e2"), 1)
+        self.assertEqual(tally.get_process_count("unknown"), 0)
+
+        r1.assigned = []
+        tally.set_resource(r1)
+        self.assertEqual(tally.get_process_count("e1"), 2)
+        self.assertEqual(tally.get_occupied_node_count("e1"), 0)
+        self.assertEqual(set(tally.get_unoccupied_nodes("e1")), set(["n1", "n2"]))
+
+        tally.discard_queued_process(("o", "p1", 1))
+        tally.discard_queued_process(("o", "p1", 1))
+        self.assertEqual(tally.get_process_count("e1"), 1)
+
+        tally.discard_resource("r1")
+        tally.discard_resource("r2")
+        tally.discard_resource("r2")
+        self.assertEqual(tally.get_node_count("e1"), 1)
+
+        tally.discard_resource("r4")
+        self.assertEqual(tally.get_process_count("e2"), 0)
+        self.assertEqual(tally.get_node_count("e2"), 0)
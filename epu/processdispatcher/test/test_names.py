@@ -0,0 +1,76 @@
+# Copyright 2013 University of Chicago
+
+import logging
+import os
+import re
+import time
+import unittest
+
+from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
+
+from epu.processdispatcher import names
+
+log = logging.getLogger(__name__)
+
+
+class NamesTests(unittest.TestCase):
+
+    def test_process_names(self):
+        for owner, upid in (("o1", "p1"), (None, "p1"), ("a&b", "c=d&e")):
+            name = names.make_process_name(owner, upid)
+            self.assertEqual(names.parse_process_name(name), (owner, upid))
+
+        self.assertEqual(names.make_process_name("o1", "p1"), "owner=o1&upid=p1")
+        self.assertEqual(names.make_process_name(None, "p1"), "upid=p1")
+        self.assertRaises(ValueError, names.make_process_name, "o1", None)
+        self.assertRaises(ValueError, names.parse_process_name, "owner=o1")
+
+    def test_queued_process_names(self):
+        self.assertEqual(names.make_queued_process_name("o1", "p1", 2),
+            "owner=o1&upid=p1&round=2+")
+        self.assertEqual(names.make_queued_process_name(None, "p1", 0, "0000000007"),
+            "upid=p1&round=0+0000000007")
+        self.assertRaises(ValueError, names.make_queued_process_name, "o1", "p1", None)
+
+        self.assertEqual(names.parse_queued_process_name("owner=o1&upid=p1&round=2+0000000003"),
+            ("o1", "p1", 2, "0000000003"))
+        self.assertEqual(names.parse_queued_process_name("upid=p1&round=0+0000000007"),
+            (None, "p1", 0, "0000000007"))
+
+        for bad in ("owner=o1&upid=p1&round=2+", "upid=p1&round=x+1", "upid=p1"):
+            self.assertRaises(ValueError, names.parse_queued_process_name, bad)
+
+    @attr('INT')
+    def test_parse_benchmark(self):
+        if not os.environ.get('INT'):
+            raise SkipTest("Skip slow benchmark")
+
+        count = 50000
+        queue = [names.make_queued_process_name("owner%d" % (i % 10),
+            "upid%d" % i, i % 3, "%010d" % i) for i in range(count)]
+
+        # the inline parse that the store used to do
+        def parse_inline(name):
+            match = re.match(r'^owner=(.+)&upid=(.+)&round=([0-9]+)\+([0-9]+)$', name)
+            if match is not None:
+                owner, upid, round, seq = match.groups()
+            else:
+                match = re.match(r'^upid=(.+)&round=([0-9]+)\+([0-9]+)$', name)
+                owner = None
+                upid, round, seq = match.groups()
+            return owner, upid, int(round), seq
+
+        start = time.time()
+        for name in queue:
+            parse_inline(name)
+        inline_time = time.time() - start
+
+        start = time.time()
+        for name in queue:
+            names.parse_queued_process_name(name)
+        precompiled_time = time.time() - start
+
+        log.info("parsed %d queue entries: inline %.3fs, precompiled %.3fs",
+            count, inline_time, precompiled_time)
+        self.assertLess(precompiled_time, inline_time)
@@ -0,0 +1,57 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+
+from mock import patch
+
+from epu.processdispatcher.resourcecache import ResourceCache
+from epu.processdispatcher.store import ProcessDispatcherStore, ResourceRecord
+from epu.states import ExecutionResourceState
+
+
+class ResourceCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ProcessDispatcherStore()
+        self.cache = ResourceCache(self.store)
+        self.notified = []
+
+    def notify(self):
+        self.notified.append(True)
+
+    def test_shared_changes(self):
+        self.store.add_resource(ResourceRecord.new("r1", "n1", 1))
+        sub1 = self.cache.subscribe(self.notify)
+        sub2 = self.cache.subscribe()
+
+        # new subscriptions start out with every resource
+        self.assertEqual(sub1.get_changes(), set(["r1"]))
+        self.assertEqual(sub1.get_changes(), set())
+
+        self.store.add_resource(ResourceRecord.new("r2", "n1", 1))
+        self.assertTrue(self.notified)
+
+        resource = self.store.get_resource("r1")
+        resource.state = ExecutionResourceState.WARNING
+        self.store.update_resource(resource)
+
+        # each change is read from the store once, for all subscriptions
+        with patch.object(self.store, "get_resource",
+                          wraps=self.store.get_resource) as mock_get_resource:
+            self.assertEqual(sub1.get_changes(), set(["r1", "r2"]))
+            self.assertEqual(sub2.get_changes(), set(["r1", "r2"]))
+            self.assertEqual(mock_get_resource.call_count, 2)
+
+        # subscribers get their own copies
+        r1 = self.cache.get_resource("r1")
+        self.assertEqual(r1.state, ExecutionResourceState.WARNING)
+        self.assertEqual(r1.metadata['version'], resource.metadata['version'])
+        r1.assigned.append(("owner", "upid", 0))
+        self.assertEqual(self.cache.get_resource("r1").assigned, [])
+
+        self.store.remove_resource("r2")
+        self.assertEqual(sub2.get_changes(), set(["r2"]))
+        self.assertIsNone(self.cache.get_resource("r2"))
+
+        sub1.cancel()
+        self.assertEqual(self.cache.subscriptions, [sub2])
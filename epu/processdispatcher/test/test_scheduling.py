@@ -0,0 +1,76 @@
+# Copyright 2013 University of Chicago
+
+import unittest
+
+from epu.processdispatcher.store import ProcessRecord
+from epu.processdispatcher.scheduling import SchedulingPolicy, \
+    PrioritySchedulingPolicy, FairShareSchedulingPolicy, \
+    SchedulingPolicyType, get_scheduling_policy
+from epu.states import ProcessState
+
+
+def make_process(owner, upid, priority=None):
+    return ProcessRecord.new(owner, upid, {}, ProcessState.REQUESTED,
+        priority=priority)
+
+
+def upids(processes):
+    return [p.upid for p in processes]
+
+
+class SchedulingPolicyTests(unittest.TestCase):
+
+    def test_fifo(self):
+        processes = [make_process("o1", "p1", 5), make_process("o2", "p2")]
+        self.assertEqual(upids(SchedulingPolicy().order(processes)), ["p1", "p2"])
+
+    def test_priority(self):
+        processes = [make_process("o1", "p1"), make_process("o1", "p2", 5),
+                     make_process("o1", "p3", -1), make_process("o1", "p4", 5),
+                     make_process("o1", "p5", 0)]
+
+        # legacy records without a priority at all are priority 0
+        del processes[0]['priority']
+
+        ordered = PrioritySchedulingPolicy().order(processes)
+        self.assertEqual(upids(ordered), ["p2", "p4", "p1", "p5", "p3"])
+
+    def test_fair_share(self):
+        # o1 floods the queue ahead of o2 and o3
+        processes = [make_process("o1", "a%d" % i) for i in range(6)]
+        processes.append(make_process("o2", "b0"))
+        processes.append(make_process("o2", "b1"))
+        processes.append(make_process("o3", "c0"))
+
+        ordered = FairShareSchedulingPolicy().order(processes)
+        self.assertEqual(upids(ordered),
+            ["a0", "b0", "c0", "a1", "b1", "a2", "a3", "a4", "a5"])
+
+    def test_fair_share_weights(self):
+        processes = [make_process("o1", "a%d" % i) for i in range(4)]
+        processes.extend(make_process("o2", "b%d" % i) for i in range(4))
+
+        policy = FairShareSchedulingPolicy(owner_weights={"o2": 2})
+        ordered = policy.order(processes)
+        self.assertEqual(upids(ordered),
+            ["a0", "b0", "b1", "a1", "b2", "b3", "a2", "a3"])
+
+    def test_fair_share_priority_classes(self):
+        processes = [make_process("o1", "a0"), make_process("o1", "a1"),
+                     make_process("o2", "b0"), make_process("sys", "s0", 10)]
+
+        ordered = FairShareSchedulingPolicy().order(processes)
+        self.assertEqual(upids(ordered), ["s0", "a0", "b0", "a1"])
+
+    def test_get_scheduling_policy(self):
+        self.assertIsInstance(get_scheduling_policy(None), SchedulingPolicy)
+        self.assertIsInstance(
+            get_scheduling_policy(dict(type=SchedulingPolicyType.PRIORITY)),
+            PrioritySchedulingPolicy)
+
+        policy = get_scheduling_policy(dict(type=SchedulingPolicyType.FAIR_SHARE,
+            owner_weights={"o1": 3}))
+        self.assertIsInstance(policy, FairShareSchedulingPolicy)
+        self.assertEqual(policy.owner_weights, {"o1": 3})
+
+        self.assertRaises(ValueError, get_scheduling_policy, dict(type="LIFO"))
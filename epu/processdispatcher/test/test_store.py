@@ -12,7 +12,9 @@ from kazoo.exceptions import KazooException
 
 from epu.exceptions import NotFoundError, WriteConflictError
 from epu.processdispatcher.store import ResourceRecord, ProcessDispatcherStore,\
-    ProcessDispatcherZooKeeperStore, ProcessDefinitionRecord
+    ProcessDispatcherZooKeeperStore, ProcessDefinitionRecord, ProcessRecord, \
+    NodeRecord, PROCESS_HISTORY_SIZE
+from epu.states import ProcessState
 from epu.test import ZooKeeperTestMixin, MockLeader, SocatProxyRestartWrapper
 
 log = logging.getLogger(__name__)
@@ -69,6 +71,213 @@ class ProcessDispatcherStoreTests(unittest.TestCase, StoreTestMixin):
         queued = self.store.get_queued_processes()
         self.assertEqual(source, queued)
 
+    def test_enqueue_processes(self):
+        self.store.enqueue_process("u1", "proc1", 0)
+
+        source = [("u1", "proc%d" % i, 1) for i in range(2, 250)]
+        self.store.enqueue_processes(iter(source))
+        self.store.enqueue_processes([])
+
+        queued = self.store.get_queued_processes()
+        self.assertEqual([("u1", "proc1", 0)] + source, queued)
+
+        self.store.remove_queued_process("u1", "proc200", 1)
+        self.assertEqual(len(self.store.get_queued_processes()), len(source))
+
+    def test_requeue_process(self):
+        self.store.enqueue_process("u1", "proc1", 0)
+        self.store.enqueue_process("u1", "proc2", 0)
+        self.store.remove_queued_process("u1", "proc1", 0)
+        self.assertRaises(NotFoundError, self.store.remove_queued_process,
+            "u1", "proc1", 0)
+
+        # queue the same key again and make sure the new entry is removed
+        self.store.enqueue_process("u1", "proc1", 0)
+        self.assertEqual(self.store.get_queued_processes(),
+            [("u1", "proc2", 0), ("u1", "proc1", 0)])
+        self.store.remove_queued_process("u1", "proc1", 0)
+        self.assertEqual(self.store.get_queued_processes(), [("u1", "proc2", 0)])
+
+    def test_get_processes(self):
+        p1 = ProcessRecord.new("u1", "proc1", {}, ProcessState.REQUESTED)
+        p2 = ProcessRecord.new(None, "proc2", {}, ProcessState.RUNNING)
+        self.store.add_process(p1)
+        self.store.add_process(p2)
+        self.store.update_process(p2)
+
+        found = self.store.get_processes([("u1", "proc1"), ("u1", "nope"),
+            (None, "proc2")])
+        self.assertEqual(len(found), 3)
+        self.assertEqual(found[0].upid, "proc1")
+        self.assertIsNone(found[1])
+        self.assertEqual(found[2].state, ProcessState.RUNNING)
+        self.assertEqual(found[2].metadata['version'],
+            self.store.get_process(None, "proc2").metadata['version'])
+
+        self.assertEqual(self.store.get_processes([]), [])
+
+    def test_process_state_index(self):
+        state = ProcessState.UNSCHEDULED_PENDING
+        p1 = ProcessRecord.new("u1", "proc1", {}, state)
+        p2 = ProcessRecord.new(None, "proc2", {}, ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        self.store.add_process(p2)
+        self.assertEqual(self.store.get_process_ids_by_state(state),
+            [("u1", "proc1")])
+
+        p2.state = state
+        self.store.update_process(p2)
+        self.assertEqual(set(self.store.get_process_ids_by_state(state)),
+            set([("u1", "proc1"), (None, "proc2")]))
+
+        # a process is only removed once it has left the state, and only if
+        # the record has not changed since it was read
+        self.assertFalse(self.store.unindex_process_state(p2, state))
+        p2.state = ProcessState.REQUESTED
+        self.store.update_process(p2)
+        stale_p2 = self.store.get_process(None, "proc2")
+        self.store.update_process(p2)
+        self.assertFalse(self.store.unindex_process_state(stale_p2, state))
+        self.assertTrue(self.store.unindex_process_state(p2, state))
+        self.assertEqual(self.store.get_process_ids_by_state(state),
+            [("u1", "proc1")])
+
+        self.store.remove_process("u1", "proc1")
+        self.assertEqual(self.store.get_process_ids_by_state(state), [])
+
+        self.store.index_process_state(None, "proc2", state)
+        self.assertEqual(self.store.get_process_ids_by_state(state),
+            [(None, "proc2")])
+
+        self.assertRaises(ValueError, self.store.get_process_ids_by_state,
+            ProcessState.RUNNING)
+
+    def test_process_watches(self):
+        process_set_changed = threading.Event()
+        process_changed = []
+        process_changed_event = threading.Event()
+
+        def process_watcher(owner, upid):
+            process_changed.append((owner, upid))
+            process_changed_event.set()
+
+        self.assertEqual(self.store.get_process_ids(
+            watcher=lambda *args: process_set_changed.set()), [])
+
+        p1 = ProcessRecord.new("u1", "proc1", {}, ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        process_set_changed.wait(5)
+        self.assertTrue(process_set_changed.is_set())
+
+        found = self.store.get_processes([("u1", "proc1")],
+            watcher=process_watcher)
+        self.assertEqual(found[0].upid, "proc1")
+        self.store.update_process(p1)
+        process_changed_event.wait(5)
+        self.assertEqual(process_changed, [("u1", "proc1")])
+
+    def test_engines(self):
+        engines_changed = threading.Event()
+
+        self.assertEqual(self.store.get_engine_ids(
+            watcher=lambda *args: engines_changed.set()), [])
+        self.assertIsNone(self.store.get_engine("engine1"))
+
+        self.store.add_engine("engine1", {"slots": 4, "replicas": 2})
+        engines_changed.wait(5)
+        self.assertTrue(engines_changed.is_set())
+
+        self.assertEqual(self.store.get_engine_ids(), ["engine1"])
+        self.assertEqual(self.store.get_engine("engine1"),
+            {"slots": 4, "replicas": 2})
+
+        self.assertRaises(WriteConflictError, self.store.add_engine,
+            "engine1", {"slots": 1})
+
+    def test_remove_resource_heartbeat(self):
+        r1 = ResourceRecord.new("r1", "n1", 1)
+        self.store.add_resource(r1)
+        r2 = ResourceRecord.new("r2", "n1", 1)
+        self.store.add_resource(r2)
+        self.store.set_resource_heartbeat("r1", 100)
+
+        # the heartbeat goes with the resource, whether or not there is one
+        self.store.remove_resource("r1")
+        self.store.remove_resource("r2")
+        self.assertIsNone(self.store.get_resource_heartbeat("r1"))
+        self.assertIsNone(self.store.get_resource_heartbeat("r2"))
+        self.assertRaises(NotFoundError, self.store.remove_resource, "r1")
+
+        # a late heartbeat from a removed resource is dropped
+        self.store.set_resource_heartbeat("r2", 200)
+        self.assertIsNone(self.store.get_resource_heartbeat("r2"))
+
+        # so a resource with the same ID starts without one
+        self.store.add_resource(r1)
+        self.assertIsNone(self.store.get_resource_heartbeat("r1"))
+        self.store.add_resource(r2)
+        self.assertIsNone(self.store.get_resource_heartbeat("r2"))
+
+    def test_commit_assignment(self):
+        r1 = ResourceRecord.new("r1", "n1", 2)
+        self.store.add_resource(r1)
+
+        p1 = ProcessRecord.new("u1", "p1", {}, ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1.key)
+        p2 = ProcessRecord.new("u1", "p2", {}, ProcessState.REQUESTED)
+        self.store.add_process(p2)
+
+        # p2 is not queued. that is not an error.
+        r1.assigned.extend([p1.key, p2.key])
+        p1.state = p2.state = ProcessState.ASSIGNED
+        self.store.commit_assignment(r1, [p1, p2])
+
+        self.assertRecordVersions(r1, self.store.get_resource("r1"))
+        self.assertEqual(len(self.store.get_resource("r1").assigned), 2)
+        for p in (p1, p2):
+            got = self.store.get_process(p.owner, p.upid)
+            self.assertRecordVersions(p, got)
+            self.assertEqual(got.state, ProcessState.ASSIGNED)
+        self.assertEqual(self.store.get_queued_processes(), [])
+
+        # a conflict on any record means nothing is written
+        p3 = ProcessRecord.new("u1", "p3", {}, ProcessState.REQUESTED)
+        self.store.add_process(p3)
+        self.store.enqueue_process(*p3.key)
+        stale_p3 = self.store.get_process("u1", "p3")
+        p3.state = ProcessState.TERMINATED
+        self.store.update_process(p3)
+
+        r1.assigned.remove(p2.key)
+        r1.assigned.append(stale_p3.key)
+        stale_p3.state = ProcessState.ASSIGNED
+        self.assertRaises(WriteConflictError, self.store.commit_assignment,
+            r1, [stale_p3])
+
+        got_r1 = self.store.get_resource("r1")
+        self.assertRecordVersions(r1, got_r1)
+        self.assertEqual(len(got_r1.assigned), 2)
+        self.assertTrue(got_r1.is_assigned(*p2.key))
+        self.assertEqual(self.store.get_queued_processes(), [p3.key])
+
+        # a node record goes out with the assignment, and conflicts with it
+        n1 = NodeRecord.new("n1", "d1")
+        self.store.add_node(n1)
+        stale_n1 = self.store.get_node("n1")
+        n1.node_exclusive = ["port5000"]
+        self.store.commit_assignment(r1, [], node=n1)
+        self.assertRecordVersions(n1, self.store.get_node("n1"))
+        self.assertEqual(self.store.get_node("n1").node_exclusive, ["port5000"])
+
+        self.assertRaises(WriteConflictError, self.store.commit_assignment,
+            r1, [], node=stale_n1)
+        self.assertRecordVersions(r1, self.store.get_resource("r1"))
+
+        self.store.remove_resource("r1")
+        self.assertRaises(NotFoundError, self.store.commit_assignment,
+            r1, [p3])
+
     def assertProcessDefinitionsEqual(self, d1, d2):
         attrs = ('definition_id', 'definition_type', 'executable',
                              'name', 'description', 'version')
@@ -262,3 +471,35 @@ class RecordTests(unittest.TestCase):
         self.assertEqual(r2.metadata['version'], 1)
         self.assertNotIn('metadata', r1_dict_copy)
         self.assertNotIn('metadata', r2_dict_copy)
+
+    def test_process_history_bounded(self):
+        p = ProcessRecord.new(None, "p1", {}, ProcessState.REQUESTED)
+        self.assertIsNone(p.get_last_dispatch_time())
+
+        for _ in range(PROCESS_HISTORY_SIZE * 3):
+            p.increment_dispatches()
+            p.increment_starts()
+
+        self.assertEqual(p.dispatches, PROCESS_HISTORY_SIZE * 3)
+        self.assertEqual(p.starts, PROCESS_HISTORY_SIZE * 3)
+        self.assertEqual(len(p.dispatch_times), PROCESS_HISTORY_SIZE)
+        self.assertEqual(len(p.start_times), PROCESS_HISTORY_SIZE)
+        self.assertEqual(p.get_last_dispatch_time(), p.dispatch_times[-1])
+        self.assertEqual(p.get_last_start_time(), p.start_times[-1])
+
+    def test_process_history_old_record(self):
+        # records written before the history was bounded have no latest
+        # times and may have long lists
+        p = ProcessRecord.new(None, "p1", {}, ProcessState.REQUESTED)
+        del p['last_dispatch_time']
+        del p['last_start_time']
+        p.dispatches = 1000
+        p.dispatch_times = [float(i) for i in range(1000)]
+
+        self.assertEqual(p.get_last_dispatch_time(), 999.0)
+        self.assertIsNone(p.get_last_start_time())
+
+        p.increment_dispatches()
+        self.assertEqual(p.dispatches, 1001)
+        self.assertEqual(len(p.dispatch_times), PROCESS_HISTORY_SIZE)
+        self.assertEqual(p.get_last_dispatch_time(), p.dispatch_times[-1])
@@ -1,5 +1,9 @@
 # Copyright 2013 University of Chicago
 
+import threading
+from collections import OrderedDict
+
+
 def get_process_state_message(process):
     """Get a string suitable for logging a process state
     """
@@ -48,3 +52,70 @@ def get_set_difference_debug_message(set1, set2):
         return "added=%s" % (difference2,)
     else:
         return "sets are equal"
+
+
+def iter_processes(store, process_ids, batch_size=1000):
+    """Read process records in bulk, a batch at a time
+
+    Yields each record found, in the order of process_ids.
+    """
+    process_ids = list(process_ids)
+    for start in range(0, len(process_ids), batch_size):
+        batch = process_ids[start:start + batch_size]
+        for process in store.get_processes(batch):
+            if process is not None:
+                yield process
+
+
+def get_processes_by_state(store, state):
+    """Returns the records of all processes in an indexed process state
+
+    Only processes in the state's index are read. Any which turn out to have
+    left the state are removed from the index.
+    """
+    processes = []
+    for process in iter_processes(store, store.get_process_ids_by_state(state)):
+        if process.state == state:
+            processes.append(process)
+        else:
+            store.unindex_process_state(process, state)
+    return processes
+
+
+class LRUCache(object):
+    """A bounded mapping which forgets its least recently used entries
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)